@@ -0,0 +1,88 @@
+"""
+This module includes functions for keeping per-table checkpoints in a local json file, so that a sync or migration
+can pick up where the last run stopped.  Each table has its own dictionary in the file, and each kind of
+checkpoint (e.g. the high-water mark of an incremental sync) is stored under its own key in that dictionary.
+The file is rewritten atomically, so a crash while saving leaves the previous checkpoints in place.
+
+Functions:
+    load_checkpoints: loads every table's checkpoints from the checkpoint file
+    get_checkpoint: returns one checkpoint for a table
+    save_checkpoint: saves one checkpoint for a table
+    clear_checkpoint: removes one checkpoint for a table
+"""
+
+
+import json
+import os
+import threading
+
+CHECKPOINT_PATH = './checkpoints.json'
+
+_CHECKPOINT_LOCK = threading.Lock()
+
+
+def load_checkpoints(path=None):
+    """ Loads every table's checkpoints from the checkpoint file.
+        Args:
+            path (string): path of the checkpoint file (defaults to CHECKPOINT_PATH)
+        Returns:
+            dictionary of dictionaries, keyed by table name (empty if the file does not exist yet)
+    """
+    path = path or CHECKPOINT_PATH
+    if not os.path.exists(path):
+        return {}
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def get_checkpoint(table, key, path=None):
+    """ Returns one checkpoint for a table.
+        Args:
+            table (string): name of the table
+            key (string): kind of checkpoint, e.g. 'watermark'
+            path (string): path of the checkpoint file (defaults to CHECKPOINT_PATH)
+        Returns:
+            the saved value, or None if there is no checkpoint of this kind for the table
+    """
+    with _CHECKPOINT_LOCK:
+        return load_checkpoints(path).get(table, {}).get(key)
+
+
+def _write_checkpoints(checkpoints, path):
+    """ Writes the checkpoint file through a temporary file, so that it is never left half-written """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as checkpoint_file:
+        # Dates and decimals read from MySQL are stored as strings, which MySQL compares correctly with the
+        # original column values
+        json.dump(checkpoints, checkpoint_file, indent=2, sort_keys=True, default=str)
+    os.replace(temp_path, path)
+
+
+def save_checkpoint(table, key, value, path=None):
+    """ Saves one checkpoint for a table, leaving its other checkpoints and other tables' checkpoints as they are.
+        Args:
+            table (string): name of the table
+            key (string): kind of checkpoint, e.g. 'watermark'
+            value: json-serializable value to save
+            path (string): path of the checkpoint file (defaults to CHECKPOINT_PATH)
+    """
+    path = path or CHECKPOINT_PATH
+    with _CHECKPOINT_LOCK:
+        checkpoints = load_checkpoints(path)
+        checkpoints.setdefault(table, {})[key] = value
+        _write_checkpoints(checkpoints, path)
+
+
+def clear_checkpoint(table, key, path=None):
+    """ Removes one checkpoint for a table.
+        Args:
+            table (string): name of the table
+            key (string): kind of checkpoint, e.g. 'watermark'
+            path (string): path of the checkpoint file (defaults to CHECKPOINT_PATH)
+    """
+    path = path or CHECKPOINT_PATH
+    with _CHECKPOINT_LOCK:
+        checkpoints = load_checkpoints(path)
+        if key in checkpoints.get(table, {}):
+            del checkpoints[table][key]
+            _write_checkpoints(checkpoints, path)
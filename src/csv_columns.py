@@ -0,0 +1,184 @@
+"""
+This module includes functions for converting the values of a table's CSV file to the types in its schema a
+column at a time instead of a cell at a time.  Rows are read in blocks and each block is turned into columns.
+DATETIME columns are parsed in bulk by NumPy, which reads the fixed '%Y-%m-%d %H:%M:%S' format far faster than
+datetime.strptime.  NumPy also accepts shorter ISO forms, such as a date on its own, so only values shaped exactly
+like '%Y-%m-%d %H:%M:%S' are left to NumPy, and any other value goes through datetime.strptime, which raises a
+ValueError for malformed values as the per-cell conversion did.  INT columns are converted with a single int()
+pass over the column.  'NULL' is converted to None in every column, whatever its type.
+
+Functions:
+    column_types: returns the kind of conversion needed for each column of a schema
+    convert_int_column: converts a column of integer strings
+    convert_datetime_column: converts a column of '%Y-%m-%d %H:%M:%S' strings
+    convert_columns: converts a block of CSV rows into typed rows
+    read_csv_blocks: reads a CSV file in blocks of rows
+    read_typed_blocks: reads a CSV file in blocks of typed rows
+"""
+
+
+import csv
+from datetime import datetime
+import numpy as np
+
+NULL = 'NULL'
+BLOCK_ROWS = 10000
+# Value put in place of 'NULL' before a column is parsed, so that the whole column can be parsed in one call
+_INT_PLACEHOLDER = '0'
+_DATETIME_PLACEHOLDER = '1970-01-01 00:00:00'
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Position of each separator in a '%Y-%m-%d %H:%M:%S' value.  Every other character is a digit.
+_DATETIME_SEPARATORS = {4: '-', 7: '-', 10: ' ', 13: ':', 16: ':'}
+
+
+def column_types(tbl_schema):
+    """ Returns the kind of conversion needed for each column of a schema.
+        Args:
+            tbl_schema (list): [<column name>, <data type>] for each column, as read by import_schemas_from_file
+                or read_schema_from_db
+        Returns:
+            list of strings: 'int', 'datetime' or 'str' for each column
+    """
+    types = []
+    for col in tbl_schema:
+        data_type = col[1].upper()
+        if data_type.startswith('DATETIME'):
+            types.append('datetime')
+        elif 'INT' in data_type:
+            types.append('int')
+        else:
+            types.append('str')
+    return types
+
+
+def _string_array(values, placeholder):
+    """ Returns a NumPy array of strings that is wide enough for both the values and the placeholder """
+    array = np.array(values, dtype=str)
+    return array.astype(np.promote_types(array.dtype, 'U{}'.format(len(placeholder))))
+
+
+def _null_mask(array, placeholder):
+    """ Returns a boolean mask of the 'NULL' values in an array of strings and replaces them with a placeholder """
+    mask = array == NULL
+    if mask.any():
+        array[mask] = placeholder
+    return mask
+
+
+def _restore_nulls(values, mask):
+    """ Puts None back in the positions of a list that held 'NULL' """
+    for i in np.flatnonzero(mask):
+        values[i] = None
+    return values
+
+
+def convert_int_column(values):
+    """ Converts a column of integer strings.
+        Args:
+            values (sequence of strings): column values, e.g. ('12', 'NULL', '7')
+        Returns:
+            list of integers, with None for 'NULL'
+    """
+    # int() over the whole column runs in C and is faster than NumPy's string to integer cast, so NumPy is
+    # only used to find the NULLs
+    if NULL not in values:
+        return list(map(int, values))
+    array = _string_array(values, _INT_PLACEHOLDER)
+    mask = _null_mask(array, _INT_PLACEHOLDER)
+    return _restore_nulls(list(map(int, array.tolist())), mask)
+
+
+def _datetime_shape_mask(array):
+    """ Returns a boolean mask of the values of an array of strings that are shaped exactly like
+        '%Y-%m-%d %H:%M:%S', with zero-padded fields.  The ranges of the fields (month, day, hours...) are left to
+        NumPy's cast, which rejects values out of range.
+    """
+    width = len(_DATETIME_PLACEHOLDER)
+    shaped = np.char.str_len(array) == width
+    # One column of single characters for each position in the value
+    chars = array.astype('U{}'.format(width)).view('U1').reshape(len(array), width)
+    for i in range(width):
+        if i in _DATETIME_SEPARATORS:
+            shaped &= chars[:, i] == _DATETIME_SEPARATORS[i]
+        else:
+            shaped &= (chars[:, i] >= '0') & (chars[:, i] <= '9')
+    return shaped
+
+
+def convert_datetime_column(values):
+    """ Converts a column of '%Y-%m-%d %H:%M:%S' strings.
+        Args:
+            values (sequence of strings): column values, e.g. ('2018-05-01 13:45:00', 'NULL')
+        Returns:
+            list of datetime objects, with None for 'NULL'
+    """
+    # The values are copied into a NumPy array of strings and the NULLs are replaced, so that the column can be
+    # cast to datetime64 in one call.  Values of any other shape are parsed by strptime, which raises for malformed
+    # values, and are also replaced before the cast.  The cast column is turned back into a list of datetime
+    # objects, and the strptime results and the NULLs are put back in their positions.
+    array = _string_array(values, _DATETIME_PLACEHOLDER)
+    mask = _null_mask(array, _DATETIME_PLACEHOLDER)
+    other = np.flatnonzero(~_datetime_shape_mask(array))
+    parsed = [datetime.strptime(value, DATETIME_FORMAT) for value in array[other].tolist()]
+    array[other] = _DATETIME_PLACEHOLDER
+    converted = array.astype('datetime64[s]').tolist()
+    for i, value in zip(other, parsed):
+        converted[i] = value
+    return _restore_nulls(converted, mask)
+
+
+def _convert_str_column(values):
+    """ Keeps a column of strings as it is, apart from 'NULL' which becomes None """
+    return [None if value == NULL else value for value in values]
+
+
+CONVERTERS = {'int': convert_int_column, 'datetime': convert_datetime_column, 'str': _convert_str_column}
+
+
+def convert_columns(types, rows):
+    """ Converts a block of CSV rows into typed rows, a column at a time.
+        Args:
+            types (list of strings): conversion for each column, as returned by column_types
+            rows (list): rows, each a list of strings
+        Returns:
+            list of tuples, one for each row
+    """
+    if not rows:
+        return []
+    for row in rows:
+        if len(row) != len(types):
+            raise ValueError('expected {} values, got {}: {}'.format(len(types), len(row), row))
+    columns = [CONVERTERS[col_type](values) for col_type, values in zip(types, zip(*rows))]
+    return list(zip(*columns))
+
+
+def read_csv_blocks(csv_file, block_rows=BLOCK_ROWS):
+    """ Reads an open CSV file in blocks of rows.
+        Args:
+            csv_file (file object): CSV file opened in text mode
+            block_rows (integer): number of rows in each block
+        Yields:
+            lists of rows, each a list of strings
+    """
+    block = []
+    for row in csv.reader(csv_file, delimiter=','):
+        block.append(row)
+        if len(block) == block_rows:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def read_typed_blocks(csv_file, tbl_schema, block_rows=BLOCK_ROWS):
+    """ Reads an open CSV file in blocks of typed rows, ready to be inserted.
+        Args:
+            csv_file (file object): CSV file opened in text mode
+            tbl_schema (list): [<column name>, <data type>] for each column
+            block_rows (integer): number of rows in each block
+        Yields:
+            lists of tuples, one for each row
+    """
+    types = column_types(tbl_schema)
+    for block in read_csv_blocks(csv_file, block_rows):
+        yield convert_columns(types, block)
@@ -0,0 +1,194 @@
+"""
+This module includes an in-memory cache of the small dimension tables (doctor and site), so that event
+documents can be enriched with their fields as they are generated, instead of flattening the event tables with a
+SQL join on RDS before every migration.  Each dimension is held as a dictionary from its key to a tuple of the
+columns that are attached to events, and is refreshed incrementally: rows with keys above the largest key loaded
+are added often, and the whole table is reloaded now and then to pick up rows that were changed.
+
+Functions:
+    load_dimensions: loads dimension tables into memory
+    refresh_dimension: adds new rows to a cached dimension, or reloads it
+    dimensions_generation: returns a number that changes whenever the rows of a cached dimension change
+    dimensions_for: returns the dimension tables needed to enrich a table's documents
+    compile_enrichment: compiles the lookups that enrich a table's documents
+    enrich_document: adds dimension fields to a document
+    start_dimension_refresher: refreshes cached dimensions at a fixed interval on their own connection
+"""
+
+
+import threading
+import time
+from mySQL_connect import rds_mysql_connection, close_connection
+
+# For each dimension table: its key column and the columns attached to event documents.  Columns that should not
+# be copied into every event (passwords, avatars) are left out.  Only tables that an event table refers to by key
+# are cached: no event table has a scribeId column, so scribe is not.
+DIMENSIONS = {'doctor': {'key': 'doctorId', 'columns': ['doctorFirstName', 'doctorLastName', 'doctorEmail',
+                                                        'doctorStatus', 'siteID']},
+              'site': {'key': 'id', 'columns': ['siteName', 'siteLeadEmail']}}
+
+# For each event table: the lookups that enrich its documents, in order, as (document field, dimension table).
+# A lookup can use a field added by an earlier one, e.g. the doctor's siteID to find the site.
+ENRICHMENTS = {'ee_audit_events': [('doctors_id', 'doctor'), ('siteID', 'site')]}
+
+# Seconds between incremental refreshes, and between full reloads
+REFRESH_INTERVAL = 30.0
+FULL_REFRESH_INTERVAL = 600.0
+
+# Counts the changes to the rows of cached dimensions, so that copies of them held elsewhere (e.g. by worker
+# processes) can tell when they are out of date
+_GENERATION = {'count': 0}
+
+
+def _read_rows(cur, table, dimension, after_key=None):
+    """ Reads a dimension's rows, or only those with keys above after_key, as a dictionary of key to tuple """
+    query = """SELECT {}, {} FROM {}""".format(dimension['key'], ', '.join(dimension['columns']), table)
+    if after_key is not None:
+        cur.execute(query + """ WHERE {} > %s""".format(dimension['key']), [after_key])
+    else:
+        cur.execute(query)
+    return {row[0]: tuple(row[1:]) for row in cur.fetchall()}
+
+
+def refresh_dimension(cur, table, dimension, full=False):
+    """ Adds the rows added to a dimension table since it was last read, with a range scan on its key, or reloads
+        the whole table.  The cached dictionary is updated in place, so lookups compiled from it see the new rows
+        straight away, and a full reload never leaves it empty while it runs.
+        Args:
+            cur (cursor object): MySQL cursor object that is connected to the database
+            table (string): name of the dimension table
+            dimension (dictionary): cached dimension returned by load_dimensions
+            full (boolean): whether to reload the whole table, picking up changed and deleted rows
+        Returns:
+            integer: number of rows read
+    """
+    rows = _read_rows(cur, table, dimension, None if full else dimension['max_key'])
+    changed = any(dimension['rows'].get(key) != values for key, values in rows.items())
+    dimension['rows'].update(rows)
+    if full:
+        deleted = set(dimension['rows']) - set(rows)
+        for key in deleted:
+            del dimension['rows'][key]
+        changed = changed or bool(deleted)
+    if changed:
+        _GENERATION['count'] += 1
+    if dimension['rows']:
+        dimension['max_key'] = max(dimension['rows'])
+    return len(rows)
+
+
+def dimensions_generation():
+    """ Returns a number that changes whenever rows of a cached dimension are added, changed or deleted """
+    return _GENERATION['count']
+
+
+def load_dimensions(cur, tables):
+    """ Loads dimension tables into memory.
+        Args:
+            cur (cursor object): MySQL cursor object that is connected to the database
+            tables (list of strings): dimension tables to load (keys of DIMENSIONS)
+        Returns:
+            dictionary with, for each table, its key column, the columns attached to documents, a dictionary of
+            key to tuple of column values and the largest key loaded
+    """
+    dimensions = {}
+    for table in tables:
+        dimensions[table] = {'key': DIMENSIONS[table]['key'], 'columns': list(DIMENSIONS[table]['columns']),
+                             'rows': {}, 'max_key': None}
+        refresh_dimension(cur, table, dimensions[table], full=True)
+        print('Loaded {} rows of {}'.format(len(dimensions[table]['rows']), table))
+    return dimensions
+
+
+def dimensions_for(table):
+    """ Returns the dimension tables needed to enrich a table's documents (empty if it is not enriched) """
+    return [dimension for field, dimension in ENRICHMENTS.get(table, [])]
+
+
+def compile_enrichment(dimensions, table):
+    """ Compiles the lookups that enrich a table's documents.
+        Args:
+            dimensions (dictionary): cached dimensions returned by load_dimensions
+            table (string): name of the table whose documents are enriched
+        Returns:
+            list of (document field, columns, dictionary of key to values) tuples, to be passed to
+            es_documents.compile_row_converter or enrich_document
+    """
+    return [(field, dimensions[dimension]['columns'], dimensions[dimension]['rows'])
+            for field, dimension in ENRICHMENTS.get(table, [])]
+
+
+def enrich_document(enrichment, doc):
+    """ Adds dimension fields to a document.  Fields of a dimension row that is not found are set to None, so that
+        every document of a table has the same fields.
+        Args:
+            enrichment (list): lookups returned by compile_enrichment
+            doc (dictionary): document to enrich in place
+        Returns:
+            the document
+    """
+    for field, columns, rows in enrichment:
+        values = rows.get(doc.get(field))
+        if values is None:
+            values = (None,) * len(columns)
+        doc.update(zip(columns, values))
+    return doc
+
+
+def _close_quietly(con, cur):
+    """ Closes a connection that may already be broken """
+    try:
+        close_connection(con, cur)
+    except Exception:
+        pass
+
+
+def start_dimension_refresher(dimensions, rds_info, interval=REFRESH_INTERVAL, full_interval=FULL_REFRESH_INTERVAL):
+    """ Refreshes cached dimensions in a background thread, on a connection of its own so that it does not get
+        in the way of the cursor reading the events.  New rows are added every <interval> seconds and the tables
+        are reloaded every <full_interval> seconds.  If the connection cannot be opened, or is lost, the refresher
+        reports it and connects again at the next interval.
+        Args:
+            dimensions (dictionary): cached dimensions returned by load_dimensions
+            rds_info (dictionary): MySQL connection information (see mySQL_connect.rds_mysql_connection)
+            interval (float): seconds between incremental refreshes
+            full_interval (float): seconds between full reloads
+        Returns:
+            threading.Event object.  Setting it stops the refresher.
+    """
+    stop = threading.Event()
+
+    def refresh():
+        connection_info = None
+        last_full = time.time()
+        try:
+            while not stop.wait(interval):
+                if connection_info is None:
+                    # rds_mysql_connection returns None when it cannot connect: try again at the next interval
+                    connection_info = rds_mysql_connection(rds_info)
+                    if connection_info is None:
+                        print('could not connect to refresh dimensions, retrying in {} seconds'.format(interval))
+                        continue
+                con, cur = connection_info
+                full = time.time() - last_full >= full_interval
+                for table, dimension in dimensions.items():
+                    try:
+                        refresh_dimension(cur, table, dimension, full)
+                    except Exception as e:
+                        print('failed to refresh {}: {}'.format(table, e))
+                if full:
+                    last_full = time.time()
+                try:
+                    # Start a new transaction, so that the next refresh sees rows committed since this one
+                    con.commit()
+                except Exception as e:
+                    print('lost the dimension refresh connection, reconnecting: {}'.format(e))
+                    _close_quietly(con, cur)
+                    connection_info = None
+        finally:
+            if connection_info is not None:
+                close_connection(*connection_info)
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+    return stop
@@ -0,0 +1,285 @@
+"""
+This module includes an asyncio engine for submitting payloads to the Elasticsearch Bulk API.  The engine runs
+its own event loop in a background thread and keeps a steady stream of bulk requests in flight across batches:
+callers hand it payloads and only wait when the global limit on requests in flight has been reached.  Each
+request goes to the node with the fewest requests in flight, and no node gets more than its own limit, so one
+slow node cannot hold up the others.  Requests are sent over keep-alive HTTP/1.1 connections that are pooled per
+node, and responses are handled item by item with the same retry and dead-letter rules as es_bulk.
+
+The engine only ever sends one kind of request (a POST with a Content-Length to /_bulk) and reads responses with a
+Content-Length or chunked body, so it speaks that much HTTP/1.1 itself over asyncio streams rather than adding an
+HTTP client such as aiohttp to the pinned requirements.  It also needs its own per-node connection pools to route
+each request to the least busy node, which a client's shared pool would hide.  tests/test_es_async.py checks it
+against es_standin, including chunked responses, connection reuse and whole-request 429, 503 and 500 responses.
+
+Functions:
+    start_engine: starts the engine for a list of Elasticsearch nodes, or updates its limits if it is running
+    submit_payload: hands a payload to the engine, waiting while the global limit is reached
+    collect_results: returns the counts for requests that have finished since the last call
+    flush_engine: waits for every request in flight to finish and returns their counts
+    stop_engine: waits for every request in flight, then stops the event loop and closes all connections
+    is_running: returns whether the engine has been started
+    in_flight: returns the number of requests in flight
+"""
+
+
+import asyncio
+import threading
+import time
+from es_bulk import new_bulk_stats, failed_bulk_outcome, sort_bulk_outcome, record_bulk_outcome, backoff_delay, \
+    join_bulk_pairs, MAX_RETRIES
+
+# State of the running engine.  'in_flight' and 'limit' are guarded by 'condition'; everything else that changes
+# while the engine runs is only touched from the event loop thread.
+_ENGINE = {'loop': None, 'thread': None, 'nodes': None, 'condition': threading.Condition(), 'in_flight': 0,
+           'limit': 0, 'node_limit': 0, 'node_freed': None, 'futures': set(), 'results': []}
+
+
+def _split_address(address):
+    """ Splits a 'host:port' node address """
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+async def _read_response(reader):
+    """ Reads an HTTP/1.1 response, returning the status, whether the server will keep the connection open, and
+        the body.
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed by server')
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    if 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        body = b''.join(chunks)
+    else:
+        body = await reader.read()
+        headers['connection'] = 'close'
+    return status, headers.get('connection', '').lower() != 'close', body
+
+
+async def _post(node, path, payload):
+    """ Posts a payload to a node over a pooled keep-alive connection.
+        Args:
+            node (dictionary): node state with its address and its pool of idle connections
+            path (string): request path, e.g. '/_bulk'
+            payload (bytes or bytearray): request body
+        Returns:
+            tuple: HTTP status and body of the response
+    """
+    head = ('POST {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/x-ndjson\r\nContent-Length: {}\r\n\r\n'
+            .format(path, node['address'], len(payload))).encode('latin-1')
+    while True:
+        reused = bool(node['idle'])
+        if reused:
+            reader, writer = node['idle'].pop()
+        else:
+            reader, writer = await asyncio.open_connection(*_split_address(node['address']))
+        try:
+            writer.write(head)
+            writer.write(payload)
+            await writer.drain()
+            status, keep_alive, body = await _read_response(reader)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            if reused:
+                # The server closed the idle connection, so try again on a new one
+                continue
+            raise
+        except Exception:
+            # After a malformed response the connection is in an unknown state, so it is not reused
+            writer.close()
+            raise
+        if keep_alive:
+            node['idle'].append((reader, writer))
+        else:
+            writer.close()
+        return status, body
+
+
+async def _choose_node():
+    """ Waits for a node with a free slot and returns the one with the fewest requests in flight """
+    if _ENGINE['node_freed'] is None:
+        # Created here so that the event belongs to the engine's event loop
+        _ENGINE['node_freed'] = asyncio.Event()
+    nodes = _ENGINE['nodes']
+    while True:
+        node = min(nodes, key=lambda n: n['in_flight'])
+        if node['in_flight'] < _ENGINE['node_limit']:
+            node['in_flight'] += 1
+            return node
+        await _ENGINE['node_freed'].wait()
+        _ENGINE['node_freed'].clear()
+
+
+def _release_node(node):
+    """ Frees a node's slot and wakes up any request waiting for one """
+    node['in_flight'] -= 1
+    _ENGINE['node_freed'].set()
+
+
+async def _submit_with_retry(payload, max_retries=MAX_RETRIES, dead_letter_path=None):
+    """ Submits a payload, re-sending only rejected documents after a backoff delay (see
+        es_bulk.submit_bulk_with_retry).  Each attempt goes to whichever node is least busy at the time.  If the
+        response cannot be read, the documents are dead-lettered, so that the counts returned always account for
+        every document of the payload.
+    """
+    num_docs = payload.count(b'\n') // 2
+    stats = new_bulk_stats(num_docs, len(payload))
+    pairs = None
+    attempt = 0
+    while num_docs:
+        node = await _choose_node()
+        t0 = time.time()
+        outcome = None
+        try:
+            status, body = await _post(node, '/_bulk', payload)
+        except (OSError, asyncio.IncompleteReadError) as exc:
+            print('bulk request failed: {}'.format(exc))
+            status, body = 503, b''
+        except Exception as exc:
+            print('bulk request failed: {}'.format(exc))
+            outcome = failed_bulk_outcome(payload, pairs, None, 'bulk request failed: {}'.format(exc))
+        finally:
+            _release_node(node)
+        stats['latencies'].append(time.time() - t0)
+        if outcome is None:
+            outcome = sort_bulk_outcome(status, body, payload, pairs, num_docs)
+        pairs = record_bulk_outcome(stats, outcome, attempt, max_retries, dead_letter_path)
+        num_docs = len(pairs)
+        if pairs:
+            await asyncio.sleep(backoff_delay(attempt))
+            attempt += 1
+            payload = join_bulk_pairs(pairs)
+            stats['sent_bytes'] += len(payload)
+    return stats
+
+
+def _run_loop(loop):
+    """ Runs the engine's event loop in its background thread """
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def start_engine(addresses, max_in_flight, node_limit=None):
+    """ Starts the engine for a list of Elasticsearch nodes.  If the engine is already running for the same
+        nodes, only its limits are updated, so requests already in flight are not affected.
+        Args:
+            addresses (list of strings): 'host:port' address of each node
+            max_in_flight (integer): maximum number of bulk requests in flight across all nodes
+            node_limit (integer): maximum number of bulk requests in flight to any one node (defaults to an even
+                share of max_in_flight plus one, so that faster nodes can take up some of a slow node's share)
+    """
+    if node_limit is None:
+        node_limit = -(-max_in_flight // len(addresses)) + 1
+    if _ENGINE['loop'] is not None and [n['address'] for n in _ENGINE['nodes']] != list(addresses):
+        stop_engine()
+    with _ENGINE['condition']:
+        _ENGINE['limit'] = max_in_flight
+        _ENGINE['node_limit'] = node_limit
+        _ENGINE['condition'].notify_all()
+    if _ENGINE['loop'] is None:
+        loop = asyncio.new_event_loop()
+        _ENGINE['nodes'] = [{'address': address, 'in_flight': 0, 'idle': []} for address in addresses]
+        _ENGINE['node_freed'] = None
+        _ENGINE['loop'] = loop
+        _ENGINE['thread'] = threading.Thread(target=_run_loop, args=(loop,), daemon=True)
+        _ENGINE['thread'].start()
+
+
+def _finished(future, payload):
+    """ Records the counts of a finished request and frees its place in the global limit.  If the request ended
+        with an error, its documents are counted as failed and dead-lettered.
+    """
+    if future.cancelled() or future.exception() is not None:
+        error = 'bulk request cancelled' if future.cancelled() else 'bulk request failed: {}'.format(
+            future.exception())
+        print(error)
+        stats = new_bulk_stats(payload.count(b'\n') // 2, len(payload))
+        record_bulk_outcome(stats, failed_bulk_outcome(payload, None, None, error), 0)
+    else:
+        stats = future.result()
+    with _ENGINE['condition']:
+        _ENGINE['in_flight'] -= 1
+        _ENGINE['futures'].discard(future)
+        _ENGINE['results'].append(stats)
+        _ENGINE['condition'].notify_all()
+
+
+def submit_payload(payload):
+    """ Hands a payload to the engine.  Returns as soon as the payload has been scheduled, waiting first if the
+        global limit on requests in flight has been reached.
+        Args:
+            payload (bytes or bytearray): '\\n'-delimited json actions and document sources
+    """
+    with _ENGINE['condition']:
+        while _ENGINE['in_flight'] >= _ENGINE['limit']:
+            _ENGINE['condition'].wait()
+        _ENGINE['in_flight'] += 1
+        future = asyncio.run_coroutine_threadsafe(_submit_with_retry(payload), _ENGINE['loop'])
+        _ENGINE['futures'].add(future)
+    future.add_done_callback(lambda f: _finished(f, payload))
+
+
+def collect_results():
+    """ Returns the counts for requests that have finished since the last call.
+        Returns:
+            list of dictionaries (see es_bulk.new_bulk_stats)
+    """
+    with _ENGINE['condition']:
+        results = _ENGINE['results']
+        _ENGINE['results'] = []
+    return results
+
+
+def flush_engine():
+    """ Waits for every request in flight to finish.
+        Returns:
+            list of dictionaries with the counts for requests that finished since collect_results was last called
+    """
+    with _ENGINE['condition']:
+        while _ENGINE['in_flight']:
+            _ENGINE['condition'].wait()
+    return collect_results()
+
+
+def stop_engine():
+    """ Waits for every request in flight to finish, then stops the event loop and closes all connections """
+    if _ENGINE['loop'] is None:
+        return
+    flush_engine()
+    loop = _ENGINE['loop']
+    for node in _ENGINE['nodes']:
+        for reader, writer in node['idle']:
+            loop.call_soon_threadsafe(writer.close)
+    loop.call_soon_threadsafe(loop.stop)
+    _ENGINE['thread'].join()
+    loop.close()
+    _ENGINE['loop'], _ENGINE['thread'], _ENGINE['nodes'] = None, None, None
+
+
+def is_running():
+    """ Returns whether the engine has been started (and not stopped since) """
+    return _ENGINE['loop'] is not None
+
+
+def in_flight():
+    """ Returns the number of requests that have been handed to the engine and have not finished yet """
+    with _ENGINE['condition']:
+        return _ENGINE['in_flight']
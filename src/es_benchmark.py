@@ -0,0 +1,454 @@
+"""
+This module includes a headless benchmark harness for the MySQL to Elasticsearch migration, so that throughput
+can be measured on a laptop or in CI without the EC2 cluster or the RDS instance.  Synthetic tables shaped like
+the ones in tblSchemas are generated into an in-memory SQLite database that stands in for MySQL, and bulk calls
+go to the local stand-in node from es_standin, with configurable latency and rejections, or to a real node.  A
+sweep runs migrate_table over every combination of batch size, number of workers, submission engine and mapping
+profile, and the results are written to a json or csv file and compared with a baseline file to catch throughput
+regressions.  Runs with the optimized mapping profile (see es_mappings) are also compared with the same runs using
+the legacy mapping, in throughput, bytes of bulk payload and, on a real node, size of the index on disk.
+
+Functions:
+    synthetic_value_factory: returns a function that generates values for a MySQL column type
+    synthetic_rows: generates reproducible rows for a table schema
+    load_synthetic_table: loads synthetic rows into an in-memory SQLite stand-in for MySQL
+    run_sweep: runs migrations over every combination of batch size, workers, engine and mapping profile
+    index_store_bytes: returns the size on disk of the primary shards of a table's live index
+    write_results: writes sweep results to a json or csv file
+    load_results: loads sweep results from a json or csv file
+    compare_to_baseline: compares sweep results with a baseline run
+    format_comparison: formats a baseline comparison for printing
+    compare_mappings: compares runs with each mapping profile to the same runs with the legacy mapping
+    format_mapping_comparison: formats a mapping comparison for printing
+    main: uses argparse to set up a command line interface for this module
+"""
+
+
+import os
+# Benchmarks run without a display, so plots from es_connect must not try to open a window
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+from es_connect import CONNECTION_IP, KEY_COLUMNS, API_FUNCS, migrate_table, generate_json, get_es_client, \
+    close_es_connections
+from es_mappings import MAPPING_PROFILES
+from es_standin import start_standin
+from metadata_cache import configure_cache
+from mySQL_connect import import_schemas_from_file
+from datetime import datetime, timedelta
+from itertools import product
+from argparse import ArgumentParser
+import csv
+import json
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+BENCHMARK_CONNECTION = 'benchmark'
+BENCHMARK_TABLES = ['ee_log', 'ee_audit_events', 'scribeuxmetricsconnectivity']
+# Fraction of non-key values that are NULL
+NULL_RATE = 0.05
+# First timestamp in every synthetic table.  Rows are 3 seconds apart.
+START_TIME = datetime(2018, 1, 1)
+# Columns that identify a run when comparing it with a baseline run
+RUN_KEYS = ['table', 'rows', 'batch_size', 'workers', 'engine', 'mapping', 'latency', 'latency_per_mb',
+            'rejection_rate']
+# Values of run settings that results written before the setting existed were run with
+RUN_DEFAULTS = {'mapping': 'legacy'}
+# Measures compared between mapping profiles, with their labels
+MAPPING_MEASURES = [('docs_per_sec', 'docs/s'), ('bulk_bytes', 'bulk bytes'), ('store_bytes', 'bytes on disk')]
+# Fractional drop in documents per second that counts as a regression
+TOLERANCE = 0.1
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('DATETIME', lambda value: datetime.strptime(value.decode('utf-8'), '%Y-%m-%d %H:%M:%S'))
+
+
+def synthetic_value_factory(col_type, rng, text):
+    """ Returns a function that generates values for a MySQL column type.
+        Args:
+            col_type (string): MySQL column type from tblSchemas, e.g. 'INT(11)', 'VARCHAR(100)' or 'DATETIME'
+            rng (random.Random object): random number generator shared by all columns of the table
+            text (string): random text that string values are sliced from
+        Returns:
+            function that takes the row number and returns a value
+    """
+    col_type = col_type.upper()
+    if col_type.startswith('TINYINT'):
+        return lambda i: rng.randint(0, 1)
+    elif 'INT' in col_type:
+        return lambda i: rng.randint(1, 1000000)
+    elif col_type == 'DATETIME':
+        return lambda i: START_TIME + timedelta(seconds=3 * i + rng.randint(0, 2))
+    if col_type.startswith('VARCHAR'):
+        max_length = min(int(col_type[8:-1]), 200)
+    elif col_type == 'LONGTEXT':
+        max_length = 2000
+    else:
+        max_length = 500
+
+    def string_value(i):
+        length = rng.randint(1, max_length)
+        start = rng.randint(0, len(text) - length)
+        return text[start:start + length]
+    return string_value
+
+
+def synthetic_rows(table, schema, num_rows, seed=0):
+    """ Generates reproducible rows for a table.  Key columns (see es_connect.KEY_COLUMNS) count up from 1 and
+        DATETIME columns increase with the row number, like the admin log tables, so keyset reads and
+        watermarks behave as they do on the real tables.
+        Args:
+            table (string): name of the table
+            schema (list of lists): [column name, column type] for each column, as returned by
+                mySQL_connect.import_schemas_from_file
+            num_rows (integer): number of rows to generate
+            seed (integer): seed for the random number generator, so that every run gets the same rows
+        Returns:
+            list of tuples
+    """
+    rng = random.Random(seed)
+    words = ['connect', 'disconnect', 'timeout', 'glass', 'scribe', 'doctor', 'audio', 'video', 'stream', 'error',
+             'retry', 'wifi', 'latency', 'battery', 'session', 'card', 'note', 'sync', 'ok', 'failed']
+    text = ' '.join(rng.choice(words) for i in range(20000))
+    key_cols = KEY_COLUMNS.get(table, [])
+    factories = []
+    for name, col_type in schema:
+        if name in key_cols:
+            factories.append((False, lambda i: i + 1))
+        else:
+            factories.append((True, synthetic_value_factory(col_type, rng, text)))
+    rows = []
+    for i in range(num_rows):
+        rows.append(tuple(None if nullable and rng.random() < NULL_RATE else factory(i)
+                          for nullable, factory in factories))
+    return rows
+
+
+class SQLiteCursor(object):
+    """ Cursor over an in-memory SQLite database with the parts of the MySQLdb cursor interface that the migration
+        functions use: '%s' parameters, DESCRIBE, rowcount, description, fetchone/fetchmany/fetchall and scroll.
+        DESCRIBE returns the MySQL column types, in lower case as MySQL reports them.
+    """
+    def __init__(self, con, schemas):
+        self.con = con
+        self.schemas = schemas
+        self.rows = []
+        self.position = 0
+        self.rowcount = -1
+        self.description = None
+
+    def execute(self, query, params=None):
+        words = query.split()
+        if words[0].upper() == 'DESCRIBE':
+            rows = [(name, col_type.lower(), 'YES', '', None, '') for name, col_type in self.schemas[words[1]]]
+            self.description = [('Field',), ('Type',), ('Null',), ('Key',), ('Default',), ('Extra',)]
+        else:
+            sqlite_cur = self.con.execute(query.replace('%s', '?'), tuple(params or ()))
+            rows = sqlite_cur.fetchall()
+            self.description = sqlite_cur.description
+        self.rows = rows
+        self.position = 0
+        self.rowcount = len(rows)
+        return self.rowcount
+
+    def fetchone(self):
+        if self.position >= self.rowcount:
+            return None
+        self.position += 1
+        return self.rows[self.position - 1]
+
+    def fetchmany(self, size=1):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return tuple(rows)
+
+    def fetchall(self):
+        return self.fetchmany(self.rowcount - self.position)
+
+    def scroll(self, value, mode='relative'):
+        self.position = value if mode == 'absolute' else self.position + value
+
+    def close(self):
+        pass
+
+
+def load_synthetic_table(table, schema, num_rows, seed=0):
+    """ Loads synthetic rows into an in-memory SQLite database that stands in for MySQL.
+        Args:
+            table (string): name of the table
+            schema (list of lists): [column name, column type] for each column
+            num_rows (integer): number of rows to generate
+            seed (integer): seed for the random number generator
+        Returns:
+            tuple: SQLite connection and a cursor that can be passed to migrate_table in place of a MySQL cursor
+    """
+    con = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+    con.execute('CREATE TABLE {} ({})'.format(table, ', '.join(' '.join(col) for col in schema)))
+    for col in KEY_COLUMNS.get(table, []):
+        con.execute('CREATE INDEX {0}_{1} ON {0} ({1})'.format(table, col))
+    con.executemany('INSERT INTO {} VALUES ({})'.format(table, ','.join(['?'] * len(schema))),
+                    synthetic_rows(table, schema, num_rows, seed))
+    con.commit()
+    return con, SQLiteCursor(con, {table: schema})
+
+
+def run_sweep(tables, num_rows, batch_sizes, workers_list, engines, latency=0.0, latency_per_mb=0.0,
+              rejection_rate=0.0, seed=0, mappings=('legacy',), es_host=None):
+    """ Migrates synthetic tables into a local stand-in node, or into a real node, with every combination of batch
+        size, number of workers, submission engine and mapping profile.
+        Args:
+            tables (list of strings): tables from tblSchemas to generate
+            num_rows (integer): number of rows in each table
+            batch_sizes (list of integers): batch sizes to try
+            workers_list (list of integers): numbers of workers to try
+            engines (list of strings): submission engines to try (keys of es_connect.API_FUNCS)
+            latency (float): seconds the stand-in node waits before answering each Bulk API call
+            latency_per_mb (float): additional seconds it waits for each megabyte of bulk payload
+            rejection_rate (float): fraction of documents it rejects with a 429
+            seed (integer): seed for the synthetic rows
+            mappings (list of strings): mapping profiles to try (see es_mappings.MAPPING_PROFILES)
+            es_host (string): '<host>:<port>' of a real Elasticsearch node to migrate into instead of the stand-in
+                node.  The stand-in node does not analyze or store documents, so the effect of the mapping on
+                indexing cost and on the size of the index can only be measured on a real node.
+        Returns:
+            list of dictionaries, one for each run, with its settings, stage times, documents per second and the
+            number of documents, rejections, Bulk API calls and bytes of bulk payload seen by the stand-in node,
+            or the number of documents and the size on disk of the index on a real node
+    """
+    schemas = import_schemas_from_file()
+    # Every run reads the same synthetic schemas, so DESCRIBE is cached in memory under its own namespace
+    configure_cache('benchmark')
+    server = None
+    if es_host:
+        CONNECTION_IP[BENCHMARK_CONNECTION] = [es_host]
+    else:
+        server = start_standin(latency=latency, latency_per_mb=latency_per_mb, rejection_rate=rejection_rate)
+        CONNECTION_IP[BENCHMARK_CONNECTION] = ['127.0.0.1:{}'.format(server.server_port)]
+    workdir = tempfile.mkdtemp(prefix='es_benchmark_')
+    results = []
+    try:
+        for table in tables:
+            con, cur = load_synthetic_table(table, schemas[table], num_rows, seed)
+            for batch_size, workers, engine, mapping in product(batch_sizes, workers_list, engines, mappings):
+                print('{}: {} rows, batch size {}, {} workers, {} engine, {} mapping'.format(
+                    table, num_rows, batch_size, workers, engine, mapping))
+                if server:
+                    counts = (server.docs, server.rejections, server.requests, server.bytes_received)
+                times = migrate_table(BENCHMARK_CONNECTION, cur, table, workers, batch_size, num_rows, generate_json,
+                                      API_FUNCS[engine], checkpoint_path=os.path.join(workdir, 'checkpoints.json'),
+                                      mapping=mapping)
+                run = {'table': table, 'rows': num_rows, 'batch_size': batch_size, 'workers': workers,
+                       'engine': engine, 'mapping': mapping, 'latency': latency, 'latency_per_mb': latency_per_mb,
+                       'rejection_rate': rejection_rate, 'setup_time': round(times[0], 4),
+                       'sql_time': round(times[1], 4), 'actions_time': round(times[2], 4),
+                       'es_time': round(times[3], 4), 'total_time': round(times[4], 4),
+                       'docs_per_sec': round(num_rows / times[4], 1) if times[4] else 0}
+                if server:
+                    run.update({'docs_indexed': server.docs - counts[0], 'rejections': server.rejections - counts[1],
+                                'bulk_calls': server.requests - counts[2],
+                                'bulk_bytes': server.bytes_received - counts[3], 'store_bytes': None})
+                else:
+                    es = get_es_client(BENCHMARK_CONNECTION)
+                    run.update({'docs_indexed': es.count(index=table + '_index')['count'], 'rejections': None,
+                                'bulk_calls': None, 'bulk_bytes': None,
+                                'store_bytes': index_store_bytes(BENCHMARK_CONNECTION, table)})
+                results.append(run)
+            con.close()
+    finally:
+        close_es_connections()
+        if server:
+            server.shutdown()
+        del CONNECTION_IP[BENCHMARK_CONNECTION]
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def index_store_bytes(connection, table):
+    """ Returns the size on disk of the primary shards of a table's live index (the one behind the <table>_index
+        alias), as reported by the index stats API.  The index is force-merged by es_connect.finalize_index before
+        it goes live, so the size does not depend on how many segments were left when the load finished.
+        Args:
+            connection (string): name of the Elasticsearch connection to be used
+            table (string): name of the table
+        Returns:
+            integer
+    """
+    stats = get_es_client(connection).indices.stats(index=table + '_index', metric='store')
+    return stats['_all']['primaries']['store']['size_in_bytes']
+
+
+def write_results(results, path):
+    """ Writes sweep results to a file, as csv if the path ends in .csv and as json otherwise.
+        Args:
+            results (list of dictionaries): results returned by run_sweep
+            path (string): path of the file to write
+    """
+    with open(path, 'w') as results_file:
+        if path.endswith('.csv'):
+            writer = csv.DictWriter(results_file, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+        else:
+            json.dump(results, results_file, indent=2)
+
+
+def load_results(path):
+    """ Loads sweep results written by write_results.
+        Args:
+            path (string): path of a .csv or json results file
+        Returns:
+            list of dictionaries
+    """
+    with open(path) as results_file:
+        if not path.endswith('.csv'):
+            return json.load(results_file)
+        results = []
+        for row in csv.DictReader(results_file):
+            for key, value in row.items():
+                try:
+                    row[key] = int(value)
+                except ValueError:
+                    try:
+                        row[key] = float(value)
+                    except ValueError:
+                        pass
+            results.append(row)
+        return results
+
+
+def _run_key(run):
+    """ Returns the settings that identify a run, as a tuple of the values of RUN_KEYS """
+    return tuple(run.get(key, RUN_DEFAULTS.get(key)) for key in RUN_KEYS)
+
+
+def compare_to_baseline(results, baseline, tolerance=TOLERANCE):
+    """ Compares sweep results with a baseline run.  Runs are matched on their table, number of rows, batch size,
+        number of workers, engine and stand-in settings; runs without a match in the baseline are skipped.
+        Args:
+            results (list of dictionaries): results of the current run
+            baseline (list of dictionaries): results of the baseline run
+            tolerance (float): fractional drop in documents per second that counts as a regression
+        Returns:
+            list of dictionaries with the run settings, the baseline and current documents per second, the change
+            as a fraction of the baseline, and whether the change is a regression
+    """
+    baseline_speeds = {_run_key(run): run['docs_per_sec'] for run in baseline}
+    comparison = []
+    for run in results:
+        run_key = _run_key(run)
+        if run_key not in baseline_speeds or not baseline_speeds[run_key]:
+            continue
+        change = (run['docs_per_sec'] - baseline_speeds[run_key]) / float(baseline_speeds[run_key])
+        entry = dict(zip(RUN_KEYS, run_key))
+        entry.update({'baseline': baseline_speeds[run_key], 'current': run['docs_per_sec'],
+                      'change': round(change, 4), 'regression': change < -tolerance})
+        comparison.append(entry)
+    return comparison
+
+
+def format_comparison(comparison):
+    """ Formats a baseline comparison for printing, one line per run.
+        Args:
+            comparison (list of dictionaries): comparison returned by compare_to_baseline
+        Returns:
+            string
+    """
+    lines = []
+    for entry in comparison:
+        lines.append('{table} batch={batch_size} workers={workers} engine={engine} mapping={mapping}: '
+                     '{baseline:.0f} -> {current:.0f} docs/s ({change:+.1%}){flag}'.format(
+                         flag='  REGRESSION' if entry['regression'] else '', **entry))
+    return '\n'.join(lines)
+
+
+def compare_mappings(results):
+    """ Compares the runs of each mapping profile with the same runs using the legacy mapping.
+        Args:
+            results (list of dictionaries): results returned by run_sweep
+        Returns:
+            list of dictionaries with the run settings and, for documents per second, bytes of bulk payload and
+            bytes on disk, the legacy and current values and the change as a fraction of the legacy value (None
+            where a value was not measured)
+    """
+    legacy_runs = {_run_key(dict(run, mapping=None)): run for run in results if run.get('mapping') == 'legacy'}
+    comparison = []
+    for run in results:
+        legacy = legacy_runs.get(_run_key(dict(run, mapping=None)))
+        if run.get('mapping', 'legacy') == 'legacy' or legacy is None:
+            continue
+        entry = dict(zip(RUN_KEYS, _run_key(run)))
+        for measure, label in MAPPING_MEASURES:
+            before, after = legacy.get(measure), run.get(measure)
+            entry[measure] = (before, after, round((after - before) / float(before), 4) if before and
+                              after is not None else None)
+        comparison.append(entry)
+    return comparison
+
+
+def format_mapping_comparison(comparison):
+    """ Formats a mapping comparison for printing, one line per run.
+        Args:
+            comparison (list of dictionaries): comparison returned by compare_mappings
+        Returns:
+            string
+    """
+    lines = []
+    for entry in comparison:
+        changes = []
+        for measure, label in MAPPING_MEASURES:
+            before, after, change = entry[measure]
+            if change is not None:
+                changes.append('{}: {:.0f} -> {:.0f} ({:+.1%})'.format(label, before, after, change))
+        lines.append('{table} batch={batch_size} workers={workers} engine={engine} mapping=legacy->{mapping}: '
+                     '{changes}'.format(changes=', '.join(changes), **entry))
+    return '\n'.join(lines)
+
+
+def main():
+    """
+    Uses argparse to implement a command line interface for the functions in this module.  Exits with status 1 if
+    any run is slower than the baseline by more than the tolerance.
+    """
+    parser = ArgumentParser(description='Headless benchmarks for the MySQL to Elasticsearch migration')
+    parser.add_argument('-t', '--tables', nargs='+', default=BENCHMARK_TABLES, help='tables from tblSchemas to '
+                                                                                   'generate synthetic data for')
+    parser.add_argument('-n', '--rows', type=int, default=20000, help='number of rows in each synthetic table')
+    parser.add_argument('-b', '--batch_sizes', type=int, nargs='+', default=[1000, 5000], help='batch sizes to try')
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 4], help='numbers of workers to try')
+    parser.add_argument('-e', '--engines', nargs='+', default=list(API_FUNCS), choices=list(API_FUNCS),
+                        help='bulk submission engines to try')
+    parser.add_argument('-m', '--mappings', nargs='+', default=['legacy'], choices=MAPPING_PROFILES,
+                        help='mapping profiles to try; runs with each profile are compared with the legacy mapping')
+    parser.add_argument('--es_host', default=None, help='<host>:<port> of a real Elasticsearch node to migrate '
+                                                        'into instead of the stand-in, to measure the index size')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the stand-in node waits before '
+                                                                   'answering each bulk call')
+    parser.add_argument('--latency_per_mb', type=float, default=0.0, help='additional seconds it waits for each '
+                                                                          'megabyte of bulk payload')
+    parser.add_argument('--rejection_rate', type=float, default=0.0, help='fraction of documents the stand-in '
+                                                                          'node rejects with a 429')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic rows')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='file to write the results to '
+                                                                                 '(.json or .csv)')
+    parser.add_argument('--baseline', default=None, help='results file from an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='fractional drop in documents per '
+                                                                           'second that counts as a regression')
+    args = parser.parse_args()
+
+    results = run_sweep(args.tables, args.rows, args.batch_sizes, args.workers, args.engines, args.latency,
+                        args.latency_per_mb, args.rejection_rate, args.seed, args.mappings, args.es_host)
+    write_results(results, args.output)
+    print('Wrote {} results to {}'.format(len(results), args.output))
+    if len(args.mappings) > 1:
+        print(format_mapping_comparison(compare_mappings(results)))
+    if args.baseline:
+        comparison = compare_to_baseline(results, load_results(args.baseline), args.tolerance)
+        print(format_comparison(comparison))
+        if any(entry['regression'] for entry in comparison):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
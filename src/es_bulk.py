@@ -0,0 +1,277 @@
+"""
+This module includes functions for handling responses from the Elasticsearch Bulk API.  Each bulk response is
+checked item by item, documents rejected because Elasticsearch's write queue is full are re-sent with jittered
+exponential backoff, and documents that can never be indexed are written to a dead-letter file.
+
+Functions:
+    split_bulk_payload: splits a '\\n'-delimited Bulk API payload into (action, source) line pairs
+    join_bulk_pairs: joins (action, source) line pairs back into a Bulk API payload
+    new_bulk_stats: creates an empty dictionary of bulk submission counts
+    merge_bulk_stats: adds a list of bulk submission counts together
+    item_succeeded: returns whether a Bulk API item result counts as indexed
+    process_bulk_response: sorts the items of a Bulk API response into indexed, retryable and failed documents
+    backoff_delay: returns a jittered exponential backoff delay for a retry attempt
+    write_dead_letters: appends documents that could not be indexed to the dead-letter file
+    failed_bulk_outcome: returns the outcome of a Bulk API call whose documents all failed permanently
+    sort_bulk_outcome: sorts the documents of a Bulk API call into indexed, retryable and failed documents
+    record_bulk_outcome: adds the outcome of a Bulk API call to the submission counts
+    submit_bulk_with_retry: submits a payload to the Bulk API, re-sending only the documents that were rejected
+    format_bulk_stats: formats bulk submission counts for printing
+"""
+
+
+import json
+import random
+import threading
+import time
+import requests
+
+# Statuses returned when Elasticsearch is too busy to index a document (e.g. es_rejected_execution_exception
+# when the write thread pool queue is full).  Only these are retried; all other errors are permanent.
+RETRY_STATUSES = (429, 503)
+MAX_RETRIES = 8
+INITIAL_BACKOFF = 0.5
+MAX_BACKOFF = 30
+DEAD_LETTER_PATH = './dead_letters.ndjson'
+
+_DEAD_LETTER_LOCK = threading.Lock()
+
+
+def split_bulk_payload(payload):
+    """ Splits a Bulk API payload into (action, source) line pairs.
+        Args:
+            payload (bytes): '\\n'-delimited json actions, each followed by its document source
+        Returns:
+            list of tuples of bytes
+    """
+    lines = payload.split(b'\n')
+    if lines and not lines[-1]:
+        lines.pop()
+    return list(zip(lines[0::2], lines[1::2]))
+
+
+def join_bulk_pairs(pairs):
+    """ Joins (action, source) line pairs into a Bulk API payload.
+        Args:
+            pairs (list of tuples of bytes): action and source lines
+        Returns:
+            bytes
+    """
+    return b''.join(action + b'\n' + source + b'\n' for action, source in pairs)
+
+
+def new_bulk_stats(docs=0, num_bytes=0):
+    """ Creates a dictionary for counting the outcome of bulk submissions.
+        Args:
+            docs (integer): number of documents submitted
+            num_bytes (integer): size of the submitted payload
+        Returns:
+            dictionary with the number of documents submitted, indexed, retried and failed, the number of
+            rejections received from Elasticsearch, the size of the submitted payload, the number of bytes sent
+            (which also counts payloads re-sent by retries) and the latency of each Bulk API call
+    """
+    return {'docs': docs, 'indexed': 0, 'retried': 0, 'failed': 0, 'rejections': 0, 'bytes': num_bytes,
+            'sent_bytes': num_bytes, 'latencies': []}
+
+
+def merge_bulk_stats(stats_list):
+    """ Adds together a list of bulk submission counts.
+        Args:
+            stats_list (list of dictionaries): counts created by new_bulk_stats
+        Returns:
+            dictionary with the combined counts
+    """
+    total = new_bulk_stats()
+    for stats in stats_list:
+        for key, value in stats.items():
+            total[key] += value
+    return total
+
+
+def item_succeeded(op_type, status):
+    """ Returns whether a Bulk API item result counts as indexed.  A 'create' that fails with 409 (version
+        conflict) means the document with that _id is already in the index, e.g. because the batch is being
+        replayed, so there is nothing left to do for it.
+        Args:
+            op_type (string): operation of the item ('index', 'create', 'update' or 'delete')
+            status (integer): HTTP status of the item
+        Returns:
+            boolean
+    """
+    return status < 300 or (status == 409 and op_type == 'create')
+
+
+def process_bulk_response(response_json, pairs):
+    """ Sorts the items of a Bulk API response by outcome.  Items are returned by Elasticsearch in the same order
+        as the actions in the request.
+        Args:
+            response_json (dictionary): parsed body of the Bulk API response
+            pairs (list of tuples of bytes): action and source lines that were submitted
+        Returns:
+            tuple: number of documents indexed, list of pairs to retry, and list of (pair, item result) tuples
+                for documents that failed permanently
+    """
+    if not response_json.get('errors'):
+        return len(pairs), [], []
+    indexed = 0
+    retry = []
+    failed = []
+    for pair, item in zip(pairs, response_json['items']):
+        op_type, result = next(iter(item.items()))
+        status = result.get('status', 500)
+        if item_succeeded(op_type, status):
+            indexed += 1
+        elif status in RETRY_STATUSES:
+            retry.append(pair)
+        else:
+            failed.append((pair, result))
+    return indexed, retry, failed
+
+
+def backoff_delay(attempt):
+    """ Returns how long to wait before a retry, using exponential backoff with full jitter so that workers that
+        were rejected at the same time do not all retry at the same time.
+        Args:
+            attempt (integer): number of retries already made (0 for the first retry)
+        Returns:
+            float: delay in seconds
+    """
+    return random.uniform(0, min(MAX_BACKOFF, INITIAL_BACKOFF * (2 ** attempt)))
+
+
+def write_dead_letters(failed, path=None):
+    """ Appends documents that could not be indexed to the dead-letter file, one json object per line with
+        the action, the document source and the error returned by Elasticsearch.
+        Args:
+            failed (list of tuples): (pair, item result) tuples returned by process_bulk_response
+            path (string): path of the dead-letter file (defaults to DEAD_LETTER_PATH)
+    """
+    if not failed:
+        return
+    lines = []
+    for (action, source), result in failed:
+        lines.append(json.dumps({'action': json.loads(action.decode('utf-8')),
+                                 'source': json.loads(source.decode('utf-8')),
+                                 'status': result.get('status'),
+                                 'error': result.get('error')}))
+    with _DEAD_LETTER_LOCK:
+        with open(path or DEAD_LETTER_PATH, 'a') as dead_letter_file:
+            dead_letter_file.write('\n'.join(lines) + '\n')
+
+
+def failed_bulk_outcome(payload, pairs, status, error):
+    """ Returns the outcome of a Bulk API call whose documents all failed permanently, e.g. because the call
+        returned an error or a response that could not be read, in the form returned by sort_bulk_outcome.
+        Args:
+            payload (bytes or bytearray): payload that was submitted
+            pairs (list of tuples of bytes): payload already split into (action, source) pairs, or None
+            status (integer): HTTP status to record for each document (None if there was no usable response)
+            error (string): error to record for each document
+        Returns:
+            tuple (see sort_bulk_outcome)
+    """
+    return 0, [], [(pair, {'status': status, 'error': error}) for pair in pairs or split_bulk_payload(payload)], False
+
+
+def sort_bulk_outcome(status, body, payload, pairs, num_docs):
+    """ Sorts the documents of a Bulk API call by outcome, using the HTTP status and body of the response.
+        Args:
+            status (integer): HTTP status of the response
+            body (bytes): body of the response
+            payload (bytes or bytearray): payload that was submitted
+            pairs (list of tuples of bytes): payload already split into (action, source) pairs, or None if it
+                has not been split yet
+            num_docs (integer): number of documents in the payload
+        Returns:
+            tuple: number of documents indexed, list of pairs to retry, list of (pair, item result) tuples for
+                documents that failed permanently, and whether Elasticsearch rejected anything
+    """
+    if status in RETRY_STATUSES:
+        # The whole request was rejected, so every document is retried
+        return 0, pairs or split_bulk_payload(payload), [], True
+    if status >= 300:
+        return failed_bulk_outcome(payload, pairs, status, body.decode('utf-8', 'replace'))
+    try:
+        response_json = json.loads(body.decode('utf-8'))
+        if not response_json.get('errors'):
+            return num_docs, [], [], False
+        indexed, retry, failed = process_bulk_response(response_json, pairs or split_bulk_payload(payload))
+    except (ValueError, KeyError, AttributeError, TypeError) as exc:
+        # Which documents were indexed cannot be known from an unreadable response, so none are counted as indexed
+        return failed_bulk_outcome(payload, pairs, status, 'unreadable bulk response: {}'.format(exc))
+    return indexed, retry, failed, bool(retry)
+
+
+def record_bulk_outcome(stats, outcome, attempt, max_retries=MAX_RETRIES, dead_letter_path=None):
+    """ Adds the outcome of a Bulk API call to the submission counts and writes permanently failed documents to
+        the dead-letter file.  Rejected documents are given up on once max_retries retries have been made.
+        Args:
+            stats (dictionary): counts created by new_bulk_stats
+            outcome (tuple): outcome returned by sort_bulk_outcome
+            attempt (integer): number of retries already made
+            max_retries (integer): maximum number of times to re-send rejected documents
+            dead_letter_path (string): path of the dead-letter file (defaults to DEAD_LETTER_PATH)
+        Returns:
+            list of (action, source) pairs to retry
+    """
+    indexed, retry, failed, rejected = outcome
+    stats['indexed'] += indexed
+    stats['rejections'] += 1 if rejected else 0
+    if retry and attempt >= max_retries:
+        failed = failed + [(pair, {'status': 429, 'error': 'rejected after {} retries'.format(attempt)})
+                           for pair in retry]
+        retry = []
+    stats['failed'] += len(failed)
+    write_dead_letters(failed, dead_letter_path)
+    stats['retried'] += len(retry)
+    return retry
+
+
+def submit_bulk_with_retry(session, url, payload, max_retries=MAX_RETRIES, dead_letter_path=None):
+    """ Submits a payload to the Elasticsearch Bulk API.  If the whole request is rejected, or if individual
+        documents are rejected because Elasticsearch is too busy, only the rejected documents are re-sent after a
+        backoff delay.  Documents that fail for any other reason, or that are still rejected after max_retries
+        retries, are written to the dead-letter file.
+        Args:
+            session (requests Session object): HTTP session to send the request with
+            url (string): url of the Bulk API endpoint
+            payload (bytes or bytearray): '\\n'-delimited json actions and document sources.  It is sent as it
+                is and only split into documents if some of them have to be retried or dead-lettered.
+            max_retries (integer): maximum number of times to re-send rejected documents
+            dead_letter_path (string): path of the dead-letter file (defaults to DEAD_LETTER_PATH)
+        Returns:
+            dictionary of counts (see new_bulk_stats)
+    """
+    num_docs = payload.count(b'\n') // 2
+    stats = new_bulk_stats(num_docs, len(payload))
+    pairs = None
+    attempt = 0
+    while num_docs:
+        t0 = time.time()
+        try:
+            response = session.post(url, data=payload, headers={"Content-type": "application/x-ndjson"})
+            status, body = response.status_code, response.content
+        except requests.RequestException as exc:
+            print('bulk request failed: {}'.format(exc))
+            status, body = 503, b''
+        stats['latencies'].append(time.time() - t0)
+        outcome = sort_bulk_outcome(status, body, payload, pairs, num_docs)
+        pairs = record_bulk_outcome(stats, outcome, attempt, max_retries, dead_letter_path)
+        num_docs = len(pairs)
+        if pairs:
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+            payload = join_bulk_pairs(pairs)
+            stats['sent_bytes'] += len(payload)
+    return stats
+
+
+def format_bulk_stats(stats):
+    """ Formats bulk submission counts for printing.
+        Args:
+            stats (dictionary): counts created by new_bulk_stats or merge_bulk_stats
+        Returns:
+            string
+    """
+    return ('Documents indexed: {indexed}, retried: {retried}, dead-lettered: {failed}, '
+            'rejections: {rejections}'.format(**stats))
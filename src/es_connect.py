@@ -5,11 +5,29 @@ API call process and with parallel processes) and running benchmark tests on bat
 process workers.
 
 Functions:
+    get_es_client: returns the long-lived Elasticsearch client for a connection
+    get_http_session: returns the long-lived keep-alive HTTP session for an Elasticsearch node
+    get_worker_pool: returns the shared thread pool used for parallel Bulk API calls
+    get_process_pool: returns the shared process pool used to generate Bulk API payloads on several cores
+    close_es_connections: closes all Elasticsearch clients, HTTP sessions, the worker pool and the process pool
     submit_single_bulk_api: indexes records by submitting a single call to the Elasticsearch Bulk API
     submit_parallel_es_requests: indexes records by submitting parallel calls to the Elasticsearch Bulk API
+    submit_async_es_requests: indexes records by handing Bulk API calls to the asyncio submission engine
+    flush_async_es_requests: waits for all Bulk API calls handed to the asyncio submission engine to finish
+    offset_reader: reads a table from MySQL in batches using LIMIT/OFFSET queries
+    last_row_key: returns the key column values of the last row in a batch
+    keyset_reader: reads a table from MySQL in batches using indexed range queries on its key columns
     migrate_table: migrates a table from MySQL to Elasticsearch using either a single API call or parallel calls
-    create_index: creates a new index in Elasticsearch
+    pipeline_migrate_table: migrates a table with overlapping read, action generation and bulk submission stages
+    sync_table: indexes only the rows added to a table since its last sync
+    create_index: creates a new versioned index in Elasticsearch, set up for bulk loading
+    open_partitions: sets up the index template and aliases of a table's time-partitioned indices
+    maintain_partitions: rolls a table's partitions over and deletes those older than the retention period
+    discard_unfinished_index: deletes the index left by an unfinished migration
+    discard_failed_index: deletes the index that a failed migration was loading
+    finalize_index: restores search settings on a loaded index, force-merges it and swaps the table's alias to it
     generate_json: generates actions to be used in parallel Elasticsearch Bulk API calls
+    generate_ndjson: generates ready-to-send Bulk API payloads, cut by size, for parallel Elasticsearch Bulk API calls
     generate_bulk_actions_list: generates actions to be used in a single Elasticsearch Bulk API call
     generate_mapping: generates mapping for a table to be indexed in Elasticsearch
     benchmark_import_size: runs benchmark tests to determine the optimal batch size for the Elasticsearch bulk API
@@ -19,16 +37,35 @@ Functions:
 
 
 from elasticsearch import Elasticsearch, helpers
-from mySQL_connect import load_connection_info, rds_mysql_connection, close_connection, get_colnames, interval_query, \
-    read_schema_from_db
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from checkpoints import get_checkpoint, save_checkpoint, clear_checkpoint
+from es_bulk import RETRY_STATUSES, MAX_RETRIES, new_bulk_stats, merge_bulk_stats, backoff_delay, \
+    write_dead_letters, item_succeeded, submit_bulk_with_retry, format_bulk_stats
+import es_async
+from es_documents import OP_TYPES, compile_row_converter, convert_rows, bulk_action, bulk_source, \
+    compile_action_header, serialize_rows, init_worker_serializer, serialize_worker_rows
+from es_metrics import new_metrics, observe, record_bulk_stats, set_gauge, format_log_line, start_metrics_server, \
+    start_metrics_logger
+from dimension_cache import load_dimensions, dimensions_for, compile_enrichment, start_dimension_refresher, \
+    dimensions_generation
+from es_mappings import MAPPING_PROFILES, SAMPLE_ROWS, build_profile, profile_mapping
+from es_partitions import TIME_COLUMNS, PARTITIONINGS, RETENTION_DAYS, ROLLOVER_CONDITIONS, partition_names, \
+    put_partition_template, is_partitioned, detach_unpartitioned_indices, bootstrap_rollover, rollover_partition, \
+    apply_retention
+from es_tuning import new_tuning_state, batch_rows, record_doc_bytes, update_tuning_state, format_tuning_state
+from metadata_cache import METADATA_CACHE_PATH, configure_cache
+from mySQL_connect import load_connection_info, rds_mysql_connection, close_connection, interval_query, \
+    keyset_query, partition_ranges, read_schema_from_db, list_tables, metadata_namespace
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from queue import Queue, Empty, Full
+import threading
 import time
 import requests
+from requests.adapters import HTTPAdapter
 import matplotlib.pyplot as plt
-import pdb
 import json
 from argparse import ArgumentParser
 from itertools import cycle
+from functools import partial
 
 CONNECTION_IP = {'standalone': ['ec2-54-236-6-174.compute-1.amazonaws.com'],
                  'cluster': ['ec2-174-129-84-154.compute-1.amazonaws.com',
@@ -40,6 +77,138 @@ CONNECTION_IP = {'standalone': ['ec2-54-236-6-174.compute-1.amazonaws.com'],
                  'cluster3': ['ec2-54-164-6-26.compute-1.amazonaws.com'],
                  'cluster4': ['ec2-54-234-235-235.compute-1.amazonaws.com']}
 PORT = 9200
+# Size at which generate_ndjson starts a new Bulk API payload
+PAYLOAD_BYTES = 10 * 1024 * 1024
+# Seconds between the checkpoints of a migration that uses the asyncio submission engine.  Each checkpoint waits for
+# every Bulk API call in flight to finish, so saving one after every batch would stop the engine from keeping calls
+# in flight across batch boundaries.
+CHECKPOINT_INTERVAL = 30
+# Index settings used while a new index is being loaded (no refreshes, no replicas to copy each document to), and
+# the settings it is given once the load has finished and before it starts serving searches
+BULK_LOAD_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+SEARCH_SETTINGS = {'refresh_interval': '1s', 'number_of_replicas': 1}
+# Number of segments each shard is merged down to before a loaded index starts serving searches
+MERGE_SEGMENTS = 1
+# Seconds to wait for a force-merge, which can take much longer than the client's default request timeout
+MERGE_TIMEOUT = 3600
+
+# Long-lived clients, keep-alive sessions and worker pool, created on first use and reused for every batch and
+# every benchmark loop until close_es_connections is called
+_ES_CLIENTS = {}
+_HTTP_SESSIONS = {}
+_WORKER_POOL = {'pool': None, 'size': 0}
+_PROCESS_POOL = {'pool': None, 'size': 0, 'converter': None, 'header': None, 'generation': None}
+_CLIENT_LOCK = threading.Lock()
+
+# Columns used to page through each table with keyset_reader.  Each list must uniquely order the table's rows
+# and should match an index in MySQL (e.g. ['logTime', 'logId'] for ee_log if there is an index on both).
+KEY_COLUMNS = {'doctor': ['doctorId'],
+               'site': ['id'],
+               'scribe': ['scribeId'],
+               'ee_audit_events': ['event_id'],
+               'ee_log': ['logId'],
+               'scribeuxmetricsconnectivity': ['logId']}
+
+
+def node_address(ip):
+    """ Returns the host:port address of an Elasticsearch node, using PORT if the node does not name a port """
+    return ip if ':' in ip else '{}:{}'.format(ip, PORT)
+
+
+def get_es_client(connection):
+    """ Returns the Elasticsearch client for a connection, creating it the first time it is needed.
+        Args:
+            connection (string): name of the Elasticsearch connection to be used
+        Returns:
+            Elasticsearch client object
+    """
+    with _CLIENT_LOCK:
+        if connection not in _ES_CLIENTS:
+            _ES_CLIENTS[connection] = Elasticsearch([node_address(ip) for ip in CONNECTION_IP[connection]])
+        return _ES_CLIENTS[connection]
+
+
+def get_http_session(ip, pool_size):
+    """ Returns the keep-alive HTTP session for an Elasticsearch node, creating it the first time it is needed.
+        Args:
+            ip (string): address of the Elasticsearch node
+            pool_size (integer): number of connections that the session should be able to keep open at once
+        Returns:
+            requests Session object
+    """
+    with _CLIENT_LOCK:
+        session, size = _HTTP_SESSIONS.get(ip, (None, 0))
+        if session is None:
+            session = requests.Session()
+        if size < pool_size:
+            # Mounting a larger adapter keeps the session but lets it hold more open connections
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+            size = pool_size
+        _HTTP_SESSIONS[ip] = (session, size)
+        return session
+
+
+def get_worker_pool(workers):
+    """ Returns the thread pool shared by all parallel Bulk API calls, replacing it with a larger one if more
+        workers are needed than it has.
+        Args:
+            workers (integer): number of parallel workers needed
+        Returns:
+            ThreadPoolExecutor object
+    """
+    with _CLIENT_LOCK:
+        if _WORKER_POOL['size'] < workers:
+            if _WORKER_POOL['pool'] is not None:
+                # Requests already running in the old pool still finish
+                _WORKER_POOL['pool'].shutdown(wait=False)
+            _WORKER_POOL['pool'] = ThreadPoolExecutor(max_workers=workers)
+            _WORKER_POOL['size'] = workers
+        return _WORKER_POOL['pool']
+
+
+def get_process_pool(processes, converter, header):
+    """ Returns the process pool used to generate Bulk API payloads on several cores.  Each worker process is
+        given the converter and action header once, when it starts (see es_documents.init_worker_serializer), so
+        that only rows are sent with each batch.  The pool is replaced if more processes are needed than it has,
+        if it was started for another converter or header, or if the cached dimensions that the converter enriches
+        documents with have changed since.
+        Args:
+            processes (integer): number of worker processes needed
+            converter (dictionary): row converter for the table, created by es_documents.compile_row_converter
+            header (tuple of bytes): serialized action line, created by es_documents.compile_action_header
+        Returns:
+            ProcessPoolExecutor object
+    """
+    generation = dimensions_generation() if converter['enrichment'] else None
+    with _CLIENT_LOCK:
+        if _PROCESS_POOL['size'] < processes or _PROCESS_POOL['converter'] is not converter or \
+                _PROCESS_POOL['header'] != header or _PROCESS_POOL['generation'] != generation:
+            if _PROCESS_POOL['pool'] is not None:
+                _PROCESS_POOL['pool'].shutdown(wait=False)
+            _PROCESS_POOL['pool'] = ProcessPoolExecutor(max_workers=max(processes, _PROCESS_POOL['size']),
+                                                        initializer=init_worker_serializer,
+                                                        initargs=(converter, header))
+            _PROCESS_POOL.update(size=max(processes, _PROCESS_POOL['size']), converter=converter, header=header,
+                                 generation=generation)
+        return _PROCESS_POOL['pool']
+
+
+def close_es_connections():
+    """ Closes all Elasticsearch clients and HTTP sessions and shuts down the worker and process pools and the
+        asyncio submission engine
+    """
+    es_async.stop_engine()
+    with _CLIENT_LOCK:
+        for pool in [_WORKER_POOL, _PROCESS_POOL]:
+            if pool['pool'] is not None:
+                pool['pool'].shutdown()
+            pool['pool'], pool['size'] = None, 0
+        for session, size in _HTTP_SESSIONS.values():
+            session.close()
+        _HTTP_SESSIONS.clear()
+        for es in _ES_CLIENTS.values():
+            es.transport.close()
+        _ES_CLIENTS.clear()
 
 
 def submit_single_bulk_api(connection, workers, actions_list):
@@ -48,63 +217,255 @@ def submit_single_bulk_api(connection, workers, actions_list):
             connection (string): name of the Elasticsearch connection to be used
             workers (integer): not used in this function.  Included so that migrate_table can call either
                 this function or submit_parallel_es_requests
-            actions_list (list of json objects): list of actions to send to the Elasticsearch Bulk API
+            actions_list (list of json objects or list of bytearrays): list of actions to send to the
+                Elasticsearch Bulk API, or list of payloads created by generate_ndjson, sent one after another
         Returns:
-            list containing the response returned from the Bulk API call
+            list containing the counts of documents indexed, retried and failed (see es_bulk.new_bulk_stats)
     """
-    es = Elasticsearch(CONNECTION_IP[connection], port=PORT)
-    response = helpers.bulk(es, actions_list)
-    return [response]
+    if isinstance(actions_list[0], (bytes, bytearray)):
+        ip = CONNECTION_IP[connection][0]
+        url = 'http://' + node_address(ip) + '/_bulk'
+        return [submit_bulk_with_retry(get_http_session(ip, 1), url, payload) for payload in actions_list]
+    es = get_es_client(connection)
+    stats = new_bulk_stats(len(actions_list))
+    attempt = 0
+    while actions_list:
+        t0 = time.time()
+        # Results come back in the same order as actions_list because the helper is not retrying on its own
+        results = helpers.streaming_bulk(es, actions_list, raise_on_error=False, raise_on_exception=False)
+        retry = []
+        failed = []
+        for action, (ok, item) in zip(actions_list, results):
+            op_type, result = next(iter(item.items()))
+            if ok or item_succeeded(op_type, result.get('status', 500)):
+                stats['indexed'] += 1
+            elif result.get('status') in RETRY_STATUSES or not isinstance(result.get('status'), int):
+                # Rejected because Elasticsearch is busy, or the request never reached it
+                retry.append(action)
+            else:
+                failed.append((action, result))
+        stats['latencies'].append(time.time() - t0)
+        if retry and attempt >= MAX_RETRIES:
+            failed += [(action, {'status': 429, 'error': 'rejected after {} retries'.format(attempt)})
+                       for action in retry]
+            retry = []
+        stats['failed'] += len(failed)
+        write_dead_letters([(helper_action_pair(action), result) for action, result in failed])
+        if retry:
+            stats['rejections'] += 1
+            stats['retried'] += len(retry)
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+        actions_list = retry
+    return [stats]
+
+
+def helper_action_pair(action):
+    """ Converts an action in the format used by the Bulk API helpers into Bulk API action and source lines """
+    meta = {'_index': action['_index'], '_type': action['_type']}
+    if '_id' in action:
+        meta['_id'] = action['_id']
+    header = {action.get('_op_type', 'index'): meta}
+    return json.dumps(header).encode('utf-8'), json.dumps(action['_source']).encode('utf-8')
+
+
+def build_payloads(actions_list, workers):
+    """ Converts a list of actions into one Bulk API payload per worker.  Lists of payloads created by
+        generate_ndjson are returned as they are.
+        Args:
+            actions_list (list of json objects or list of bytearrays): actions created by generate_json, or
+                payloads created by generate_ndjson
+            workers (integer): number of payloads to split the actions between
+        Returns:
+            list of bytes or bytearrays
+    """
+    if isinstance(actions_list[0], (bytes, bytearray)):
+        return actions_list
+    # Slices are cut on whole (action, source) pairs so that no document is split between two workers
+    payloads = []
+    num_docs = len(actions_list) // 2
+    docs_per_worker = -(-num_docs // workers)
+    for worker_start in range(0, num_docs, docs_per_worker):
+        # get a slice of actions for each worker
+        worker_actions_list = actions_list[2 * worker_start:2 * (worker_start + docs_per_worker)]
+        # convert the list of json objects to a single '\n'-delimited json object
+        payloads.append(("\n".join([json.dumps(x) for x in worker_actions_list]) + "\n").encode('utf-8'))
+    return payloads
 
 
 def submit_parallel_es_requests(connection, workers, actions_list):
-    """ Imports a table into Elasticsearch by submitting parallel calls to the Elasticsearch Bulk API.
+    """ Imports a table into Elasticsearch by submitting parallel calls to the Elasticsearch Bulk API.  Calls
+        are made from the shared worker pool over each node's keep-alive session.  Documents rejected by a busy
+        node are re-sent with backoff and documents that cannot be indexed are written to the dead-letter file
+        (see es_bulk.submit_bulk_with_retry).
         Args:
             connection (string): name of the Elasticsearch connection to be used
             workers (integer): number of parallel workers to make Bulk API calls with
-            actions_list (list of json objects): list of actions to send to the Elasticsearch Bulk API
+            actions_list (list of json objects or list of bytearrays): list of actions to send to the
+                Elasticsearch Bulk API, split evenly between the workers, or list of payloads created by
+                generate_ndjson, each sent in its own call
         Returns:
-            list of warnings returned if too many API call have been submitted (empty list otherwise)
-    """
-    flags = []
-    # Initialize variables used for concurrent futures
-    index = actions_list[0]['index']['_index']
-    ip_list = ['http://' + ip + ':9200/' + index + '/_bulk' for ip in
-               CONNECTION_IP[connection]]
-    tpool = ThreadPoolExecutor(max_workers=workers)
-    func = requests.post
+            list containing the counts of documents indexed, retried and failed by each call (see
+            es_bulk.new_bulk_stats)
+    """
+    # Initialize variables used for concurrent futures.  Every action names its index, so the requests go to
+    # the cluster-wide _bulk endpoint.
+    node_list = [(get_http_session(ip, workers), 'http://' + node_address(ip) + '/_bulk') for ip in
+                 CONNECTION_IP[connection]]
+    tpool = get_worker_pool(workers)
     futures = []
-    # Set up for workers loop
-    worker_start = 0
-    worker_end = int(round(len(actions_list) / workers))
     # Cycle through the different Elasticsearch nodes in the cluster
-    ip_cycle = cycle(ip_list)
-    for i in range(workers):
-        # get a slice of actions for each worker
-        worker_actions_list = actions_list[worker_start:worker_end]
-        # convert the list of json objects to a single '\n'-delimited json object
-        worker_actions = "\n".join([json.dumps(x) for x in worker_actions_list]) + "\n"
-        worker_start = worker_end
-        worker_end = min(worker_end + int(round(len(actions_list) / workers)), len(actions_list))
-        ip = next(ip_cycle)
-        # add a bulk API call to the thread pool, using the 'headers' keyword argument to specify the type of
-        # json document being used.
-        futures.append(tpool.submit(func, ip, data=worker_actions, headers={"Content-type": "application/x-ndjson"}))
-    for f in as_completed(futures):
-        try:
-            result = f.result()
-            # Check to see if too many API calls have been submitted
-            if result.status_code == 429:
-                flags.append(result)
-        except Exception as exc:
-            print('exception: {}'.format(exc))
-            pdb.set_trace()
-    return flags
+    node_cycle = cycle(node_list)
+    for payload in build_payloads(actions_list, workers):
+        session, url = next(node_cycle)
+        futures.append(tpool.submit(submit_bulk_with_retry, session, url, payload))
+    return [f.result() for f in as_completed(futures)]
+
+
+def submit_async_es_requests(connection, workers, actions_list):
+    """ Imports records into Elasticsearch by handing Bulk API calls to the asyncio submission engine (see
+        es_async).  Unlike submit_parallel_es_requests, this function does not wait for the calls to finish: it
+        returns as soon as they have been scheduled, so up to <workers> calls stay in flight across batch
+        boundaries and a slow node does not hold up the next batch.  flush_async_es_requests must be called once
+        all batches have been submitted.
+        Args:
+            connection (string): name of the Elasticsearch connection to be used
+            workers (integer): maximum number of Bulk API calls in flight across all nodes
+            actions_list (list of json objects or list of bytearrays): actions created by generate_json, or
+                payloads created by generate_ndjson
+        Returns:
+            list containing the counts of documents indexed, retried and failed by each call that finished since
+            the last call to this function (see es_bulk.new_bulk_stats)
+    """
+    es_async.start_engine([node_address(ip) for ip in CONNECTION_IP[connection]], workers)
+    for payload in build_payloads(actions_list, workers):
+        es_async.submit_payload(payload)
+    return es_async.collect_results()
+
+
+def flush_async_es_requests():
+    """ Waits for all Bulk API calls handed to the asyncio submission engine to finish.
+        Returns:
+            list containing the counts for each call that finished since submit_async_es_requests last returned
+            (empty if the engine is not running)
+    """
+    if es_async.is_running():
+        return es_async.flush_engine()
+    return []
 
 
-def migrate_table(connection, cur, table, workers, batch_size, limit, actions_func, api_func):
+API_FUNCS = {'threads': submit_parallel_es_requests, 'async': submit_async_es_requests}
+
+
+def offset_reader(cur, table, batch_size, key_cols=None):
+    """ Reads a table in batches using LIMIT/OFFSET queries.  Each query has to skip over every row that has
+        already been read, so batches get slower the further into the table they start.
+        Args:
+            cur (cursor object): MySQL cursor object that is connected to the MySQL database
+            table (string): name of the table to read
+            batch_size (integer): number of rows to read in each batch.  A new batch size can be sent to the
+                generator with send() after each batch
+            key_cols (list of strings): not used in this function.  Included so that migrate_table can call
+                either this function or keyset_reader
+        Yields:
+            tuple: number of rows in the batch, the cursor holding them and None (offset batches have no key to
+                resume from)
+    """
+    start = 0
+    while True:
+        num_results, cur = interval_query(cur, table, start, batch_size)
+        if num_results == 0:
+            return
+        new_size = yield num_results, cur, None
+        batch_size = new_size or batch_size
+        start += num_results
+
+
+def last_row_key(cur, num_results, key_cols):
+    """ Returns the key column values of the last row in a batch.  The cursor is rewound afterwards, so that
+        the actions functions still see the whole batch.
+        Args:
+            cur (cursor object): MySQL cursor object holding the batch
+            num_results (integer): number of rows in the batch
+            key_cols (list of strings): key columns
+        Returns:
+            list of values, one for each key column
+    """
+    col_names = [col[0] for col in cur.description]
+    cur.scroll(num_results - 1, mode='absolute')
+    last_row = cur.fetchone()
+    cur.scroll(0, mode='absolute')
+    return [last_row[col_names.index(col)] for col in key_cols]
+
+
+def keyset_reader(cur, table, batch_size, key_cols=None, bounds=None, start_key=None):
+    """ Reads a table in batches using range queries on its key columns, so that every batch is an indexed
+        range scan and takes the same time from the first row of the table to the last.
+        Args:
+            cur (cursor object): MySQL cursor object that is connected to the MySQL database
+            table (string): name of the table to read
+            batch_size (integer): number of rows to read in each batch.  A new batch size can be sent to the
+                generator with send() after each batch
+            key_cols (list of strings): columns to page through the table with.  Defaults to the columns
+                listed for the table in KEY_COLUMNS
+            bounds (tuple): optional (column, lower, upper) range to read, as returned by
+                mySQL_connect.partition_ranges (None to read the whole table)
+            start_key (list): values of key_cols to start reading after (None to start at the first row)
+        Yields:
+            tuple: number of rows in the batch, the cursor holding them and the key column values of the batch's
+                last row, which is where the next batch starts
+    """
+    key_cols = key_cols or KEY_COLUMNS[table]
+    last_key = start_key
+    while True:
+        num_results, cur = keyset_query(cur, table, key_cols, last_key, batch_size, bounds)
+        if num_results == 0:
+            return
+        # The last row of the batch is where the next batch starts
+        last_key = last_row_key(cur, num_results, key_cols)
+        new_size = yield num_results, cur, last_key
+        batch_size = new_size or batch_size
+
+
+READERS = {'keyset': keyset_reader, 'offset': offset_reader}
+
+
+def next_batch(batches, cur, batch_size=None):
+    """ Returns the next batch from a reader, optionally changing the number of rows it reads.
+        Args:
+            batches (generator): generator returned by a reader function
+            cur (cursor object): MySQL cursor object to return when the reader has run out of rows
+            batch_size (integer): new number of rows to read (None to keep the current batch size).  Must be
+                None for the first batch.
+        Returns:
+            tuple: number of rows in the batch (0 when the table has been read), the cursor holding them and the
+                key of the batch's last row (None for offset_reader and when the table has been read)
+    """
+    try:
+        return batches.send(batch_size)
+    except StopIteration:
+        return 0, cur, None
+
+
+def _table_converter(cur, table, id_cols, op_type, dimensions, profile, partitioning):
+    """ Compiles the row converter for a table, with its enrichment, mapping profile and partitioning """
+    return compile_row_converter(read_schema_from_db(cur, table), id_cols, op_type,
+                                 compile_enrichment(dimensions, table) if dimensions else None,
+                                 profile['exclude'] if profile else None,
+                                 TIME_COLUMNS[table] if partitioning == 'daily' else None)
+
+
+def migrate_table(connection, cur, table, workers, batch_size, limit, actions_func, api_func, reader=keyset_reader,
+                  key_cols=None, auto_tune=False, payload_bytes=None, id_cols=None, op_type='index', resume=False,
+                  checkpoint_path=None, metrics=None, dimensions=None, mapping='legacy', partitioning=None):
     """ Migrates a table into Elasticsearch using the Elasticsearch Bulk API.  It can use a single worker
         making API calls or multiple workers making API calls in parallel, based on the value of api_func.
+        When resume is set or a checkpoint_path is given (keyset_reader only), progress (the key of the last row
+        acknowledged by Elasticsearch, the index being loaded, document counts and stage times) is saved in the
+        checkpoint file after every batch, or at most every CHECKPOINT_INTERVAL seconds while
+        submit_async_es_requests has calls in flight, so that a migration that dies partway through can be resumed
+        where it stopped instead of starting over.  A migration that is not checkpointed deletes the index it was
+        loading if it fails.
         Args:
             connection (string): name of the Elasticsearch connection to be used
             cur (cursor object): MySQL cursor object that is connected to the MySQL database
@@ -117,9 +478,36 @@ def migrate_table(connection, cur, table, workers, batch_size, limit, actions_fu
             actions_func (function): function to use to generate actions for the Bulk API call.  Can be either
                 generate_json (for the parallel API calls approach) or generate_bulk_actions_list (for the
                 non-parallel approach)
-            api_func (function): function to use to make calls to the Elasticsearch Bulk API.  Can be either
-                submit_parallel_es_requests (for the parallel API calls approach) or submit_single_bulk_API
-                (for the non-parallel approach)
+            api_func (function): function to use to make calls to the Elasticsearch Bulk API.  Can be
+                submit_parallel_es_requests or submit_async_es_requests (for the parallel API calls approach) or
+                submit_single_bulk_API (for the non-parallel approach)
+            reader (function): function to use to read batches of records from MySQL.  Can be either
+                keyset_reader (default) or offset_reader
+            key_cols (list of strings): key columns for keyset_reader (defaults to KEY_COLUMNS[table])
+            auto_tune (boolean): if True, batch_size and workers are only starting points, and both are adjusted
+                after every batch using the measured bulk latency, throughput and rejections (see es_tuning)
+            payload_bytes (integer): if set, batches are sized in bytes instead of rows: after the first batch,
+                each worker is given enough rows to fill a payload of this size.  Used as the starting size when
+                auto_tune is True.
+            id_cols (list of strings): columns to derive each document's _id from, so that re-sent rows do not
+                create duplicate documents (None to let Elasticsearch assign ids)
+            op_type (string): Bulk API operation for each document: 'index', 'create' or 'update' (upsert)
+            resume (boolean): if True, continue the table's last unfinished migration from its checkpoint, loading
+                the same index and counting rows, documents and times from where it stopped.  Requires
+                keyset_reader.
+            checkpoint_path (string): path of the checkpoint file (defaults to checkpoints.CHECKPOINT_PATH when
+                resume is set).  Giving a path checkpoints the migration so that it can be resumed later.
+            metrics (dictionary): if set, the time of each stage and the outcome of each batch are recorded in
+                these metrics while the migration runs (see es_metrics.new_metrics)
+            dimensions (dictionary): cached dimension tables loaded by dimension_cache.load_dimensions.  If set,
+                documents are enriched with the fields of the dimension rows they refer to (see
+                dimension_cache.ENRICHMENTS), instead of the table being flattened with a SQL join.
+            mapping (string): mapping profile of the new index (see es_mappings.MAPPING_PROFILES): 'legacy' maps
+                every string column to text, and 'optimized' maps identifiers and enums to keyword, stores blobs
+                without indexing them and leaves secrets out of the documents
+            partitioning (string): 'daily' to route each document into the daily index of its time column, or
+                'rollover' to write to the table's rolling write alias, instead of loading a new index that
+                replaces the table's index (see es_partitions).  Only for the tables in es_partitions.TIME_COLUMNS.
         Returns:
             tuple: contains time required to set up the migration process (setup_time), time required to
                 query data from the table in the MySQL database (sql_time), time required to generate
@@ -127,110 +515,713 @@ def migrate_table(connection, cur, table, workers, batch_size, limit, actions_fu
                 records (es_time), and the total time for the whole process.
     """
 
-    # Setup steps: create index, get column names (for action generation), initialize variables
+    # Setup steps: create index (or pick up the index of the migration being resumed), compile the row converter
+    # (for action generation), initialize variables
     t0 = time.time()
-    create_index(connection, cur, table)
-    col_names = get_colnames(cur, table)
-    t1 = time.time()
-    setup_time = t1 - t0
-    start = 0
-    num_rows = limit
-    sql_time = 0
-    actions_time = 0
-    es_time = 0
-    batch_size = batch_size * workers  # make sure that each worker has the optimal batch_size
+    checkpointed = reader is keyset_reader and (resume or checkpoint_path is not None)
+    if resume and reader is not keyset_reader:
+        raise ValueError('only migrations that use the keyset reader can be resumed')
+    if checkpointed:
+        key_cols = key_cols or KEY_COLUMNS[table]
+    progress = get_checkpoint(table, 'migration', checkpoint_path) if resume else None
+    if progress is not None and progress['key_cols'] != key_cols:
+        raise ValueError('the migration of {} was checkpointed with key columns {}, not {}'.format(
+            table, progress['key_cols'], key_cols))
+    if progress is not None and progress.get('partitioning') != partitioning:
+        raise ValueError('the migration of {} was checkpointed with partitioning {}, not {}'.format(
+            table, progress.get('partitioning'), partitioning))
+    profile = build_profile(cur, table, mapping, dimensions)
+    if progress is None:
+        if resume:
+            print('No unfinished migration of {} to resume, starting from the first row'.format(table))
+        elif checkpointed:
+            discard_unfinished_index(connection, table, get_checkpoint(table, 'migration', checkpoint_path))
+        if partitioning:
+            index_name = open_partitions(connection, cur, table, partitioning, profile)
+        else:
+            index_name = create_index(connection, cur, table, profile)
+        progress = {'index': index_name, 'partitioning': partitioning, 'key_cols': key_cols, 'last_key': None,
+                    'rows': 0,
+                    'stats': new_bulk_stats(), 'times': {'sql': 0, 'actions': 0, 'es': 0}, 'tuning': None}
+        if checkpointed:
+            # Record the new index straight away, so that it is resumed or discarded even if the migration dies
+            # before its first checkpoint
+            save_checkpoint(table, 'migration', progress, checkpoint_path)
+    else:
+        index_name = progress['index']
+        print('Resuming the migration of {} into {} after {} rows'.format(table, index_name, progress['rows']))
+    try:
+        converter = _table_converter(cur, table, id_cols, op_type, dimensions, profile, partitioning)
+        t1 = time.time()
+        setup_time = t1 - t0
+        num_rows = limit - progress['rows']
+        sql_time = progress['times']['sql']
+        actions_time = progress['times']['actions']
+        es_time = progress['times']['es']
+        tuning = progress['tuning']
+        if tuning is None and (auto_tune or payload_bytes):
+            tuning = new_tuning_state(batch_size, workers, payload_bytes)
+        if auto_tune and tuning['doc_bytes']:
+            workers = tuning['workers']
+        batch_size = batch_size * workers  # make sure that each worker has the optimal batch_size
+        if tuning and tuning['doc_bytes']:
+            batch_size = batch_rows(tuning) * workers
+        new_size = None
+        checkpoint_time = time.time()
+        result = [progress['stats']]
+        doc_type_name = 'record'
+        if progress['last_key'] is not None:
+            batches = reader(cur, table, batch_size, key_cols, start_key=progress['last_key'])
+        else:
+            batches = reader(cur, table, batch_size, key_cols)
+        # Loop through the table in batches.  For each loop, create actions for the Elasticsearch bulk API and
+        # submit those actions to the API.
+        while num_rows > 0:
+            t2 = time.time()
+            num_results, cur, last_key = next_batch(batches, cur, new_size)
+            t3 = time.time()
+            sql_time += t3 - t2
+            if num_results == 0:
+                break
+            observe(metrics, 'sql', t3 - t2)
+            actions_list = actions_func(num_results, cur, converter, index_name, doc_type_name,
+                                        tuning['batch_bytes'] if tuning else None)
+            t4 = time.time()
+            actions_time += t4 - t3
+            observe(metrics, 'actions', t4 - t3)
+            batch_result = api_func(connection, workers, actions_list)
+            if partitioning == 'rollover':
+                rollover_partition(get_es_client(connection), table)
+            save = checkpointed and (not es_async.in_flight() or time.time() - checkpoint_time >= CHECKPOINT_INTERVAL)
+            if save:
+                # Only move the checkpoint past documents that Elasticsearch has acknowledged
+                batch_result += flush_async_es_requests()
+            result += batch_result
+            t5 = time.time()
+            es_time += t5 - t4
+            observe(metrics, 'es', t5 - t4)
+            record_bulk_stats(metrics, merge_bulk_stats(batch_result))
+            set_gauge(metrics, 'bulk_in_flight', es_async.in_flight())
+            num_rows -= num_results
+            if tuning:
+                if auto_tune:
+                    update_tuning_state(tuning, merge_bulk_stats(batch_result), t5 - t4)
+                    workers = tuning['workers']
+                else:
+                    record_doc_bytes(tuning, merge_bulk_stats(batch_result))
+                new_size = batch_rows(tuning) * workers
+            if save:
+                checkpoint_time = time.time()
+                progress['last_key'] = last_key
+                progress['rows'] = limit - num_rows
+                progress['stats'] = dict(merge_bulk_stats(result), latencies=[])
+                progress['times'] = {'sql': sql_time, 'actions': actions_time, 'es': es_time}
+                progress['tuning'] = tuning
+                save_checkpoint(table, 'migration', progress, checkpoint_path)
+        t6 = time.time()
+        flushed = flush_async_es_requests()
+        if flushed:
+            record_bulk_stats(metrics, merge_bulk_stats(flushed))
+        result += flushed
+        if not partitioning:
+            finalize_index(connection, table, index_name)
+    except BaseException:
+        if not partitioning and not checkpointed:
+            discard_failed_index(connection, index_name)
+        raise
+    es_time += time.time() - t6
+    if checkpointed:
+        clear_checkpoint(table, 'migration', checkpoint_path)
+    print(format_bulk_stats(merge_bulk_stats(result)))
+    if auto_tune:
+        print(format_tuning_state(tuning))
+    return (setup_time, sql_time, actions_time, es_time, sum([setup_time, sql_time, actions_time, es_time]))
+
+
+class RowBuffer(object):
+    """ Holds a batch of rows that has already been fetched from MySQL and hands them out through the same
+        rowcount/fetchone/fetchmany interface as a MySQL cursor, so that the actions functions can be run on
+        a batch after the cursor has moved on to the next one.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.rowcount = len(rows)
+        self.position = 0
+
+    def fetchone(self):
+        if self.position >= self.rowcount:
+            return None
+        self.position += 1
+        return self.rows[self.position - 1]
+
+    def fetchmany(self, size=1):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(self.rowcount - self.position)
+
+
+def _put_until_stopped(q, item, stop):
+    """ Puts an item on a bounded queue, giving up if another pipeline stage has failed """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _get_until_stopped(q, stop):
+    """ Gets an item from a bounded queue, returning None if another pipeline stage has failed """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except Empty:
+            pass
+    return None
+
+
+def pipeline_migrate_table(connection, cur, table, workers, batch_size, limit, actions_func, api_func,
+                           reader=keyset_reader, key_cols=None, auto_tune=False, payload_bytes=None, serializers=1,
+                           submitters=1, queue_size=4, partitions=1, partition_col=None, read_connections=None,
+                           rds_info=None, id_cols=None, op_type='index', metrics=None, dimensions=None,
+                           mapping='legacy', partitioning=None):
+    """ Migrates a table into Elasticsearch with the read, action generation and Bulk API stages running at the
+        same time.  A reader thread pulls batches from MySQL, serializer threads turn them into actions and
+        submitter threads send them to Elasticsearch, with bounded queues between the stages, so that MySQL
+        keeps reading while Elasticsearch is indexing and the total time approaches that of the slowest stage.
+        With more than one partition, the table is split into key or time ranges and several reader threads,
+        each with its own MySQL connection, read the ranges at the same time and feed the same serializers.
+        Pipelined migrations cannot be resumed, so one that fails deletes the index it was loading.
+        Args:
+            connection (string): name of the Elasticsearch connection to be used
+            cur (cursor object): MySQL cursor object that is connected to the MySQL database
+                where records will be pulled from
+            table (string): the name of the table to be indexed in Elasticsearch
+            workers (integer): number of parallel workers to use in each Bulk API call (see migrate_table)
+            batch_size (integer): number of records to send to Elasticsearch in each Bulk API call
+            limit (integer): total number of records to migrate from MySQL to Elasticsearch
+            actions_func (function): function to use to generate actions for the Bulk API call (see
+                migrate_table)
+            api_func (function): function to use to make calls to the Elasticsearch Bulk API (see migrate_table)
+            reader (function): function to use to read batches of records from MySQL
+            key_cols (list of strings): key columns for keyset_reader (defaults to KEY_COLUMNS[table])
+            auto_tune (boolean): if True, adjust the batch size and number of workers as batches complete (see
+                migrate_table)
+            payload_bytes (integer): if set, size batches in bytes instead of rows (see migrate_table)
+            serializers (integer): number of threads generating actions
+            submitters (integer): number of threads making Bulk API calls
+            queue_size (integer): maximum number of batches waiting between two stages
+            partitions (integer): number of ranges to split the table into (see mySQL_connect.partition_ranges).
+                Requires keyset_reader.
+            partition_col (string): integer or DATETIME column to split the table on, e.g. logId or logTime
+                (defaults to the first key column)
+            read_connections (integer): number of reader threads, each with its own MySQL connection, taking
+                ranges in turn (defaults to one per partition)
+            rds_info (dictionary): connection information used to open the reader connections (see
+                mySQL_connect.rds_mysql_connection).  Required when partitions is more than 1.
+            id_cols (list of strings): columns to derive each document's _id from (see migrate_table)
+            op_type (string): Bulk API operation for each document (see migrate_table)
+            metrics (dictionary): if set, stage times, batch outcomes and the number of batches waiting in each
+                queue are recorded in these metrics while the migration runs (see es_metrics.new_metrics)
+            dimensions (dictionary): cached dimension tables to enrich documents with (see migrate_table)
+            mapping (string): mapping profile of the new index (see migrate_table)
+            partitioning (string): 'daily' or 'rollover' to write to time-partitioned indices (see migrate_table)
+        Returns:
+            tuple: setup time, then the time spent in the SQL, actions and Elasticsearch stages (summed over
+                each stage's threads), and the total wall-clock time for the whole process.  Because the stages
+                overlap, the total is less than the sum of the stage times.
+    """
+    # Setup steps: create index, compile the row converter (for action generation), initialize variables
+    t0 = time.time()
+    profile = build_profile(cur, table, mapping, dimensions)
+    if partitioning:
+        index_name = open_partitions(connection, cur, table, partitioning, profile)
+    else:
+        index_name = create_index(connection, cur, table, profile)
+    try:
+        converter = _table_converter(cur, table, id_cols, op_type, dimensions, profile, partitioning)
+        t1 = time.time()
+        setup_time = t1 - t0
+        tuning = new_tuning_state(batch_size, workers, payload_bytes) if auto_tune or payload_bytes else None
+        batch_size = batch_size * workers  # make sure that each worker has the optimal batch_size
+        doc_type_name = 'record'
+        row_queue = Queue(maxsize=queue_size)
+        actions_queue = Queue(maxsize=queue_size)
+        stop = threading.Event()
+        lock = threading.Lock()
+        stage_times = {'sql': 0, 'actions': 0, 'es': 0}
+        result = []
+        errors = []
+        remaining = {'rows': limit}
+        ranges = Queue()
+        if partitions > 1:
+            if reader is not keyset_reader:
+                raise ValueError('partitioned reads require the keyset reader')
+            key_cols = key_cols or KEY_COLUMNS[table]
+            for bounds in partition_ranges(cur, table, partition_col or key_cols[0], partitions):
+                ranges.put(bounds)
+            num_readers = min(ranges.qsize(), read_connections or partitions)
+        else:
+            ranges.put(None)
+            num_readers = 1
+
+        def add_time(stage, start):
+            elapsed = time.time() - start
+            observe(metrics, stage, elapsed)
+            with lock:
+                stage_times[stage] += elapsed
+
+        def run_stage(func):
+            # Record the first failure and stop the other stages instead of leaving them blocked on a queue
+            try:
+                func()
+            except Exception as exc:
+                errors.append(exc)
+                stop.set()
+
+        def read_range(read_cur, bounds):
+            # Returns False once the limit has been reached or another stage has failed
+            if bounds is None:
+                batches = reader(read_cur, table, batch_size, key_cols)
+            else:
+                batches = reader(read_cur, table, batch_size, key_cols, bounds)
+            new_size = None
+            while True:
+                with lock:
+                    if remaining['rows'] <= 0:
+                        return False
+                t2 = time.time()
+                num_results, batch_cur, _ = next_batch(batches, read_cur, new_size)
+                if num_results == 0:
+                    return True
+                rows = batch_cur.fetchall()
+                add_time('sql', t2)
+                if not _put_until_stopped(row_queue, (num_results, rows), stop):
+                    return False
+                set_gauge(metrics, 'row_queue_depth', row_queue.qsize())
+                with lock:
+                    remaining['rows'] -= num_results
+                    if tuning:
+                        new_size = batch_rows(tuning) * tuning['workers']
+
+        def read_stage():
+            if partitions <= 1:
+                read_range(cur, ranges.get())
+                return
+            connection_info = rds_mysql_connection(rds_info)
+            if connection_info is None:
+                raise ConnectionError('could not open a MySQL connection for a partitioned read')
+            read_con, read_cur = connection_info
+            try:
+                while not stop.is_set():
+                    try:
+                        bounds = ranges.get_nowait()
+                    except Empty:
+                        return
+                    if not read_range(read_cur, bounds):
+                        return
+            finally:
+                close_connection(read_con, read_cur)
+
+        def serialize_stage():
+            while True:
+                item = _get_until_stopped(row_queue, stop)
+                set_gauge(metrics, 'row_queue_depth', row_queue.qsize())
+                if item is None:
+                    return
+                t3 = time.time()
+                num_results, rows = item
+                actions_list = actions_func(num_results, RowBuffer(rows), converter, index_name, doc_type_name,
+                                            tuning['batch_bytes'] if tuning else None)
+                add_time('actions', t3)
+                if not _put_until_stopped(actions_queue, actions_list, stop):
+                    return
+                set_gauge(metrics, 'actions_queue_depth', actions_queue.qsize())
+
+        def submit_stage():
+            while True:
+                actions_list = _get_until_stopped(actions_queue, stop)
+                set_gauge(metrics, 'actions_queue_depth', actions_queue.qsize())
+                if actions_list is None:
+                    return
+                t4 = time.time()
+                response = api_func(connection, tuning['workers'] if tuning else workers, actions_list)
+                if partitioning == 'rollover':
+                    rollover_partition(get_es_client(connection), table)
+                add_time('es', t4)
+                record_bulk_stats(metrics, merge_bulk_stats(response))
+                set_gauge(metrics, 'bulk_in_flight', es_async.in_flight())
+                with lock:
+                    result.extend(response)
+                    if auto_tune:
+                        update_tuning_state(tuning, merge_bulk_stats(response), time.time() - t4)
+                    elif tuning:
+                        record_doc_bytes(tuning, merge_bulk_stats(response))
+
+        def start_threads(func, count):
+            threads = [threading.Thread(target=run_stage, args=(func,)) for i in range(count)]
+            for thread in threads:
+                thread.start()
+            return threads
+
+        # Start every stage, then shut them down in order: once a stage's threads have all finished, send one
+        # end-of-data marker (None) per thread in the next stage
+        reader_threads = start_threads(read_stage, num_readers)
+        serializer_threads = start_threads(serialize_stage, serializers)
+        submitter_threads = start_threads(submit_stage, submitters)
+        for threads, next_queue, next_count in [(reader_threads, row_queue, serializers),
+                                                (serializer_threads, actions_queue, submitters),
+                                                (submitter_threads, None, 0)]:
+            for thread in threads:
+                thread.join()
+            for i in range(next_count):
+                _put_until_stopped(next_queue, None, stop)
+        if errors:
+            raise errors[0]
+        t5 = time.time()
+        flushed = flush_async_es_requests()
+        if flushed:
+            record_bulk_stats(metrics, merge_bulk_stats(flushed))
+        result += flushed
+        if not partitioning:
+            finalize_index(connection, table, index_name)
+    except BaseException:
+        if not partitioning:
+            discard_failed_index(connection, index_name)
+        raise
+    stage_times['es'] += time.time() - t5
+    print(format_bulk_stats(merge_bulk_stats(result)))
+    if auto_tune:
+        print(format_tuning_state(tuning))
+    total_time = time.time() - t0
+    return setup_time, stage_times['sql'], stage_times['actions'], stage_times['es'], total_time
+
+
+def sync_table(connection, cur, table, workers, batch_size, actions_func, api_func, key_cols=None,
+               checkpoint_path=None, id_cols=None, op_type='index', dimensions=None, mapping='legacy',
+               partitioning=None):
+    """ Brings a table's index up to date by indexing only the rows added since the last sync.  The key of the
+        last row indexed (the high-water mark, e.g. the largest logId or the latest (logTime, logId)) is saved in
+        the checkpoint file after every batch, and each run reads the new rows with an indexed range query that
+        starts after it, so the cost of a sync depends on the number of new rows and not on the size of the
+        table.  New rows are appended to the index behind the <table>_index alias.  The first sync of a table
+        has no high-water mark: it loads the whole table into a new index and then swaps the alias to it (see
+        create_index and finalize_index).  Until the alias has been swapped, the high-water mark also names the
+        index being loaded, so that a first sync that dies partway through is finished by the next one instead of
+        appending rows to an alias that does not exist yet.
+        Args:
+            connection (string): name of the Elasticsearch connection to be used
+            cur (cursor object): MySQL cursor object that is connected to the MySQL database
+            table (string): the name of the table to sync
+            workers (integer): number of parallel workers to use in Bulk API calls
+            batch_size (integer): number of records each worker sends in each Bulk API call
+            actions_func (function): function to use to generate actions for the Bulk API call (see migrate_table)
+            api_func (function): function to use to make calls to the Elasticsearch Bulk API.  Must wait for
+                its calls to finish (i.e. not submit_async_es_requests), so that the high-water mark only
+                moves past documents that Elasticsearch has acknowledged.
+            key_cols (list of strings): columns that order new rows after old ones, e.g. ['event_id'] or
+                ['logTime', 'logId'] (defaults to KEY_COLUMNS[table])
+            checkpoint_path (string): path of the checkpoint file (defaults to checkpoints.CHECKPOINT_PATH)
+            id_cols (list of strings): columns to derive each document's _id from, so that a batch that is
+                re-sent after a crash, before its high-water mark was saved, does not duplicate documents
+            op_type (string): Bulk API operation for each document (see migrate_table)
+            dimensions (dictionary): cached dimension tables to enrich documents with (see migrate_table)
+            mapping (string): mapping profile of the index if it is created, and of the documents added to it
+                (see migrate_table)
+            partitioning (string): 'daily' or 'rollover' to write to time-partitioned indices (see migrate_table)
+        Returns:
+            tuple: number of rows synced and the total time taken
+    """
+    t0 = time.time()
+    key_cols = key_cols or KEY_COLUMNS[table]
+    watermark = get_checkpoint(table, 'watermark', checkpoint_path)
+    if watermark is not None and watermark['key_cols'] != key_cols:
+        raise ValueError('the high-water mark for {} was saved for key columns {}, not {}'.format(
+            table, watermark['key_cols'], key_cols))
+    loading = watermark.get('loading') if watermark is not None and not partitioning else None
+    if watermark is not None and not partitioning:
+        es = get_es_client(connection)
+        if loading and not es.indices.exists(index=loading):
+            print('{}, which the first sync of {} was loading, is gone'.format(loading, table))
+            watermark = loading = None
+        elif not loading and not es.indices.exists_alias(name=table + '_index'):
+            print('{}_index does not exist'.format(table))
+            watermark = None
+    profile = build_profile(cur, table, mapping, dimensions, sample_rows=0 if watermark else SAMPLE_ROWS)
+    if partitioning:
+        index_name = open_partitions(connection, cur, table, partitioning, profile)
+    elif watermark is None:
+        index_name = loading = create_index(connection, cur, table, profile)
+        # Record the new index straight away, so that the next sync finishes loading it if this one dies
+        save_checkpoint(table, 'watermark', {'key_cols': key_cols, 'last_key': None, 'loading': loading},
+                        checkpoint_path)
+    elif loading:
+        index_name = loading
+        print('Finishing the first sync of {} into {}'.format(table, index_name))
+    else:
+        index_name = table + '_index'
+    if watermark is None:
+        print('No high-water mark for {}, loading the whole table'.format(table))
+        start_key = None
+    else:
+        start_key = watermark['last_key']
+    last_key = start_key
+    converter = _table_converter(cur, table, id_cols, op_type, dimensions, profile, partitioning)
+    batches = keyset_reader(cur, table, batch_size * workers, key_cols, start_key=start_key)
+    synced = 0
     result = []
-    index_name = table + '_index'
-    doc_type_name = 'record'
-    # Loop through the table in batches.  For each loop, create actions for the Elasticsearch bulk API and
-    # submit those actions to the API.
-    while num_rows > 0:
-        t2 = time.time()
-        num_results, cur = interval_query(cur, table, start, batch_size)
-        t3 = time.time()
-        sql_time += t3 - t2
+    while True:
+        num_results, cur, batch_key = next_batch(batches, cur)
         if num_results == 0:
             break
-        actions_list = actions_func(num_results, cur, col_names, index_name, doc_type_name)
-        t4 = time.time()
-        actions_time += t4 - t3
+        last_key = batch_key
+        actions_list = actions_func(num_results, cur, converter, index_name, 'record')
         result += api_func(connection, workers, actions_list)
-        t5 = time.time()
-        es_time += t5 - t4
-        num_rows -= num_results
-        start += num_results
-    return (setup_time, sql_time, actions_time, es_time, sum([setup_time, sql_time, actions_time, es_time]))
+        if partitioning == 'rollover':
+            rollover_partition(get_es_client(connection), table)
+        save_checkpoint(table, 'watermark', {'key_cols': key_cols, 'last_key': last_key, 'loading': loading},
+                        checkpoint_path)
+        synced += num_results
+    if loading:
+        finalize_index(connection, table, index_name)
+        save_checkpoint(table, 'watermark', {'key_cols': key_cols, 'last_key': last_key, 'loading': None},
+                        checkpoint_path)
+    print(format_bulk_stats(merge_bulk_stats(result)))
+    return synced, time.time() - t0
 
 
-def create_index(connection, cur, table):
-    """ Creates a new index in Elasticsearch.  If the index already exists, this function deletes it
-        before creating a new index.
+def create_index(connection, cur, table, profile=None):
+    """ Creates a new versioned index (<table>_index_v<timestamp>) in Elasticsearch, with refreshes turned off and
+        no replicas so that it can be loaded at full speed.  Searches keep going to the index behind the
+        <table>_index alias until finalize_index swaps the alias to the new index.
         Args:
             connection (string): name of the Elasticsearch connection to be used
             cur (cursor object): MySQL cursor object that is connected to the MySQL database where records
                 will be pulled from
             table (string): name of the table to be indexed in Elasticsearch
+            profile (dictionary): mapping profile returned by es_mappings.build_profile (None for the mapping of
+                generate_mapping)
+        Returns:
+            string: name of the new index
     """
-    mapping = generate_mapping(cur, table, 'record')
-    es = Elasticsearch(CONNECTION_IP[connection], port=PORT)
-    index_name = table + "_index"
-    if es.indices.exists(index_name):
-        es.indices.delete(index_name)
-    response = es.indices.create(index=index_name, ignore=400, body=mapping)
+    es = get_es_client(connection)
+    if is_partitioned(es, table):
+        raise ValueError('{} is partitioned; migrate it with partitioning, or delete the {}_partitions template '
+                         'first'.format(table, table))
+    if profile:
+        body = profile_mapping(profile, 'record')
+    else:
+        body = json.loads(generate_mapping(cur, table, 'record'))
+    body['settings'] = BULK_LOAD_SETTINGS
+    index_name = '{}_index_v{}'.format(table, int(time.time() * 1000))
+    response = es.indices.create(index=index_name, body=body)
     print(response)
+    return index_name
 
 
-def generate_json(num_rows, cur, col_names, index_name, doc_type_name):
+def open_partitions(connection, cur, table, partitioning, profile=None):
+    """ Sets up time-partitioned indices for a table (see es_partitions): puts the index template that gives every
+        partition the table's mapping and the <table>_index read alias, and for rollover partitioning creates the
+        first partition and the <table>_write alias if they do not exist yet.  The versioned index of an earlier
+        migration is removed from the read alias, as the partitions will hold the same rows.
+        Args:
+            connection (string): name of the Elasticsearch connection to be used
+            cur (cursor object): MySQL cursor object that is connected to the MySQL database
+            table (string): name of the table, one of es_partitions.TIME_COLUMNS
+            partitioning (string): 'daily' or 'rollover'
+            profile (dictionary): mapping profile returned by es_mappings.build_profile (None for the mapping of
+                generate_mapping)
+        Returns:
+            string: index name to generate actions with: the prefix of the daily partitions, which
+                es_documents adds each document's day to, or the write alias
+    """
+    if table not in TIME_COLUMNS:
+        raise ValueError('{} has no time column to partition it on'.format(table))
+    if partitioning not in PARTITIONINGS:
+        raise ValueError('unknown partitioning {}'.format(partitioning))
+    es = get_es_client(connection)
+    if profile:
+        mapping = profile_mapping(profile, 'record')
+    else:
+        mapping = json.loads(generate_mapping(cur, table, 'record'))
+    put_partition_template(es, table, mapping)
+    detach_unpartitioned_indices(es, table)
+    if partitioning == 'rollover':
+        return bootstrap_rollover(es, table)
+    return partition_names(table)[0]
+
+
+def maintain_partitions(connection, cur, table, partitioning, mapping='legacy', retention_days=RETENTION_DAYS,
+                        conditions=None, interval=None):
+    """ Keeps a table's partitions in shape, once or every <interval> seconds: the index template is put, rollover
+        partitions are rolled over when they meet a condition, and partitions older than the retention period are
+        deleted.  Run it next to streaming ingestion into the write alias (see es_stream), which does not roll
+        the alias over itself.
+        Args:
+            connection (string): name of the Elasticsearch connection to be used
+            cur (cursor object): MySQL cursor object that is connected to the MySQL database
+            table (string): name of the table, one of es_partitions.TIME_COLUMNS
+            partitioning (string): 'daily' or 'rollover'
+            mapping (string): mapping profile of new partitions (see migrate_table)
+            retention_days (float): number of days partitions are kept for
+            conditions (dictionary): rollover conditions (defaults to es_partitions.ROLLOVER_CONDITIONS)
+            interval (float): seconds between rounds (None to run once)
+    """
+    open_partitions(connection, cur, table, partitioning, build_profile(cur, table, mapping))
+    es = get_es_client(connection)
+    while True:
+        if partitioning == 'rollover':
+            rollover_partition(es, table, conditions)
+        apply_retention(es, table, retention_days)
+        if not interval:
+            return
+        time.sleep(interval)
+
+
+def discard_unfinished_index(connection, table, progress):
+    """ Deletes the index that an unfinished migration was loading, unless it has already been made live.
+        Args:
+            connection (string): name of the Elasticsearch connection to be used
+            table (string): name of the table
+            progress (dictionary): checkpoint saved by migrate_table (None if there is no unfinished migration)
+    """
+    if progress is None or progress.get('partitioning'):
+        # Partitioned migrations write to partitions that are already live
+        return
+    es = get_es_client(connection)
+    if not es.indices.exists_alias(index=progress['index'], name=table + '_index'):
+        print('Deleting {}, left by an unfinished migration'.format(progress['index']))
+        es.indices.delete(index=progress['index'], ignore=404)
+
+
+def discard_failed_index(connection, index_name):
+    """ Deletes the index that a failed migration was loading, so that it is not left behind.  Bulk API calls still
+        in flight are waited for first, so that none of them creates the index again after it is deleted.
+        Args:
+            connection (string): name of the Elasticsearch connection to be used
+            index_name (string): name of the index, as returned by create_index
+    """
+    try:
+        flush_async_es_requests()
+        print('Deleting {}, left by a failed migration'.format(index_name))
+        get_es_client(connection).indices.delete(index=index_name, ignore=404)
+    except Exception as e:
+        print('could not delete {}: {}'.format(index_name, e))
+
+
+def finalize_index(connection, table, index_name):
+    """ Gets a loaded index ready for searches and makes it live.  The search settings are restored, the index
+        is refreshed and force-merged, and then, in a single atomic update, the <table>_index alias is pointed at
+        the new index and the index it pointed at before is deleted.  A concrete index called <table>_index, left
+        by versions of create_index that did not use aliases, is replaced by the alias in the same update.  Tables
+        that are partitioned are refused, as the update would delete their partitions.
+        Args:
+            connection (string): name of the Elasticsearch connection to be used
+            table (string): name of the table that was indexed
+            index_name (string): name of the loaded index, as returned by create_index
+    """
+    es = get_es_client(connection)
+    alias = table + '_index'
+    if is_partitioned(es, table):
+        raise ValueError('{} is partitioned; {} was not made live so that its partitions are kept'.format(
+            table, index_name))
+    es.indices.put_settings(index=index_name, body=SEARCH_SETTINGS)
+    es.indices.refresh(index=index_name)
+    es.indices.forcemerge(index=index_name, max_num_segments=MERGE_SEGMENTS, request_timeout=MERGE_TIMEOUT)
+    actions = [{'add': {'index': index_name, 'alias': alias}}]
+    if es.indices.exists_alias(name=alias):
+        old_indices = [name for name in es.indices.get_alias(name=alias) if name != index_name]
+    elif es.indices.exists(alias):
+        old_indices = [alias]
+    else:
+        old_indices = []
+    actions += [{'remove_index': {'index': name}} for name in old_indices]
+    response = es.indices.update_aliases(body={'actions': actions})
+    print(response)
+
+
+def generate_json(num_rows, cur, converter, index_name, doc_type_name, max_bytes=None):
     """ Generates a list of json objects to be used by submit_parallel_es_requests(), which uses the Requests
         Python library to submit parallel calls to the Elasticsearch Bulk API.
         Args:
             num_rows (integer): number of rows in the MySQL table to be indexed by Elasticsearch
             cur (cursor object): MySQL cursor object that holds the result of the query pulling records from
                 the table in the MySQL database
-            col_names (list of strings): names of columns in the table in the MySQL database
+            converter (dictionary): row converter for the table, created by es_documents.compile_row_converter
             index_name (string): name of the index in Elasticsearch where records will be added
             doc_type_name (string): name of the document type in Elasticsearch where records will be added
+            max_bytes (integer): not used in this function.  Included so that migrate_table can call either
+                this function or generate_ndjson
         Returns:
             list of json objects (Python dictionaries)
     """
-    num_rows = min(num_rows, cur.rowcount)
     body = []
-    header = {"index": {"_index": index_name, "_type": doc_type_name}}
-    for i in range(num_rows):
-        line = cur.fetchone()
-        content = {}
-        for j, item in enumerate(line):
-            content[col_names[j]] = str(item)
-        body.append(header)
-        body.append(content)
+    for content in convert_rows(converter, cur.fetchmany(num_rows)):
+        body.append(bulk_action(converter, index_name, doc_type_name, content))
+        body.append(bulk_source(converter, content))
     return body
 
 
-def generate_bulk_actions_list(num_rows, cur, col_names, index_name, doc_type_name):
+def generate_ndjson(num_rows, cur, converter, index_name, doc_type_name, max_bytes=None, processes=0):
+    """ Generates ready-to-send payloads for submit_parallel_es_requests() or submit_single_bulk_api().  Each row
+        is written straight into a bytearray as a '\\n'-delimited action and document, with the action line
+        serialized only once for the whole batch (apart from each document's _id), and a new payload is started
+        once the current one reaches max_bytes.  With more than one process, the batch is split between worker
+        processes so that json encoding is not limited to the one core that the main Python thread can use.
+        Args:
+            num_rows (integer): number of rows in the MySQL table to be indexed by Elasticsearch
+            cur (cursor object): MySQL cursor object that holds the result of the query pulling records from
+                the table in the MySQL database
+            converter (dictionary): row converter for the table, created by es_documents.compile_row_converter
+            index_name (string): name of the index in Elasticsearch where records will be added
+            doc_type_name (string): name of the document type in Elasticsearch where records will be added
+            max_bytes (integer): payload size at which to start a new payload (defaults to PAYLOAD_BYTES)
+            processes (integer): number of worker processes to generate the payloads with (0 or 1 to generate them
+                in this process)
+        Returns:
+            list of bytearrays, each holding the body of one Bulk API call
+    """
+    max_bytes = max_bytes or PAYLOAD_BYTES
+    header = compile_action_header(converter, index_name, doc_type_name)
+    rows = cur.fetchmany(num_rows)
+    if processes > 1 and len(rows) > processes:
+        # Rows are sent to the workers as pickled tuples and come back as finished payloads
+        pool = get_process_pool(processes, converter, header)
+        chunk = -(-len(rows) // processes)
+        futures = [pool.submit(serialize_worker_rows, rows[i:i + chunk], max_bytes)
+                   for i in range(0, len(rows), chunk)]
+        return [payload for f in futures for payload in f.result()]
+    return serialize_rows(converter, rows, header, max_bytes)
+
+
+def generate_bulk_actions_list(num_rows, cur, converter, index_name, doc_type_name, max_bytes=None):
     """ Generates a list of actions to be used by submit_single_bulk_api(), which uses the Bulk API
         helpers Python library.
         Args:
             num_rows (integer): number of rows in the MySQL table to be indexed by Elasticsearch
             cur (cursor object): MySQL cursor object that holds the result of the query pulling records from
                 the table in the MySQL database
-            col_names (list of strings): names of columns in the table in the MySQL database
+            converter (dictionary): row converter for the table, created by es_documents.compile_row_converter
             index_name (string): name of the index in Elasticsearch where records will be added
             doc_type_name (string): name of the document type in Elasticsearch where records will be added
+            max_bytes (integer): not used in this function.  Included so that migrate_table can call either
+                this function or generate_ndjson
         Returns:
             list of json objects (Python dictionaries)
     """
     actions = []
-    num_rows = min(num_rows, cur.rowcount)
-    for i in range(num_rows):
-        line = cur.fetchone()
-        content = {}
-        for j, item in enumerate(line):
-            content[col_names[j]] = str(item)
-        actions.append({
-            "_index": index_name,
-            "_type": doc_type_name,
-            "_source": content
-        })
+    for content in convert_rows(converter, cur.fetchmany(num_rows)):
+        (op_type, meta), = bulk_action(converter, index_name, doc_type_name, content).items()
+        action = {
+            "_op_type": op_type,
+            "_source": bulk_source(converter, content)
+        }
+        action.update(meta)
+        actions.append(action)
     return actions
 
 
@@ -261,7 +1252,7 @@ def generate_mapping(cur, table, doc_type_name):
     return mapping
 
 
-def benchmark_import_size(connection, cur, table, low_tests, high_tests):
+def benchmark_import_size(connection, cur, table, low_tests, high_tests, reader=keyset_reader, key_cols=None):
     """ Performs benchmark tests to determine the optimal batch size to use for Elasticsearch Bulk API calls.
         For benchmarking purposes, it is recommended to connect to a single-node Elasticsearch cluster.
 
@@ -271,6 +1262,8 @@ def benchmark_import_size(connection, cur, table, low_tests, high_tests):
             table (string): name of the table to be migrated
             low_tests (integer): starting point of the range to use for batch size (2 is raised to this power)
             high_tests (integer): ending point of the range to use for batch size (2 is raised to this power)
+            reader (function): function to use to read batches of records from MySQL
+            key_cols (list of strings): key columns for keyset_reader (defaults to KEY_COLUMNS[table])
         Returns:
             shows a bar graph plotting the total indexing speed against the batch size used for API calls.
     """
@@ -282,7 +1275,7 @@ def benchmark_import_size(connection, cur, table, low_tests, high_tests):
         batch_size = 100 * (2 ** i)
         print('beginning import of {} records'.format(batch_size))
         times = migrate_table(connection, cur, table, 1, batch_size, batch_size, generate_bulk_actions_list,
-                              submit_single_bulk_api)
+                              submit_single_bulk_api, reader, key_cols)
         import_times.append(times[4])
         sizes.append(batch_size)
         total_speeds.append(batch_size / times[4])
@@ -297,7 +1290,8 @@ def benchmark_import_size(connection, cur, table, low_tests, high_tests):
     plt.show()
 
 
-def benchmark_workers(connection, cur, table, low_tests, high_tests, batch_size, limit):
+def benchmark_workers(connection, cur, table, low_tests, high_tests, batch_size, limit, reader=keyset_reader,
+                      key_cols=None):
     """ Performs benchmark tests to determine the optimal number of workers to use in making parallel Elasticsearch
         Bulk API calls.
         Args:
@@ -308,6 +1302,8 @@ def benchmark_workers(connection, cur, table, low_tests, high_tests, batch_size,
             high_tests (integer): ending point of the range to use for the number of workers
             batch_size (integer): batch size to be used in each test
             limit: total number of records to be imported during each test
+            reader (function): function to use to read batches of records from MySQL
+            key_cols (list of strings): key columns for keyset_reader (defaults to KEY_COLUMNS[table])
         Returns:
             shows a bar graph plotting the total indexing speed against the number of workers used for parallel
             API calls
@@ -320,7 +1316,8 @@ def benchmark_workers(connection, cur, table, low_tests, high_tests, batch_size,
     # Loop to conduct benchmark tests on different numbers of parallel workers
     for i in range(low_tests, high_tests + 1):
         print('beginning import of {} records with {} workers'.format(limit, i))
-        times = migrate_table(connection, cur, table, i, batch_size, limit, generate_json, submit_parallel_es_requests)
+        times = migrate_table(connection, cur, table, i, batch_size, limit, generate_json, submit_parallel_es_requests,
+                              reader, key_cols)
         import_times.append(times[4])
         num_workers.append(i)
         total_speeds.append(round(limit / (times[4]), 2))
@@ -336,6 +1333,124 @@ def benchmark_workers(connection, cur, table, low_tests, high_tests, batch_size,
     plt.show()
 
 
+def add_migration_arguments(sp):
+    """ Adds the command line arguments for batches sized in bytes and pipelined migrations to a subparser """
+    sp.add_argument('--payload_mb', type=float, default=None, help="size batches in megabytes of bulk payload "
+                                                                   "instead of rows")
+    sp.add_argument('--processes', type=int, default=0, help="number of worker processes generating bulk "
+                                                             "payloads (0 to generate them in the main process)")
+    sp.add_argument('-p', '--pipeline', action='store_true', help="overlap the MySQL read, action generation and "
+                                                                  "bulk API stages")
+    sp.add_argument('--serializers', type=int, default=1, help="number of threads generating actions in "
+                                                               "pipeline mode")
+    sp.add_argument('--submitters', type=int, default=1, help="number of threads making bulk API calls in "
+                                                              "pipeline mode")
+    sp.add_argument('--queue_size', type=int, default=4, help="maximum number of batches waiting between "
+                                                              "pipeline stages")
+    sp.add_argument('--partitions', type=int, default=1, help="split the table into this many key or time ranges "
+                                                              "and read them on separate MySQL connections "
+                                                              "(implies --pipeline)")
+    sp.add_argument('--partition_col', default=None, help="integer or DATETIME column to split the table on, e.g. "
+                                                          "logId or logTime (defaults to the first key column)")
+    sp.add_argument('--read_connections', type=int, default=None, help="number of MySQL connections reading "
+                                                                       "partitions (defaults to one per partition)")
+    sp.add_argument('--resume', action='store_true', help="continue the table's last unfinished migration from its "
+                                                          "checkpoint (not available with --pipeline)")
+    sp.add_argument('--checkpoint_path', default=None, help="checkpoint the migration in this file so that it can be "
+                                                             "resumed with --resume (--resume alone uses "
+                                                             "checkpoints.json)")
+    sp.add_argument('--metrics_port', type=int, default=None, help="serve live migration metrics in Prometheus "
+                                                                   "text format on this port at /metrics")
+    sp.add_argument('--metrics_interval', type=float, default=None, help="print a json log line with live "
+                                                                         "migration metrics every this many seconds")
+    add_document_arguments(sp)
+    add_index_arguments(sp)
+
+
+def add_document_arguments(sp):
+    """ Adds the command line arguments for document ids and Bulk API operations to a subparser """
+    sp.add_argument('-i', '--ids', action='store_true', help="derive each document's _id from the table's key "
+                                                             "columns, so that re-sent rows are not duplicated")
+    sp.add_argument('--id_cols', type=lambda s: s.split(','), default=None,
+                    help="comma-separated columns to derive each document's _id from (implies --ids)")
+    sp.add_argument('--op_type', default='index', choices=OP_TYPES,
+                    help="bulk operation for each document: index (add or replace), create (skip documents that "
+                         "already exist) or update (upsert); create and update imply --ids")
+
+
+def add_index_arguments(sp):
+    """ Adds the command line arguments for the mapping and enrichment of a table's documents to a subparser """
+    sp.add_argument('--mapping', default='legacy', choices=MAPPING_PROFILES,
+                    help="mapping profile of the index: legacy (every string column is text) or optimized (keyword "
+                         "identifiers and enums, blobs stored without indexing, secrets left out, see tblMappings)")
+    sp.add_argument('--partitioning', default=None, choices=PARTITIONINGS,
+                    help="write log tables to daily indices chosen by each row's time column, or to a rolling write "
+                         "alias, behind the <table>_index read alias, instead of replacing the table's index")
+    sp.add_argument('--enrich', action='store_true', help="add the fields of the doctor and site rows each event "
+                                                          "refers to, from an in-memory cache of those tables, "
+                                                          "instead of flattening the table with a SQL join")
+
+
+def resolve_id_columns(args):
+    """ Replaces the --ids and --id_cols command line arguments with the list of columns to derive document ids
+        from (None if documents get ids assigned by Elasticsearch)
+    """
+    ids = args.pop('ids')
+    if not args['id_cols'] and (ids or args['op_type'] != 'index'):
+        args['id_cols'] = args.get('key_cols') or KEY_COLUMNS[args['table']]
+
+
+def start_enrichment(args, cur, rds_info):
+    """ Replaces the --enrich command line argument with the cached dimension tables that the table's documents
+        are enriched with, and starts refreshing them in the background.
+        Returns:
+            threading.Event object that stops the refresher, or None if documents are not enriched
+    """
+    tables = dimensions_for(args['table'])
+    if not args.pop('enrich'):
+        return None
+    if not tables:
+        print('{} has no dimension tables to enrich its documents with'.format(args['table']))
+        return None
+    args['dimensions'] = load_dimensions(cur, tables)
+    return start_dimension_refresher(args['dimensions'], rds_info)
+
+
+def run_migration(args):
+    """ Runs migrate_table or pipeline_migrate_table (for pipelined or partitioned migrations), depending on the
+        parsed command line arguments, with live metrics if they were asked for
+    """
+    metrics_port = args.pop('metrics_port')
+    metrics_interval = args.pop('metrics_interval')
+    if metrics_port is None and not metrics_interval:
+        return run_migration_function(args)
+    args['metrics'] = new_metrics(args['table'])
+    server = start_metrics_server(args['metrics'], metrics_port) if metrics_port is not None else None
+    logger = start_metrics_logger(args['metrics'], metrics_interval) if metrics_interval else None
+    try:
+        return run_migration_function(args)
+    finally:
+        if server:
+            server.shutdown()
+        if logger:
+            logger.set()
+            print('metrics ' + format_log_line(args['metrics']))
+
+
+def run_migration_function(args):
+    """ Calls migrate_table or pipeline_migrate_table with the parsed command line arguments """
+    payload_mb = args.pop('payload_mb')
+    args['payload_bytes'] = int(payload_mb * 1024 * 1024) if payload_mb else None
+    pipeline_args = {key: args.pop(key) for key in ['serializers', 'submitters', 'queue_size', 'partitions',
+                                                    'partition_col', 'read_connections', 'rds_info']}
+    if args.pop('pipeline') or pipeline_args['partitions'] > 1:
+        if args.pop('resume'):
+            raise ValueError('pipelined migrations cannot be resumed')
+        del args['checkpoint_path']
+        return pipeline_migrate_table(**dict(args, **pipeline_args))
+    return migrate_table(**args)
+
+
 def main():
     """
     Uses argparser to implement a command line interface for the functions in this module.
@@ -343,8 +1458,8 @@ def main():
     # Connect to RDS
     rds_info = load_connection_info('./login/.rds', ['port'])
     con, cur = rds_mysql_connection(rds_info)
-    cur.execute("""SHOW TABLES""")
-    table_list = [i[0] for i in cur.fetchall()]
+    configure_cache(metadata_namespace(rds_info), METADATA_CACHE_PATH)
+    table_list = list_tables(cur)
 
     # Use argparser to parse command line arguments
     parser = ArgumentParser(description='Augmedix Elasticsearch Project CLI')
@@ -353,6 +1468,10 @@ def main():
                         help='Select the Elasticsearch instance to connect to')
     parser.add_argument('-t', '--table', default='ee_audit_events', choices=table_list, help='Select the table to '
                                                                                              'import to Elasticsearch')
+    parser.add_argument('-r', '--reader', default='keyset', choices=list(READERS),
+                        help='Select how to page through the MySQL table: by key range (keyset) or by LIMIT/OFFSET')
+    parser.add_argument('-k', '--key_cols', type=lambda s: s.split(','), default=None,
+                        help='Comma-separated key columns for the keyset reader (e.g. logTime,logId)')
 
     subparser_base = parser.add_subparsers(title='actions', description='Choose an action')
     sp = subparser_base.add_parser('workertest')
@@ -377,6 +1496,12 @@ def main():
                                                                    "Elasticsearch")
     sp.add_argument('-w', '--workers', type=int, default=4, help="number of workers that send index requests"
                                                                  "to the Elasticsearch bulk API")
+    sp.add_argument('-e', '--engine', default='threads', choices=list(API_FUNCS),
+                    help="submit bulk requests from a thread pool that waits for each batch (threads) or from an "
+                         "asyncio engine that keeps requests in flight across batches (async)")
+    sp.add_argument('-a', '--auto_tune', action='store_true', help="adjust the batch size (in bytes) and number of "
+                                                                   "workers during the migration")
+    add_migration_arguments(sp)
 
     sp = subparser_base.add_parser('migrate')
     sp.set_defaults(which='migrate')
@@ -386,11 +1511,47 @@ def main():
                                                                    "Elasticsearch")
     sp.add_argument('-w', '--workers', type=int, default=1, help="number of workers that send index requests "
                                                                  "to the Elasticsearch bulk API")
+    # The single-call approach sends payloads one after another, so there are no parallel workers to tune
+    sp.set_defaults(auto_tune=False)
+    add_migration_arguments(sp)
+
+    sp = subparser_base.add_parser('sync')
+    sp.set_defaults(which='sync')
+    sp.add_argument('-b', '--batch_size', type=int, default=5000, help="number of documents to be imported to "
+                                                                       "Elasticsearch in each batch")
+    sp.add_argument('-w', '--workers', type=int, default=4, help="number of workers that send index requests "
+                                                                 "to the Elasticsearch bulk API")
+    sp.add_argument('--checkpoint_path', default=None, help="path of the file holding each table's high-water mark")
+    add_document_arguments(sp)
+    add_index_arguments(sp)
+
+    sp = subparser_base.add_parser('partitions')
+    sp.set_defaults(which='partitions')
+    sp.add_argument('--partitioning', default='daily', choices=PARTITIONINGS, help="layout of the table's "
+                                                                                  "partitions")
+    sp.add_argument('--mapping', default='legacy', choices=MAPPING_PROFILES, help="mapping profile of new "
+                                                                                   "partitions")
+    sp.add_argument('--retention_days', type=float, default=RETENTION_DAYS, help="delete partitions older than "
+                                                                                "this many days")
+    sp.add_argument('--max_age', default=ROLLOVER_CONDITIONS['max_age'], help="roll over to a new partition once "
+                                                                              "the current one is this old")
+    sp.add_argument('--max_docs', type=int, default=ROLLOVER_CONDITIONS['max_docs'],
+                    help="roll over to a new partition once the current one holds this many documents")
+    sp.add_argument('--interval', type=float, default=None, help="repeat every this many seconds instead of "
+                                                                 "running once")
 
     args = vars(parser.parse_args())
     args['cur'] = cur
+    args['reader'] = READERS[args['reader']]
     action = args['which']
     del args['which']
+    if action in ('migrate', 'parallel'):
+        # Partitioned reads open their own connections
+        args['rds_info'] = rds_info
+    refresher = None
+    if action in ('migrate', 'parallel', 'sync'):
+        resolve_id_columns(args)
+        refresher = start_enrichment(args, cur, rds_info)
 
     if action == 'sizetest':
         # Performs a benchmarking test on the bulk API on the standalone elasticseach cluster using
@@ -400,20 +1561,47 @@ def main():
         # Performs a benchmarking test on the parallel import approach using different numbers of workers
         benchmark_workers(**args)
     elif action == 'migrate':
-        # Migrates a table (up to <limit>) using the Elasticsearch Bulk API
-        args['actions_func'] = generate_bulk_actions_list
+        # Migrates a table (up to <limit>) using the Elasticsearch Bulk API.  Batches sized in bytes are written
+        # straight into bulk payloads, so that their size is measured.
+        processes = args.pop('processes')
+        if processes > 1 or args['payload_mb']:
+            args['actions_func'] = partial(generate_ndjson, processes=processes)
+        else:
+            args['actions_func'] = generate_bulk_actions_list
         args['api_func'] = submit_single_bulk_api
-        times = migrate_table(**args)
+        times = run_migration(args)
         print('Setup time: {:.2f} s, SQL query time: {:.2f}s , actions prep time: {:.2f} s, ES API time: {:.2f} s, '
               'total time: {:.2f} s'.format(*times))
     elif action == 'parallel':
-        # Runs a faster table migration by implementing a number of parallel API calls
-        args['actions_func'] = generate_json
-        args['api_func'] = submit_parallel_es_requests
-        times = migrate_table(**args)
+        # Runs a faster table migration by implementing a number of parallel API calls.  Batches sized in bytes,
+        # or generated by worker processes, are written straight into bulk payloads.
+        processes = args.pop('processes')
+        if processes > 1 or args['payload_mb'] or args['auto_tune']:
+            args['actions_func'] = partial(generate_ndjson, processes=processes)
+        else:
+            args['actions_func'] = generate_json
+        args['api_func'] = API_FUNCS[args.pop('engine')]
+        times = run_migration(args)
         print('Setup time: {:.2f} s, SQL query time: {:.2f}s , actions prep time: {:.2f} s, ES API time: {:.2f} s, '
               'total time: {:.2f} s'.format(*times))
 
+    elif action == 'sync':
+        # Indexes the rows added to a table since the last sync
+        del args['reader']
+        args['actions_func'] = generate_json
+        args['api_func'] = submit_parallel_es_requests
+        synced, total_time = sync_table(**args)
+        print('Synced {} new rows in {:.2f} s'.format(synced, total_time))
+
+    elif action == 'partitions':
+        # Puts the partition template, rolls the write alias over and applies the retention period
+        del args['reader'], args['key_cols']
+        args['conditions'] = {'max_age': args.pop('max_age'), 'max_docs': args.pop('max_docs')}
+        maintain_partitions(**args)
+
+    if refresher:
+        refresher.set()
+    close_es_connections()
     close_connection(con, cur)
 
 
@@ -0,0 +1,299 @@
+"""
+This module includes functions for turning rows read from MySQL into Elasticsearch documents.  A converter is
+compiled once per table from the table's schema, so that values already returned by MySQL in the right type
+(integers and strings) are copied straight into the document and only the columns that need it (dates, decimals
+and binary data) are converted.  NULL values become json null.  The converter also records how each document is
+written: with an '_id' derived from the table's key columns, so that re-sending a row overwrites or skips its
+document instead of duplicating it, and with the 'index', 'create' or 'update' (upsert) Bulk API operation.  It
+can also hold lookups into cached dimension tables (see dimension_cache), whose fields are added to each document,
+and columns that are left out of the documents (see es_mappings).  With a partition column, each document is
+written to the daily index of the day in that column (see es_partitions).
+
+Functions:
+    format_datetime: formats a DATETIME value the way the Elasticsearch mapping expects it
+    format_date: formats a DATE value
+    decode_bytes: decodes a binary value
+    column_conversion: returns the function needed to convert a column of a given MySQL type
+    compile_row_converter: compiles a converter for a table from its schema
+    convert_rows: converts rows into Elasticsearch documents
+    document_id: returns the '_id' of a document
+    partition_suffix: returns the suffix of the daily index that a document belongs to
+    partition_index: returns the name of the index that a document is written to
+    bulk_action: returns the Bulk API action for a document
+    bulk_source: returns the Bulk API source line for a document
+    compile_action_header: serializes the parts of the Bulk API action line that are the same for every document
+    serialize_rows: converts rows into '\\n'-delimited Bulk API payloads
+    init_worker_serializer: keeps a converter and action header in a worker process
+    serialize_worker_rows: converts rows into Bulk API payloads with the converter kept by init_worker_serializer
+"""
+
+
+import json
+from dimension_cache import enrich_document
+
+# Bulk API operations: 'index' adds or replaces a document, 'create' only adds it if its _id is new, and 'update'
+# merges the row into the existing document (or adds it, with doc_as_upsert)
+OP_TYPES = ('index', 'create', 'update')
+# Separator between the values of a composite _id
+ID_SEPARATOR = '_'
+# Suffix of the daily index of documents whose partition column is NULL
+UNDATED = 'undated'
+# Stands for the daily suffix in action lines serialized by compile_action_header for a partitioned converter
+PARTITION_MARK = '{partition}'
+
+# Converter and action header of a worker process, set once by init_worker_serializer
+_WORKER_SERIALIZER = {'converter': None, 'header': None}
+
+
+def format_datetime(value):
+    """ Formats a DATETIME value as 'yyyy-MM-dd HH:mm:ss', the date format used in the Elasticsearch mapping """
+    return value.isoformat(' ')[:19]
+
+
+def format_date(value):
+    """ Formats a DATE value as 'yyyy-MM-dd' """
+    return value.isoformat()
+
+
+def decode_bytes(value):
+    """ Decodes a binary value as utf-8 text """
+    return value.decode('utf-8', 'replace')
+
+
+def column_conversion(col_type):
+    """ Returns the function needed to turn a value of a MySQL column type into a json value.
+        Args:
+            col_type (string): MySQL column type, e.g. 'int(11)', 'varchar(100)' or 'datetime'
+        Returns:
+            function, or None if values of this type can be used as they are
+    """
+    col_type = col_type.lower()
+    if col_type.startswith('datetime') or col_type.startswith('timestamp'):
+        return format_datetime
+    elif col_type == 'date':
+        return format_date
+    elif col_type.startswith('decimal') or col_type.startswith('numeric'):
+        return float
+    elif 'blob' in col_type or 'binary' in col_type:
+        return decode_bytes
+    return None
+
+
+def compile_row_converter(schema, id_cols=None, op_type='index', enrichment=None, exclude=None,
+                          partition_col=None):
+    """ Compiles a converter for a table.
+        Args:
+            schema (list of lists): [column name, column type] for each column, as returned by
+                mySQL_connect.read_schema_from_db
+            id_cols (list of strings): columns to derive each document's _id from, e.g. ['logId'] or
+                ['logTime', 'logId'] (None to let Elasticsearch assign random ids)
+            op_type (string): Bulk API operation to use for each document (one of OP_TYPES).  'update' needs
+                id_cols.
+            enrichment (list): dimension lookups to add to each document, created by
+                dimension_cache.compile_enrichment (None for no enrichment)
+            exclude (list of strings): columns to leave out of the documents, e.g. the ones excluded by an
+                es_mappings profile
+            partition_col (string): DATETIME column to route each document by into daily indices, e.g. 'logTime'
+                (None to write every document to the same index)
+        Returns:
+            dictionary with the column names, a list of (column position, column name, function) for the
+            columns whose values need to be converted, the _id columns, the operation, the enrichment lookups,
+            the excluded columns and the partition column
+    """
+    columns = [col[0] for col in schema]
+    if op_type not in OP_TYPES:
+        raise ValueError('unknown bulk operation {}'.format(op_type))
+    if op_type == 'update' and not id_cols:
+        raise ValueError('update operations need id columns')
+    for col in id_cols or []:
+        if col not in columns:
+            raise ValueError('id column {} is not in the table'.format(col))
+        if col in (exclude or []):
+            raise ValueError('id column {} is excluded from the documents'.format(col))
+    exclude = [col for col in exclude or [] if col in columns]
+    if partition_col is not None and (partition_col not in columns or partition_col in exclude):
+        raise ValueError('partition column {} is not in the documents'.format(partition_col))
+    conversions = []
+    for i, col in enumerate(schema):
+        func = column_conversion(col[1]) if col[0] not in exclude else None
+        if func is not None:
+            conversions.append((i, col[0], func))
+    return {'columns': columns, 'conversions': conversions, 'id_cols': list(id_cols or []), 'op_type': op_type,
+            'enrichment': list(enrichment or []), 'exclude': exclude, 'partition_col': partition_col}
+
+
+def convert_rows(converter, rows):
+    """ Converts rows into Elasticsearch documents.
+        Args:
+            converter (dictionary): converter created by compile_row_converter
+            rows (list of tuples): rows fetched from MySQL
+        Yields:
+            dictionary for each row, with column names as keys
+    """
+    columns = converter['columns']
+    conversions = converter['conversions']
+    enrichment = converter.get('enrichment')
+    exclude = converter.get('exclude')
+    for row in rows:
+        doc = dict(zip(columns, row))
+        for position, name, func in conversions:
+            value = row[position]
+            if value is not None:
+                doc[name] = func(value)
+        for name in exclude or ():
+            del doc[name]
+        if enrichment:
+            enrich_document(enrichment, doc)
+        yield doc
+
+
+def document_id(converter, doc):
+    """ Returns the _id of a document: the value of its id column, or the values of its id columns joined by
+        ID_SEPARATOR.  Dates are used as formatted in the document, so the same row always gets the same _id.
+        Args:
+            converter (dictionary): converter created by compile_row_converter, with id columns
+            doc (dictionary): document created by convert_rows
+        Returns:
+            string
+    """
+    return ID_SEPARATOR.join(str(doc[col]) for col in converter['id_cols'])
+
+
+def partition_suffix(value):
+    """ Returns the suffix of the daily index that a document belongs to, 'YYYY.MM.DD', from the value of its
+        partition column as formatted in the document ('yyyy-MM-dd HH:mm:ss'), or UNDATED if the value is NULL
+    """
+    return value[:10].replace('-', '.') if value else UNDATED
+
+
+def partition_index(converter, index_name, doc):
+    """ Returns the name of the index that a document is written to: index_name, or for a converter with a
+        partition column, the daily index '<index_name>-YYYY.MM.DD' of the document's day.
+        Args:
+            converter (dictionary): converter created by compile_row_converter
+            index_name (string): name of the index, or prefix of the daily indices
+            doc (dictionary): document created by convert_rows
+        Returns:
+            string
+    """
+    if not converter.get('partition_col'):
+        return index_name
+    return '{}-{}'.format(index_name, partition_suffix(doc[converter['partition_col']]))
+
+
+def bulk_action(converter, index_name, doc_type_name, doc):
+    """ Returns the Bulk API action for a document.
+        Args:
+            converter (dictionary): converter created by compile_row_converter
+            index_name (string): name of the index the document is written to (see partition_index)
+            doc_type_name (string): name of the document type
+            doc (dictionary): document created by convert_rows
+        Returns:
+            dictionary, e.g. {'index': {'_index': ..., '_type': ..., '_id': ...}}
+    """
+    meta = {'_index': partition_index(converter, index_name, doc), '_type': doc_type_name}
+    if converter['id_cols']:
+        meta['_id'] = document_id(converter, doc)
+    return {converter['op_type']: meta}
+
+
+def bulk_source(converter, doc):
+    """ Returns the Bulk API source line for a document: the document itself, or a partial-document upsert for
+        the 'update' operation.
+        Args:
+            converter (dictionary): converter created by compile_row_converter
+            doc (dictionary): document created by convert_rows
+        Returns:
+            dictionary
+    """
+    if converter['op_type'] == 'update':
+        return {'doc': doc, 'doc_as_upsert': True}
+    return doc
+
+
+def compile_action_header(converter, index_name, doc_type_name):
+    """ Serializes the parts of the Bulk API action line that are the same for every document of a batch, so that
+        only the _id has to be encoded for each document.
+        Args:
+            converter (dictionary): converter created by compile_row_converter
+            index_name (string): name of the index the documents are written to (see partition_index)
+            doc_type_name (string): name of the document type
+        Returns:
+            tuple of bytes: the action line up to the _id value and the rest of the line after it, including its
+                trailing newline.  Without id columns, the first part is the whole line and the second is empty.
+                For a partitioned converter, the index name ends in PARTITION_MARK, which serialize_rows
+                replaces with each document's daily suffix.
+    """
+    if converter.get('partition_col'):
+        index_name = '{}-{}'.format(index_name, PARTITION_MARK)
+    meta = json.dumps({converter['op_type']: {'_index': index_name, '_type': doc_type_name}})
+    if not converter['id_cols']:
+        return (meta + '\n').encode('utf-8'), b''
+    return (meta[:-2] + ', "_id": ').encode('utf-8'), b'}}\n'
+
+
+def serialize_rows(converter, rows, header, max_bytes):
+    """ Converts rows into Bulk API payloads.  Each document is written straight into a bytearray after the
+        action line, and a new payload is started once the current one reaches max_bytes.  All arguments can be
+        pickled, so this function can run in a worker process.
+        Args:
+            converter (dictionary): converter created by compile_row_converter
+            rows (list of tuples): rows fetched from MySQL
+            header (tuple of bytes): serialized action line, split around the _id by compile_action_header
+            max_bytes (integer): payload size at which to start a new payload
+        Returns:
+            list of bytearrays, each holding the body of one Bulk API call
+    """
+    encode = json.JSONEncoder().encode
+    prefix, suffix = header
+    with_id = bool(converter['id_cols'])
+    upsert = converter['op_type'] == 'update'
+    partition_col = converter.get('partition_col')
+    # Action lines of each daily index, with PARTITION_MARK replaced
+    partition_prefixes = {}
+    payloads = []
+    payload = bytearray()
+    for doc in convert_rows(converter, rows):
+        if partition_col:
+            suffix_name = partition_suffix(doc[partition_col])
+            doc_prefix = partition_prefixes.get(suffix_name)
+            if doc_prefix is None:
+                doc_prefix = prefix.replace(PARTITION_MARK.encode('utf-8'), suffix_name.encode('utf-8'))
+                partition_prefixes[suffix_name] = doc_prefix
+            payload += doc_prefix
+        else:
+            payload += prefix
+        if with_id:
+            payload += encode(document_id(converter, doc)).encode('utf-8')
+            payload += suffix
+        payload += encode({'doc': doc, 'doc_as_upsert': True} if upsert else doc).encode('utf-8')
+        payload += b'\n'
+        if len(payload) >= max_bytes:
+            payloads.append(payload)
+            payload = bytearray()
+    if payload:
+        payloads.append(payload)
+    return payloads
+
+
+def init_worker_serializer(converter, header):
+    """ Keeps a converter and action header in a worker process, so that they are pickled once per process
+        instead of with every batch of rows.  Used as the initializer of a process pool.
+        Args:
+            converter (dictionary): converter created by compile_row_converter
+            header (tuple of bytes): serialized action line, split around the _id by compile_action_header
+    """
+    _WORKER_SERIALIZER['converter'] = converter
+    _WORKER_SERIALIZER['header'] = header
+
+
+def serialize_worker_rows(rows, max_bytes):
+    """ Converts rows into Bulk API payloads in a worker process, with the converter and action header kept by
+        init_worker_serializer (see serialize_rows).
+        Args:
+            rows (list of tuples): rows fetched from MySQL
+            max_bytes (integer): payload size at which to start a new payload
+        Returns:
+            list of bytearrays, each holding the body of one Bulk API call
+    """
+    return serialize_rows(_WORKER_SERIALIZER['converter'], rows, _WORKER_SERIALIZER['header'], max_bytes)
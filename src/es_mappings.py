@@ -0,0 +1,173 @@
+"""
+This module includes mapping profiles, which decide how each column of a table is indexed in Elasticsearch, so that
+every string column does not pay for full-text analysis.  Identifiers, enums and other short codes are indexed as
+keyword, DATETIME columns as date and integers as integer or long, while free text keeps being analyzed as text.
+Large blobs are kept in _source for display but are neither indexed nor given doc values, and secrets are left out
+of the documents altogether.  Columns can be declared in a tblMappings file next to tblSchemas; columns that are not
+declared are inferred from their type, their name, and the length and cardinality of a sample of their values.
+Mappings are created with dynamic set to false, so that a field missing from the mapping is kept in _source but
+does not get a mapping of its own.
+
+Functions:
+    import_mappings_from_file: imports the declared field kind of each column from an external text file
+    sample_column_stats: measures the length, spaces and cardinality of a sample of string columns
+    infer_field_kind: infers how a column is indexed from its type, name and sampled values
+    build_profile: builds the mapping profile of a table
+    profile_mapping: generates the Elasticsearch mapping for a mapping profile
+"""
+
+
+import os
+import re
+from dimension_cache import DIMENSIONS, dimensions_for
+from metadata_cache import cached_file
+from mySQL_connect import parse_schemas_file, read_schema_from_db
+
+MAPPINGS_PATH = './tblMappings'
+# 'legacy' is the mapping of es_connect.generate_mapping, with every string column analyzed as text
+MAPPING_PROFILES = ('legacy', 'optimized')
+# Strings longer than this are never keywords, and longer values of keyword fields are not indexed
+KEYWORD_MAX_LENGTH = 256
+# Mapping of each field kind.  'exclude' has none: excluded columns are dropped from the documents.
+FIELD_KINDS = {'integer': {'type': 'integer'},
+               'long': {'type': 'long'},
+               'double': {'type': 'double'},
+               'date': {'type': 'date', 'format': 'yyyy-MM-dd HH:mm:ss||yyyy-MM-dd'},
+               'keyword': {'type': 'keyword', 'ignore_above': KEYWORD_MAX_LENGTH},
+               'text': {'type': 'text'},
+               'stored': {'type': 'keyword', 'index': False, 'doc_values': False},
+               'exclude': None}
+# Rows read from a table to infer the kind of its string columns
+SAMPLE_ROWS = 10000
+# Strings with spaces are still keywords if they have at most this many distinct values per sampled value
+KEYWORD_CARDINALITY = 0.05
+# Column names of secrets, which are excluded, and of identifiers and enums, which are keywords
+SECRET_NAME = re.compile('password', re.IGNORECASE)
+IDENTIFIER_NAME = re.compile('(id|uid|type|status|priority|email|phone|address|zone|offset)$', re.IGNORECASE)
+
+
+def import_mappings_from_file(path=MAPPINGS_PATH):
+    """ Imports the declared field kind of each column from an external text file with the same layout as
+        tblSchemas: a 'tblname <table>' line, then '<column name> <field kind>' lines (e.g. 'device_id keyword'),
+        where the kind is one of FIELD_KINDS.  Only the columns whose inferred kind is not right need to be
+        declared.  The file is optional, and is parsed again only if it is modified.
+        Returns:
+            dictionary of column name to field kind for each table"""
+    if not os.path.exists(path):
+        return {}
+    mappings = {}
+    for table, columns in cached_file(path, parse_schemas_file).items():
+        mappings[table] = {}
+        for name, kind in columns:
+            if kind not in FIELD_KINDS:
+                raise ValueError('unknown field kind {} for {}.{} in {}'.format(kind, table, name, path))
+            mappings[table][name] = kind
+    return mappings
+
+
+def sample_column_stats(cur, table, columns, sample_rows=SAMPLE_ROWS):
+    """ Measures the values of string columns in a sample of a table's rows.
+        Args:
+            cur (cursor object): MySQL cursor object that is connected to the database
+            table (string): name of the table
+            columns (list of strings): string columns to measure
+            sample_rows (integer): number of rows to read
+        Returns:
+            dictionary with, for each column, the number of non-NULL values sampled, the number of distinct
+            values, the length of the longest value and whether any value has a space in it
+    """
+    if not columns:
+        return {}
+    cur.execute("""SELECT {} FROM {} LIMIT %s""".format(', '.join(columns), table), [sample_rows])
+    rows = cur.fetchall()
+    stats = {}
+    for i, name in enumerate(columns):
+        values = [row[i] for row in rows if row[i] is not None]
+        stats[name] = {'count': len(values), 'distinct': len(set(values)),
+                       'max_length': max([len(value) for value in values] or [0]),
+                       'spaces': any(' ' in value for value in values)}
+    return stats
+
+
+def infer_field_kind(name, col_type, stats=None):
+    """ Infers how a column is indexed.  Numbers and dates get their own types, string secrets are excluded,
+        blobs are stored without being indexed, and identifiers and enums are keywords.  Other strings are
+        keywords if their sampled values are short and either have no spaces or only a few distinct values, and
+        text otherwise.
+        Args:
+            name (string): name of the column
+            col_type (string): MySQL column type, e.g. 'int(11)', 'varchar(100)' or 'longtext'
+            stats (dictionary): values of the column measured by sample_column_stats (None if not sampled)
+        Returns:
+            string: a key of FIELD_KINDS
+    """
+    col_type = col_type.lower()
+    if col_type.startswith('bigint'):
+        return 'long'
+    elif 'int' in col_type:
+        return 'integer'
+    elif col_type.startswith(('decimal', 'numeric', 'float', 'double')):
+        return 'double'
+    elif col_type.startswith(('datetime', 'timestamp', 'date')):
+        return 'date'
+    elif SECRET_NAME.search(name):
+        return 'exclude'
+    elif 'blob' in col_type or col_type in ('mediumtext', 'longtext'):
+        return 'stored'
+    elif IDENTIFIER_NAME.search(name):
+        return 'keyword'
+    elif stats and stats['count'] and stats['max_length'] <= KEYWORD_MAX_LENGTH and \
+            (not stats['spaces'] or stats['distinct'] <= KEYWORD_CARDINALITY * stats['count']):
+        return 'keyword'
+    return 'text'
+
+
+def _infer_fields(cur, table, schema, declared, sample_rows):
+    """ Returns the field kind of each column of a schema, declared or inferred, sampling the columns that need it """
+    undecided = [name for name, col_type in schema
+                 if name not in declared and infer_field_kind(name, col_type) == 'text']
+    stats = sample_column_stats(cur, table, undecided, sample_rows) if sample_rows else {}
+    return [(name, declared.get(name) or infer_field_kind(name, col_type, stats.get(name)))
+            for name, col_type in schema]
+
+
+def build_profile(cur, table, name='optimized', dimensions=None, path=MAPPINGS_PATH, sample_rows=SAMPLE_ROWS):
+    """ Builds the mapping profile of a table.
+        Args:
+            cur (cursor object): MySQL cursor object that is connected to the database
+            table (string): name of the table
+            name (string): name of the profile (one of MAPPING_PROFILES)
+            dimensions (dictionary): cached dimension tables that documents are enriched with (see
+                dimension_cache.load_dimensions).  The columns they add are mapped as well.
+            path (string): path of the file of declared field kinds
+            sample_rows (integer): number of rows to sample to infer string columns (0 to infer from types and
+                names only)
+        Returns:
+            dictionary with the profile name, a list of (column name, field kind) and the excluded columns, or
+            None for the legacy profile
+    """
+    if name not in MAPPING_PROFILES:
+        raise ValueError('unknown mapping profile {}'.format(name))
+    if name == 'legacy':
+        return None
+    declared = import_mappings_from_file(path)
+    fields = _infer_fields(cur, table, read_schema_from_db(cur, table), declared.get(table, {}), sample_rows)
+    for dimension in dimensions_for(table) if dimensions else []:
+        columns = set(DIMENSIONS[dimension]['columns'])
+        schema = [col for col in read_schema_from_db(cur, dimension) if col[0] in columns]
+        mapped = set(field for field, kind in fields)
+        fields += [field for field in _infer_fields(cur, dimension, schema, declared.get(dimension, {}), sample_rows)
+                   if field[0] not in mapped]
+    return {'name': name, 'fields': fields, 'exclude': [field for field, kind in fields if kind == 'exclude']}
+
+
+def profile_mapping(profile, doc_type_name):
+    """ Generates the mapping for a mapping profile, to be used in creating an index in Elasticsearch.
+        Args:
+            profile (dictionary): profile returned by build_profile
+            doc_type_name (string): name to be used for the doc_type assigned to the table in Elasticsearch
+        Returns:
+            dictionary with the body of the create index request
+    """
+    properties = {field: dict(FIELD_KINDS[kind]) for field, kind in profile['fields'] if FIELD_KINDS[kind]}
+    return {'mappings': {doc_type_name: {'dynamic': False, 'properties': properties}}}
@@ -0,0 +1,252 @@
+"""
+This module includes functions for instrumenting a migration while it runs.  Every batch adds its time in each
+stage (MySQL read, action generation and Elasticsearch) to a histogram, the outcome of its Bulk API calls to
+running counts of documents, bytes, retries and rejections, and pipelined migrations report how many batches are
+waiting in each queue.  The metrics can be served as a Prometheus-style text endpoint or printed as periodic
+json log lines, so that the stage holding up a long migration can be seen while it runs.
+
+Functions:
+    new_metrics: creates the dictionary that holds the metrics of a migration
+    observe: adds a sample to a histogram
+    record_bulk_stats: adds the outcome of Bulk API calls to the metrics
+    set_gauge: sets the current value of a gauge, e.g. a queue depth
+    increment: adds to a counter
+    percentile: returns a percentile of a list of samples
+    metrics_snapshot: returns the current totals, rates and percentiles
+    format_log_line: formats the current metrics as a json log line
+    format_prometheus: formats the current metrics in the Prometheus text exposition format
+    start_metrics_server: serves the metrics as a Prometheus-style text endpoint
+    start_metrics_logger: prints a log line with the current metrics at a fixed interval
+"""
+
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import json
+import threading
+import time
+
+# Histograms recorded for every batch: the time spent in each stage and the latency of each Bulk API call
+HISTOGRAMS = ('sql', 'actions', 'es', 'bulk_latency')
+COUNTERS = ('batches', 'docs', 'indexed', 'retried', 'failed', 'rejections', 'bytes', 'sent_bytes')
+PERCENTILES = (50, 95, 99)
+# Upper bounds, in seconds, of the histogram buckets in the Prometheus output
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_PREFIX = 'es_migration'
+
+
+def new_metrics(table=None):
+    """ Creates the dictionary that holds the metrics of a migration.
+        Args:
+            table (string): name of the table being migrated, included in the log lines and metric labels
+        Returns:
+            dictionary with a lock, the start time, a list of samples for each histogram, the counters and the
+            gauges
+    """
+    return {'lock': threading.Lock(), 'table': table, 'started': time.time(),
+            'histograms': {name: [] for name in HISTOGRAMS}, 'counters': {name: 0 for name in COUNTERS},
+            'gauges': {}}
+
+
+def observe(metrics, name, value):
+    """ Adds a sample to a histogram.
+        Args:
+            metrics (dictionary): metrics created by new_metrics (None to do nothing)
+            name (string): name of the histogram, e.g. 'sql'
+            value (float): sample, in seconds
+    """
+    if metrics is None:
+        return
+    with metrics['lock']:
+        metrics['histograms'].setdefault(name, []).append(value)
+
+
+def record_bulk_stats(metrics, stats):
+    """ Adds the outcome of one batch of Bulk API calls to the metrics.
+        Args:
+            metrics (dictionary): metrics created by new_metrics (None to do nothing)
+            stats (dictionary): bulk submission counts for the batch (see es_bulk.new_bulk_stats)
+    """
+    if metrics is None:
+        return
+    with metrics['lock']:
+        counters = metrics['counters']
+        counters['batches'] += 1
+        for name in ('docs', 'indexed', 'retried', 'failed', 'rejections', 'bytes', 'sent_bytes'):
+            counters[name] += stats[name]
+        metrics['histograms']['bulk_latency'].extend(stats['latencies'])
+
+
+def set_gauge(metrics, name, value):
+    """ Sets the current value of a gauge.
+        Args:
+            metrics (dictionary): metrics created by new_metrics (None to do nothing)
+            name (string): name of the gauge, e.g. 'row_queue_depth'
+            value (number): current value
+    """
+    if metrics is None:
+        return
+    with metrics['lock']:
+        metrics['gauges'][name] = value
+
+
+def increment(metrics, name, value=1):
+    """ Adds to a counter, creating it if it is not one of COUNTERS.
+        Args:
+            metrics (dictionary): metrics created by new_metrics (None to do nothing)
+            name (string): name of the counter, e.g. 'late'
+            value (number): amount to add
+    """
+    if metrics is None:
+        return
+    with metrics['lock']:
+        metrics['counters'][name] = metrics['counters'].get(name, 0) + value
+
+
+def percentile(samples, pct):
+    """ Returns a percentile of a list of samples, using the nearest-rank method.
+        Args:
+            samples (list of floats): samples, in any order
+            pct (number): percentile between 0 and 100
+        Returns:
+            float, or None if there are no samples
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(1, int(-(-pct * len(ordered) // 100)))
+    return ordered[rank - 1]
+
+
+def metrics_snapshot(metrics):
+    """ Returns the current totals, rates and percentiles.
+        Args:
+            metrics (dictionary): metrics created by new_metrics
+        Returns:
+            dictionary with the table, the elapsed time, the counters, documents and bytes per second, the
+            gauges, and the count, sum and percentiles of each histogram
+    """
+    with metrics['lock']:
+        elapsed = time.time() - metrics['started']
+        counters = dict(metrics['counters'])
+        gauges = dict(metrics['gauges'])
+        histograms = {name: list(samples) for name, samples in metrics['histograms'].items()}
+    snapshot = {'table': metrics['table'], 'elapsed': round(elapsed, 3), 'counters': counters, 'gauges': gauges,
+                'docs_per_sec': round(counters['indexed'] / elapsed, 1) if elapsed > 0 else 0,
+                'bytes_per_sec': round(counters['sent_bytes'] / elapsed, 1) if elapsed > 0 else 0,
+                'histograms': {}}
+    for name, samples in histograms.items():
+        summary = {'count': len(samples), 'sum': round(sum(samples), 4)}
+        for pct in PERCENTILES:
+            value = percentile(samples, pct)
+            summary['p{}'.format(pct)] = round(value, 4) if value is not None else None
+        snapshot['histograms'][name] = summary
+    return snapshot
+
+
+def format_log_line(metrics):
+    """ Formats the current metrics as a single json log line.
+        Args:
+            metrics (dictionary): metrics created by new_metrics
+        Returns:
+            string
+    """
+    return json.dumps(metrics_snapshot(metrics), sort_keys=True)
+
+
+def format_prometheus(metrics):
+    """ Formats the current metrics in the Prometheus text exposition format.  Histograms are exposed with
+        cumulative BUCKETS, and their percentiles are also exposed as a separate <name>_quantile gauge.
+        Args:
+            metrics (dictionary): metrics created by new_metrics
+        Returns:
+            string
+    """
+    with metrics['lock']:
+        counters = dict(metrics['counters'])
+        gauges = dict(metrics['gauges'])
+        histograms = {name: list(samples) for name, samples in metrics['histograms'].items()}
+        elapsed = time.time() - metrics['started']
+    labels = 'table="{}"'.format(metrics['table']) if metrics['table'] else ''
+    lines = []
+    for name, value in sorted(counters.items()):
+        metric = '{}_{}_total'.format(METRIC_PREFIX, name)
+        lines += ['# TYPE {} counter'.format(metric), '{}{{{}}} {}'.format(metric, labels, value)]
+    for name, value in [('docs_per_second', counters['indexed'] / elapsed if elapsed > 0 else 0),
+                        ('bytes_per_second', counters['sent_bytes'] / elapsed if elapsed > 0 else 0)] + \
+            sorted(gauges.items()):
+        metric = '{}_{}'.format(METRIC_PREFIX, name)
+        lines += ['# TYPE {} gauge'.format(metric), '{}{{{}}} {}'.format(metric, labels, value)]
+    separator = ',' if labels else ''
+    for name, samples in sorted(histograms.items()):
+        metric = '{}_{}_seconds'.format(METRIC_PREFIX, name)
+        lines.append('# TYPE {} histogram'.format(metric))
+        for bound in BUCKETS:
+            count = sum(1 for sample in samples if sample <= bound)
+            lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(metric, labels, separator, bound, count))
+        lines.append('{}_bucket{{{}{}le="+Inf"}} {}'.format(metric, labels, separator, len(samples)))
+        lines.append('{}_sum{{{}}} {}'.format(metric, labels, sum(samples)))
+        lines.append('{}_count{{{}}} {}'.format(metric, labels, len(samples)))
+        if samples:
+            lines.append('# TYPE {}_quantile gauge'.format(metric))
+            for pct in PERCENTILES:
+                lines.append('{}_quantile{{{}{}quantile="{}"}} {}'.format(metric, labels, separator, pct / 100.0,
+                                                                           percentile(samples, pct)))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server that handles each connection in its own thread """
+    daemon_threads = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Serves the metrics held by the server on GET /metrics """
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = format_prometheus(self.server.metrics).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(metrics, port):
+    """ Serves the metrics on http://<host>:<port>/metrics in a background thread.
+        Args:
+            metrics (dictionary): metrics created by new_metrics
+            port (integer): port to listen on (0 to pick a free port)
+        Returns:
+            server object.  server.server_port is the port it listens on and server.shutdown() stops it.
+    """
+    server = MetricsServer(('', port), MetricsHandler)
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def start_metrics_logger(metrics, interval):
+    """ Prints a json log line with the current metrics every <interval> seconds in a background thread.
+        Args:
+            metrics (dictionary): metrics created by new_metrics
+            interval (float): seconds between log lines
+        Returns:
+            threading.Event object.  Setting it stops the logger.
+    """
+    stop = threading.Event()
+
+    def log_metrics():
+        while not stop.wait(interval):
+            print('metrics ' + format_log_line(metrics))
+    thread = threading.Thread(target=log_metrics)
+    thread.daemon = True
+    thread.start()
+    return stop
@@ -0,0 +1,226 @@
+"""
+This module includes functions for time-partitioned indices, so that the log tables are indexed into many small
+indices instead of a single index holding their whole history.  Searches over the last hour or day only touch the
+newest indices, bulk loads write to small hot indices, and old data is removed by deleting whole indices instead
+of deleting documents.  Two layouts are supported.  With daily partitioning, each document is routed by the value of
+its time column into <table>_index-YYYY.MM.DD, which is created from an index template on its first document, so
+that backfills of old rows land in the right day.  With rollover partitioning, documents are written in arrival
+order to the <table>_write alias, which moves to a new index (<table>_index-000002, ...) once the current one is
+old or large enough, as suits streaming ingestion.  In both layouts the template adds every partition to the
+<table>_index read alias, so searches keep using the same name.  A table is either partitioned or loaded into
+single versioned indices (<table>_index_v<timestamp>), never both, so that the read alias does not return the same
+rows twice.
+
+Functions:
+    partition_names: returns the read alias, the write alias and the name pattern of a table's partitions
+    partition_template: returns the index template for a table's partitions
+    put_partition_template: creates or replaces the index template for a table's partitions
+    is_partitioned: returns whether a table has an index template for partitions
+    detach_unpartitioned_indices: removes the indices that are not partitions from a table's read alias
+    bootstrap_rollover: creates the first rollover partition of a table and its write alias
+    rollover_partition: moves a table's write alias to a new partition if the current one meets a condition
+    daily_indices: returns the daily partitions that cover a time window
+    expired_partitions: returns the partitions of a table that are older than the retention period
+    apply_retention: deletes the partitions of a table that are older than the retention period
+"""
+
+
+from datetime import datetime, timedelta
+import re
+import threading
+import time
+
+# Column that each log table is partitioned on
+TIME_COLUMNS = {'ee_log': 'logTime',
+                'ee_audit_events': 'timestamp',
+                'scribeuxmetricsconnectivity': 'eventTime'}
+PARTITIONINGS = ('daily', 'rollover')
+# Settings of every partition.  Partitions are small, so one shard each is enough, and they are searched while
+# they are being written to, so they keep the normal refresh interval and a replica.
+PARTITION_SETTINGS = {'number_of_shards': 1, 'number_of_replicas': 1, 'refresh_interval': '1s'}
+# A rollover partition is closed once it meets any of these conditions
+ROLLOVER_CONDITIONS = {'max_age': '1d', 'max_docs': 50000000}
+# Number of days partitions are kept for
+RETENTION_DAYS = 90
+# Date format of daily partition names, and the pattern of their suffix
+DAILY_FORMAT = '%Y.%m.%d'
+DAILY_SUFFIX = re.compile(r'-(\d{4}\.\d{2}\.\d{2})$')
+
+_ROLLOVER_LOCK = threading.Lock()
+
+
+def partition_names(table):
+    """ Returns the read alias, the write alias and the name pattern of a table's partitions """
+    return table + '_index', table + '_write', table + '_index-*'
+
+
+def partition_template(table, mapping, settings=None):
+    """ Returns the index template for a table's partitions.
+        Args:
+            table (string): name of the table
+            mapping (dictionary): body of a create index request with the table's mappings (see
+                es_connect.generate_mapping and es_mappings.profile_mapping)
+            settings (dictionary): index settings of each partition (defaults to PARTITION_SETTINGS)
+        Returns:
+            dictionary with the body of the put template request
+    """
+    read_alias, write_alias, pattern = partition_names(table)
+    return {'index_patterns': [pattern], 'settings': dict(settings or PARTITION_SETTINGS),
+            'mappings': mapping['mappings'], 'aliases': {read_alias: {}}}
+
+
+def put_partition_template(es, table, mapping, settings=None):
+    """ Creates or replaces the index template for a table's partitions.  The template only applies to partitions
+        created after it, so a new mapping takes effect from the next day or the next rollover.
+        Args:
+            es (Elasticsearch object): client of the cluster
+            table (string): name of the table
+            mapping (dictionary): body of a create index request with the table's mappings
+            settings (dictionary): index settings of each partition (defaults to PARTITION_SETTINGS)
+    """
+    read_alias = partition_names(table)[0]
+    if es.indices.exists(index=read_alias) and not es.indices.exists_alias(name=read_alias):
+        raise ValueError('{} is an index, not an alias; migrate {} once without partitioning to turn it into '
+                         'an alias'.format(read_alias, table))
+    es.indices.put_template(name=table + '_partitions', body=partition_template(table, mapping, settings))
+
+
+def is_partitioned(es, table):
+    """ Returns whether a table has an index template for partitions, i.e. whether it has been loaded with
+        partitioning.  Delete the <table>_partitions template to go back to loading single versioned indices.
+        Args:
+            es (Elasticsearch object): client of the cluster
+            table (string): name of the table
+        Returns:
+            boolean
+    """
+    return es.indices.exists_template(name=table + '_partitions')
+
+
+def detach_unpartitioned_indices(es, table):
+    """ Removes the indices that are not partitions, such as the versioned index of an earlier migration, from a
+        table's read alias, so that searches do not see their rows as well as the same rows in the partitions.
+        The indices are kept until they are deleted by hand.
+        Args:
+            es (Elasticsearch object): client of the cluster
+            table (string): name of the table
+        Returns:
+            list of strings: names of the detached indices
+    """
+    read_alias, write_alias, pattern = partition_names(table)
+    if not es.indices.exists_alias(name=read_alias):
+        return []
+    detached = sorted(name for name in es.indices.get_alias(name=read_alias) if not name.startswith(pattern[:-1]))
+    if detached:
+        es.indices.update_aliases(body={'actions': [{'remove': {'index': name, 'alias': read_alias}}
+                                                    for name in detached]})
+        print('Removed {} from {}; delete {} once the partitions hold their rows'.format(
+            ', '.join(detached), read_alias, 'them' if len(detached) > 1 else 'it'))
+    return detached
+
+
+def bootstrap_rollover(es, table):
+    """ Creates the first rollover partition of a table, <table>_index-000001, with the <table>_write alias on it,
+        unless the write alias already exists.
+        Args:
+            es (Elasticsearch object): client of the cluster
+            table (string): name of the table
+        Returns:
+            string: name of the write alias
+    """
+    read_alias, write_alias, pattern = partition_names(table)
+    if not es.indices.exists_alias(name=write_alias):
+        es.indices.create(index='{}-000001'.format(read_alias), body={'aliases': {write_alias: {}}})
+    return write_alias
+
+
+def rollover_partition(es, table, conditions=None):
+    """ Moves a table's write alias to a new partition if the current one meets any of the rollover conditions.
+        Elasticsearch checks the conditions, so calling this after every batch is cheap.
+        Args:
+            es (Elasticsearch object): client of the cluster
+            table (string): name of the table
+            conditions (dictionary): rollover conditions, e.g. {'max_age': '1d', 'max_docs': 1000000} (defaults to
+                ROLLOVER_CONDITIONS)
+        Returns:
+            string: name of the new partition, or None if the write alias did not move
+    """
+    with _ROLLOVER_LOCK:
+        response = es.indices.rollover(alias=partition_names(table)[1],
+                                       body={'conditions': conditions or ROLLOVER_CONDITIONS})
+    if response.get('rolled_over'):
+        print('Rolled {} over from {} to {}'.format(table, response['old_index'], response['new_index']))
+        return response['new_index']
+    return None
+
+
+def daily_indices(table, start, end):
+    """ Returns the daily partitions that cover a time window, so that a search over a recent window only opens
+        those partitions instead of every partition behind the read alias.  Search with ignore_unavailable, as
+        days without documents have no partition.
+        Args:
+            table (string): name of the table
+            start (datetime object): start of the window
+            end (datetime object): end of the window
+        Returns:
+            list of strings
+    """
+    read_alias = partition_names(table)[0]
+    day = datetime(start.year, start.month, start.day)
+    names = []
+    while day <= end:
+        names.append('{}-{}'.format(read_alias, day.strftime(DAILY_FORMAT)))
+        day += timedelta(days=1)
+    return names
+
+
+def expired_partitions(es, table, retention_days=RETENTION_DAYS, now=None):
+    """ Returns the partitions of a table that are older than the retention period.  Daily partitions are dated by
+        their name and rollover partitions by their creation date; the partition behind the write alias and the
+        partition of undated documents are never expired.
+        Args:
+            es (Elasticsearch object): client of the cluster
+            table (string): name of the table
+            retention_days (float): number of days partitions are kept for
+            now (float): current time as a Unix timestamp (defaults to the time of the call)
+        Returns:
+            list of strings, sorted
+    """
+    read_alias, write_alias, pattern = partition_names(table)
+    cutoff = (now or time.time()) - retention_days * 86400
+    settings = es.indices.get_settings(index=pattern, name='index.creation_date')
+    write_indices = set(es.indices.get_alias(name=write_alias)) if es.indices.exists_alias(name=write_alias) \
+        else set()
+    expired = []
+    for name, index in settings.items():
+        if name in write_indices:
+            continue
+        day = DAILY_SUFFIX.search(name)
+        if day:
+            # A daily partition expires once its last document is older than the cutoff
+            created = (datetime.strptime(day.group(1), DAILY_FORMAT) + timedelta(days=1) -
+                       datetime(1970, 1, 1)).total_seconds()
+        elif re.search(r'-\d+$', name):
+            created = int(index['settings']['index']['creation_date']) / 1000.0
+        else:
+            continue
+        if created < cutoff:
+            expired.append(name)
+    return sorted(expired)
+
+
+def apply_retention(es, table, retention_days=RETENTION_DAYS, now=None):
+    """ Deletes the partitions of a table that are older than the retention period (see expired_partitions).
+        Args:
+            es (Elasticsearch object): client of the cluster
+            table (string): name of the table
+            retention_days (float): number of days partitions are kept for
+            now (float): current time as a Unix timestamp (defaults to the time of the call)
+        Returns:
+            list of strings: names of the deleted partitions
+    """
+    expired = expired_partitions(es, table, retention_days, now)
+    if expired:
+        es.indices.delete(index=','.join(expired))
+        print('Deleted {} partitions of {} older than {} days'.format(len(expired), table, retention_days))
+    return expired
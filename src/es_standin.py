@@ -0,0 +1,297 @@
+"""
+This module includes a local stand-in for an Elasticsearch node, so that bulk submission can be tested and
+benchmarked without a cluster.  It accepts Bulk API calls on /_bulk and /<index>/_bulk over keep-alive HTTP/1.1,
+counts the documents it receives, and answers with a Bulk API response in which every document was created, or,
+at a configurable rate, rejected with a 429 as a busy node would.  It keeps track of the indices (and when they
+were created), aliases and index templates it is asked to create, so that create_index, finalize_index and the
+partition functions work against it and their effect can be checked: documents sent to an index that does not
+exist create it, with the aliases of the templates that match its name, as Elasticsearch does.  Other settings
+calls are acknowledged.  Bulk calls made with refresh=wait_for are answered at the next simulated refresh, as a
+node with a refresh interval would.  Bulk responses can be sent with chunked transfer encoding, and the whole of a
+bulk call can be answered with a given HTTP status (e.g. 429 or 503), so that clients can be tested against what a
+real node sends.
+
+Functions:
+    start_standin: starts a stand-in node in a background thread
+    main: uses argparse to set up a command line interface for this module
+"""
+
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from argparse import ArgumentParser
+from fnmatch import fnmatch
+import json
+import random
+import threading
+import time
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server that handles each connection in its own thread """
+    daemon_threads = True
+
+
+class BulkHandler(BaseHTTPRequestHandler):
+    """ Handles requests to the stand-in node.  Settings and counters live on the server object. """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def send_json(self, status, body, chunked=False):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        if chunked:
+            # Split the body in two chunks, so that clients have to join them
+            for chunk in (data[:len(data) // 2], data[len(data) // 2:], b''):
+                self.wfile.write('{:x}\r\n'.format(len(chunk)).encode('latin-1') + chunk + b'\r\n')
+        else:
+            self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def path_parts(self):
+        return [part for part in self.path.split('?')[0].split('/') if part]
+
+    def create_index(self, name, aliases=()):
+        """ Creates an index with the given aliases and those of the templates that match its name.  Called with
+            server.lock held.
+        """
+        self.server.indices[name] = 0
+        self.server.creation_dates[name] = int(time.time() * 1000)
+        for template in self.server.templates.values():
+            if any(fnmatch(name, pattern) for pattern in template.get('index_patterns', [])):
+                aliases = list(aliases) + list(template.get('aliases', {}))
+        for alias in aliases:
+            self.server.aliases.setdefault(alias, set()).add(name)
+
+    def resolve_index(self, name):
+        """ Returns the index that documents sent to an index or alias are written to, creating the index if
+            neither exists, or None if the alias points to more than one index.  Called with server.lock held.
+        """
+        if name in self.server.indices:
+            return name
+        if name in self.server.aliases:
+            indices = self.server.aliases[name]
+            return next(iter(indices)) if len(indices) == 1 else None
+        self.create_index(name)
+        return name
+
+    def update_aliases(self, actions):
+        with self.server.lock:
+            for action in actions:
+                (kind, target), = action.items()
+                if kind == 'add':
+                    self.server.aliases.setdefault(target['alias'], set()).add(target['index'])
+                elif kind == 'remove':
+                    self.server.aliases.get(target['alias'], set()).discard(target['index'])
+                elif kind == 'remove_index':
+                    self.delete_index(target['index'])
+
+    def delete_index(self, name):
+        """ Deletes an index and removes it from every alias.  Called with server.lock held. """
+        found = self.server.indices.pop(name, None) is not None
+        self.server.creation_dates.pop(name, None)
+        for indices in self.server.aliases.values():
+            indices.discard(name)
+        return found
+
+    def do_POST(self):
+        body = self.read_body()
+        parts = self.path_parts()
+        if parts == ['_aliases']:
+            self.update_aliases(json.loads(body.decode('utf-8'))['actions'])
+            self.send_json(200, {'acknowledged': True})
+            return
+        if not parts or parts[-1] != '_bulk':
+            self.send_json(200, {'acknowledged': True})
+            return
+        with self.server.lock:
+            status = self.server.bulk_statuses.pop(0) if self.server.bulk_statuses else None
+            if status is not None:
+                self.server.requests += 1
+        if status is not None:
+            self.send_json(status, {'error': {'type': 'stand_in_exception', 'reason': 'answered with status {}'.format(
+                status)}, 'status': status}, self.server.chunked)
+            return
+        path_index = parts[0] if len(parts) > 1 else None
+        lines = [line for line in body.split(b'\n') if line]
+        actions = [json.loads(line.decode('utf-8')) for line in lines[0::2]]
+        # Simulate indexing time: a fixed cost per call plus a cost per megabyte of payload
+        time.sleep(self.server.latency + self.server.latency_per_mb * len(body) / 1024.0 / 1024.0)
+        if 'refresh=wait_for' in self.path and self.server.refresh_interval:
+            # The documents become searchable at the next refresh
+            time.sleep(self.server.refresh_interval - time.time() % self.server.refresh_interval)
+        items = []
+        rejected = 0
+        failed = 0
+        with self.server.lock:
+            for action in actions:
+                op_type, meta = next(iter(action.items()))
+                index = self.resolve_index(meta.get('_index') or path_index)
+                result = {'_index': index, '_type': meta.get('_type'), '_id': meta.get('_id'), 'status': 201}
+                if index is None:
+                    result['status'] = 400
+                    result['error'] = {'type': 'illegal_argument_exception',
+                                       'reason': 'alias [{}] has more than one index associated with it'.format(
+                                           meta.get('_index') or path_index)}
+                    failed += 1
+                elif self.server.rejection_rate and random.random() < self.server.rejection_rate:
+                    result['status'] = 429
+                    result['error'] = {'type': 'es_rejected_execution_exception', 'reason': 'rejected by stand-in'}
+                    rejected += 1
+                else:
+                    self.server.indices[index] += 1
+                items.append({op_type: result})
+            self.server.docs += len(items) - rejected - failed
+            self.server.rejections += rejected
+            self.server.requests += 1
+            self.server.bytes_received += len(body)
+        self.send_json(200, {'took': 1, 'errors': rejected + failed > 0, 'items': items}, self.server.chunked)
+
+    def do_PUT(self):
+        body = self.read_body()
+        body = json.loads(body.decode('utf-8')) if body else {}
+        parts = self.path_parts()
+        with self.server.lock:
+            if len(parts) == 2 and parts[0] == '_template':
+                self.server.templates[parts[1]] = body
+            elif len(parts) == 1:
+                if parts[0] in self.server.indices:
+                    self.send_json(400, {'error': {'type': 'resource_already_exists_exception'}, 'status': 400})
+                    return
+                self.create_index(parts[0], body.get('aliases', {}))
+        self.send_json(200, {'acknowledged': True})
+
+    def do_DELETE(self):
+        parts = self.path_parts()
+        with self.server.lock:
+            found = all([self.delete_index(name) for name in parts[0].split(',')]) if len(parts) == 1 else True
+        if found:
+            self.send_json(200, {'acknowledged': True})
+        else:
+            self.send_json(404, {'error': {'type': 'index_not_found_exception'}, 'status': 404})
+
+    def do_HEAD(self):
+        parts = self.path_parts()
+        with self.server.lock:
+            if not parts:
+                found = True
+            elif parts[0] == '_alias':
+                found = bool(self.server.aliases.get(parts[1]))
+            elif parts[0] == '_template':
+                found = parts[1] in self.server.templates
+            elif len(parts) == 3 and parts[1] == '_alias':
+                found = parts[0] in self.server.aliases.get(parts[2], set())
+            else:
+                found = parts[0] in self.server.indices or bool(self.server.aliases.get(parts[0]))
+        self.send_json(200 if found else 404, {})
+
+    def do_GET(self):
+        parts = self.path_parts()
+        if parts and parts[0] == '_alias':
+            with self.server.lock:
+                indices = sorted(self.server.aliases.get(parts[1], set()))
+            if not indices:
+                self.send_json(404, {'error': 'alias [{}] missing'.format(parts[1]), 'status': 404})
+            else:
+                self.send_json(200, {name: {'aliases': {parts[1]: {}}} for name in indices})
+            return
+        if len(parts) >= 2 and parts[1] == '_settings':
+            # Only the creation date is kept for each index
+            with self.server.lock:
+                names = [name for name in self.server.indices
+                         if any(fnmatch(name, pattern) for pattern in parts[0].split(','))]
+                self.send_json(200, {name: {'settings': {'index': {
+                    'creation_date': str(self.server.creation_dates[name])}}} for name in names})
+            return
+        self.send_json(200, {'name': 'standin', 'version': {'number': '6.2.0'}, 'docs': self.server.docs,
+                             'rejections': self.server.rejections, 'requests': self.server.requests})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_standin(port=0, latency=0.0, latency_per_mb=0.0, rejection_rate=0.0, refresh_interval=0.0, chunked=False):
+    """ Starts a stand-in Elasticsearch node in a background thread.
+        Args:
+            port (integer): port to listen on (0 to pick a free port)
+            latency (float): seconds to wait before answering each Bulk API call
+            latency_per_mb (float): additional seconds to wait for each megabyte of bulk payload
+            rejection_rate (float): fraction of documents to reject with a 429, between 0 and 1
+            refresh_interval (float): seconds between simulated refreshes, which bulk calls made with
+                refresh=wait_for wait for (0 to answer them straight away)
+            chunked (boolean): if True, bulk responses are sent with chunked transfer encoding instead of a
+                Content-Length header
+        Returns:
+            server object.  server.server_port is the port it listens on, server.docs, server.rejections,
+            server.requests and server.bytes_received count the documents accepted, the documents rejected, the
+            Bulk API calls and the bytes of bulk payload received, server.indices holds the number of documents in
+            each index, server.aliases the indices behind each alias and server.templates the body of each index
+            template, server.creation_dates the creation time of each index in milliseconds since the epoch (which
+            GET /<index>/_settings reports), and server.connections counts the connections accepted.  HTTP statuses
+            appended to server.bulk_statuses answer the next Bulk API calls, one each, without indexing anything.
+            server.shutdown() stops it.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), BulkHandler)
+    server.latency = latency
+    server.latency_per_mb = latency_per_mb
+    server.rejection_rate = rejection_rate
+    server.refresh_interval = refresh_interval
+    server.chunked = chunked
+    server.bulk_statuses = []
+    server.connections = 0
+    server.lock = threading.Lock()
+    server.docs = 0
+    server.rejections = 0
+    server.requests = 0
+    server.bytes_received = 0
+    server.indices = {}
+    server.creation_dates = {}
+    server.aliases = {}
+    server.templates = {}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    """
+    Uses argparse to implement a command line interface for the functions in this module.
+    """
+    parser = ArgumentParser(description='Local stand-in for an Elasticsearch node')
+    parser.add_argument('-p', '--port', type=int, default=9200, help='port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before answering each bulk call')
+    parser.add_argument('--latency_per_mb', type=float, default=0.0, help='additional seconds to wait for each '
+                                                                          'megabyte of bulk payload')
+    parser.add_argument('--rejection_rate', type=float, default=0.0, help='fraction of documents to reject with a '
+                                                                          '429 (es_rejected_execution_exception)')
+    parser.add_argument('--refresh_interval', type=float, default=0.0, help='seconds between simulated refreshes, '
+                                                                            'waited for by refresh=wait_for calls')
+    parser.add_argument('--chunked', action='store_true', help='send bulk responses with chunked transfer encoding')
+    args = parser.parse_args()
+    server = start_standin(args.port, args.latency, args.latency_per_mb, args.rejection_rate, args.refresh_interval,
+                           args.chunked)
+    print('Stand-in Elasticsearch node listening on port {}'.format(server.server_port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,476 @@
+"""
+This module includes a long-running streaming ingest mode, for getting admin log events into Elasticsearch within
+the 7-second window needed for real-time diagnosis instead of migrating whole tables in batches.  Events are json
+objects read from a pluggable source: a tailed NDJSON file, a local TCP socket that accepts NDJSON lines (which
+also stands in for a message queue in tests), or a Kafka topic if kafka-python is installed.  Events are
+micro-batched into Bulk API calls that are sent as soon as a batch reaches its size limit or its oldest event has
+waited for the deadline, and each call waits for the next refresh, so that the lag from an event's timestamp to
+the moment it can be searched is measured for every batch and checked against the freshness SLO.
+
+Functions:
+    event_time: converts an event timestamp to seconds since the epoch
+    tail_ndjson: follows an NDJSON file as lines are appended to it
+    kafka_source: consumes NDJSON events from a Kafka topic
+    stream_events: indexes events from a source in micro-batches until the source ends
+    format_lag_summary: formats the lag percentiles and SLO compliance of a stream
+    generate_load: writes timestamped test events to an NDJSON file or a socket at a fixed rate
+    main: uses argparse to set up a command line interface for this module
+"""
+
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import cycle
+from queue import Queue, Empty
+from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+import calendar
+import json
+import os
+import random
+import socket
+import threading
+import time
+from dimension_cache import load_dimensions, dimensions_for, compile_enrichment, enrich_document, \
+    start_dimension_refresher
+from es_bulk import new_bulk_stats, failed_bulk_outcome, record_bulk_outcome, submit_bulk_with_retry, \
+    format_bulk_stats
+from es_connect import CONNECTION_IP, node_address, get_http_session
+from es_metrics import new_metrics, observe, record_bulk_stats, increment, metrics_snapshot, percentile, \
+    start_metrics_server, start_metrics_logger
+from mySQL_connect import load_connection_info, rds_mysql_connection, close_connection
+
+try:
+    from kafka import KafkaConsumer
+except ImportError:
+    KafkaConsumer = None
+
+# Seconds within which an event has to be searchable
+FRESHNESS_SLO = 7.0
+# A batch is sent once it holds MAX_DOCS events or MAX_BYTES bytes, or once its first event has waited MAX_WAIT
+# seconds, whichever comes first
+MAX_DOCS = 1000
+MAX_BYTES = 5 * 1024 * 1024
+MAX_WAIT = 1.0
+# Seconds a source waits for new events before yielding None, so that deadlines are checked while it is idle
+POLL_INTERVAL = 0.05
+# Events buffered by the socket source before clients are made to wait
+QUEUE_EVENTS = 100000
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def event_time(value):
+    """ Converts an event timestamp to seconds since the epoch.
+        Args:
+            value (number or string): seconds since the epoch, or a 'yyyy-MM-dd HH:mm:ss[.ffffff]' UTC time (an
+                ISO 8601 'T' separator and 'Z' suffix are accepted)
+        Returns:
+            float, or None if the value cannot be read as a time
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        seconds = calendar.timegm(datetime.strptime(value[:19].replace('T', ' '), DATETIME_FORMAT).timetuple())
+        fraction = value[19:].rstrip('Z')
+        return seconds + (float('0' + fraction) if fraction.startswith('.') else 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_event(line):
+    """ Parses one NDJSON line, returning None (and printing why) if it is not a json object """
+    try:
+        event = json.loads(line.decode('utf-8') if isinstance(line, bytes) else line)
+    except ValueError as exc:
+        print('skipping malformed event: {}'.format(exc))
+        return None
+    if not isinstance(event, dict):
+        print('skipping event that is not a json object: {!r}'.format(event))
+        return None
+    return event
+
+
+def tail_ndjson(path, from_start=False, poll_interval=POLL_INTERVAL):
+    """ Follows an NDJSON file as lines are appended to it, like tail -f.  A line is only read once its newline
+        has been written, and if the file is truncated (e.g. rotated by copy and truncate) it is read again from
+        the start.
+        Args:
+            path (string): path of the file
+            from_start (boolean): whether to read the events already in the file (otherwise only new ones)
+            poll_interval (float): seconds to wait for new lines before checking the file again
+        Yields:
+            dictionary for each event, or None whenever no new event arrived within poll_interval
+    """
+    with open(path, 'rb') as ndjson_file:
+        if not from_start:
+            ndjson_file.seek(0, os.SEEK_END)
+        partial = b''
+        while True:
+            line = ndjson_file.readline()
+            if not line:
+                if os.path.getsize(path) < ndjson_file.tell():
+                    ndjson_file.seek(0)
+                    partial = b''
+                yield None
+                time.sleep(poll_interval)
+                continue
+            if not line.endswith(b'\n'):
+                # The writer has not finished the line yet
+                partial += line
+                continue
+            line, partial = partial + line, b''
+            if line.strip():
+                event = _parse_event(line)
+                if event is not None:
+                    yield event
+
+
+class ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    """ TCP server that handles each connection in its own thread """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class EventHandler(StreamRequestHandler):
+    """ Reads NDJSON lines from a client connection into the server's event queue """
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                event = _parse_event(line)
+                if event is not None:
+                    # Blocks while the queue is full, which makes the client wait instead of using more memory
+                    self.server.events.put(event)
+
+
+class SocketSource(object):
+    """ Listens on a TCP port for NDJSON events sent by any number of clients.  Iterating over it yields each
+        event as a dictionary, or None whenever no new event arrived within poll_interval.  server_port is the
+        port it listens on and close() stops it.
+    """
+    def __init__(self, host='127.0.0.1', port=0, poll_interval=POLL_INTERVAL):
+        self.server = ThreadingTCPServer((host, port), EventHandler)
+        self.server.events = Queue(maxsize=QUEUE_EVENTS)
+        self.server_port = self.server.server_address[1]
+        self.poll_interval = poll_interval
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.server.events.get(timeout=self.poll_interval)
+            except Empty:
+                yield None
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def kafka_source(topic, bootstrap_servers, group_id='es_stream', poll_interval=POLL_INTERVAL):
+    """ Consumes NDJSON events from a Kafka topic.  Needs kafka-python, which is not required by the rest of the
+        project.  Offsets are committed automatically by the consumer.
+        Args:
+            topic (string): name of the topic
+            bootstrap_servers (string): comma-separated 'host:port' addresses of the Kafka brokers
+            group_id (string): consumer group, so that several streams can share the topic's partitions
+            poll_interval (float): seconds to wait for new messages
+        Yields:
+            dictionary for each event, or None whenever no new event arrived within poll_interval
+    """
+    if KafkaConsumer is None:
+        raise ImportError('the kafka source needs kafka-python (pip install kafka-python)')
+    consumer = KafkaConsumer(topic, bootstrap_servers=bootstrap_servers.split(','), group_id=group_id)
+    try:
+        while True:
+            records = consumer.poll(timeout_ms=int(poll_interval * 1000))
+            if not records:
+                yield None
+                continue
+            for messages in records.values():
+                for message in messages:
+                    event = _parse_event(message.value)
+                    if event is not None:
+                        yield event
+    finally:
+        consumer.close()
+
+
+def _new_batch():
+    """ Returns an empty micro-batch: its payload, the time each of its events was created (or received, if it
+        has no timestamp) and the time its first event was received
+    """
+    return {'payload': bytearray(), 'times': [], 'opened': None}
+
+
+def _send_batch(session, url, batch, slo, metrics):
+    """ Sends a micro-batch and records how long after its events were created they became searchable """
+    stats = submit_bulk_with_retry(session, url, batch['payload'])
+    done = time.time()
+    lags = [done - created for created in batch['times']]
+    record_bulk_stats(metrics, stats)
+    # The oldest event of the batch has the largest lag, so one sample per batch bounds the lag of all of them
+    observe(metrics, 'lag', max(lags))
+    increment(metrics, 'late', sum(1 for lag in lags if lag > slo))
+    return stats
+
+
+def _record_failed_batch(batch, error, metrics):
+    """ Counts the events of a micro-batch whose Bulk API call raised an error as failed and late, and writes them
+        to the dead-letter file
+    """
+    print('bulk request failed: {}'.format(error))
+    stats = new_bulk_stats(len(batch['times']), len(batch['payload']))
+    record_bulk_outcome(stats, failed_bulk_outcome(batch['payload'], None, None, 'bulk request failed: {}'.format(
+        error)), 0)
+    record_bulk_stats(metrics, stats)
+    # The events never became searchable, so they all missed the SLO
+    observe(metrics, 'lag', time.time() - min(batch['times']))
+    increment(metrics, 'late', len(batch['times']))
+    return stats
+
+
+def stream_events(source, connection, index_name, workers=2, max_docs=MAX_DOCS, max_bytes=MAX_BYTES,
+                  max_wait=MAX_WAIT, wait_for_refresh=True, time_field=None, id_field=None, slo=FRESHNESS_SLO,
+                  metrics=None, max_events=None, enrichment=None):
+    """ Indexes events from a source in micro-batches until the source ends (or max_events have been read).  A
+        batch is sent once it reaches max_docs or max_bytes, or once its first event has waited max_wait seconds.
+        Up to <workers> batches are in flight at once; when all of them are, reading from the source waits.
+        Args:
+            source (iterable): yields events as dictionaries, and None while it is idle (e.g. tail_ndjson,
+                SocketSource or kafka_source)
+            connection (string): name of the Elasticsearch connection to be used
+            index_name (string): index or alias to write to
+            workers (integer): maximum number of Bulk API calls in flight
+            max_docs (integer): number of events at which a batch is sent
+            max_bytes (integer): payload size at which a batch is sent
+            max_wait (float): seconds after its first event arrived at which a batch is sent
+            wait_for_refresh (boolean): whether each Bulk API call waits until its documents can be searched
+                (refresh=wait_for), so that the lag measured is the time to searchable and not only to indexed
+            time_field (string): field holding each event's creation time (see event_time).  Events without it
+                are timed from when they were received.
+            id_field (string): field to use as each document's _id (None to let Elasticsearch assign ids)
+            slo (float): seconds within which an event has to be searchable
+            metrics (dictionary): metrics created by es_metrics.new_metrics (None to create new ones)
+            max_events (integer): number of events after which to stop (None to run until the source ends)
+            enrichment (list): dimension lookups to add to each event, created by
+                dimension_cache.compile_enrichment (None for no enrichment)
+        Returns:
+            dictionary: the metrics of the stream, with a 'lag' histogram and 'late' counter
+    """
+    metrics = metrics if metrics is not None else new_metrics(index_name)
+    query = '?refresh=wait_for' if wait_for_refresh else ''
+    nodes = cycle([(get_http_session(ip, workers), 'http://' + node_address(ip) + '/_bulk' + query)
+                   for ip in CONNECTION_IP[connection]])
+    header = json.dumps({'index': {'_index': index_name, '_type': 'record'}})
+    id_prefix = (header[:-2] + ', "_id": ').encode('utf-8')
+    header = (header + '\n').encode('utf-8')
+    encode = json.JSONEncoder().encode
+    slots = threading.BoundedSemaphore(workers)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    batch = _new_batch()
+    read = 0
+
+    def finished(f, batch):
+        try:
+            if f.exception() is not None:
+                _record_failed_batch(batch, f.exception(), metrics)
+        finally:
+            slots.release()
+
+    def flush(batch):
+        slots.acquire()
+        session, url = next(nodes)
+        future = pool.submit(_send_batch, session, url, batch, slo, metrics)
+        future.add_done_callback(lambda f: finished(f, batch))
+
+    try:
+        for event in source:
+            now = time.time()
+            if event is not None:
+                read += 1
+                if enrichment:
+                    enrich_document(enrichment, event)
+                if id_field is not None and id_field in event:
+                    batch['payload'] += id_prefix + encode(str(event[id_field])).encode('utf-8') + b'}}\n'
+                else:
+                    batch['payload'] += header
+                batch['payload'] += encode(event).encode('utf-8') + b'\n'
+                created = event_time(event.get(time_field)) if time_field else None
+                batch['times'].append(created if created is not None else now)
+                if batch['opened'] is None:
+                    batch['opened'] = now
+            if batch['times'] and (len(batch['times']) >= max_docs or len(batch['payload']) >= max_bytes or
+                                   now - batch['opened'] >= max_wait):
+                flush(batch)
+                batch = _new_batch()
+            if max_events is not None and read >= max_events:
+                break
+    finally:
+        if batch['times']:
+            flush(batch)
+        pool.shutdown(wait=True)
+    return metrics
+
+
+def format_lag_summary(metrics, slo=FRESHNESS_SLO):
+    """ Formats the lag percentiles and SLO compliance of a stream.
+        Args:
+            metrics (dictionary): metrics returned by stream_events
+            slo (float): seconds within which an event has to be searchable
+        Returns:
+            string
+    """
+    snapshot = metrics_snapshot(metrics)
+    counters = snapshot['counters']
+    with metrics['lock']:
+        lags = list(metrics['histograms'].get('lag', []))
+    within = 100.0 * (counters['docs'] - counters.get('late', 0)) / counters['docs'] if counters['docs'] else 100.0
+    summary = '{} events, {:.0f} docs/sec, {:.2f}% searchable within the {}s SLO'.format(
+        counters['docs'], snapshot['docs_per_sec'], within, slo)
+    if lags:
+        summary += ', batch lag p50 {:.3f}s, p95 {:.3f}s, p99 {:.3f}s, max {:.3f}s'.format(
+            percentile(lags, 50), percentile(lags, 95), percentile(lags, 99), max(lags))
+    return summary + '\n' + format_bulk_stats(counters)
+
+
+def generate_load(target, rate, seconds, time_field='logTime'):
+    """ Writes timestamped test events at a fixed rate, so that the lag of a stream can be measured under load.
+        Events are shaped like ee_log rows, with the time they were written in time_field.
+        Args:
+            target (string): path of an NDJSON file to append to, or 'host:port' of a socket source
+            rate (float): events per second
+            seconds (float): how long to write events for
+            time_field (string): field to write each event's creation time to, in seconds since the epoch
+        Returns:
+            integer: number of events written
+    """
+    host, _, port = target.rpartition(':')
+    if port.isdigit() and host:
+        connection = socket.create_connection((host, int(port)))
+        out = connection.makefile('wb')
+    else:
+        connection = None
+        out = open(target, 'ab')
+    written = 0
+    start = time.time()
+    try:
+        while time.time() - start < seconds:
+            # Write the events that are due, then sleep until the next one
+            due = int((time.time() - start) * rate) + 1
+            lines = []
+            for log_id in range(written, due):
+                lines.append(json.dumps({'logId': log_id, 'logType': 'connectivity', 'userId': random.randint(1, 500),
+                                         'logMessage': 'test event {}'.format(log_id), time_field: time.time()}))
+            if lines:
+                out.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                out.flush()
+                written = due
+            time.sleep(max(0.0, start + written / float(rate) - time.time()))
+    finally:
+        out.close()
+        if connection is not None:
+            connection.close()
+    return written
+
+
+def main():
+    """
+    Uses argparse to implement a command line interface for the functions in this module.
+    """
+    parser = ArgumentParser(description='Streaming ingest into Elasticsearch')
+    subparser_base = parser.add_subparsers(title='actions', description='Choose an action')
+
+    sources = []
+    sp = subparser_base.add_parser('tail', help='follow an NDJSON file')
+    sp.set_defaults(which='tail')
+    sp.add_argument('-f', '--path', required=True, help='NDJSON file to follow')
+    sp.add_argument('--from_start', action='store_true', help='index the events already in the file as well')
+    sources.append(sp)
+
+    sp = subparser_base.add_parser('socket', help='listen for NDJSON events on a TCP port')
+    sp.set_defaults(which='socket')
+    sp.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    sp.add_argument('-p', '--port', type=int, default=5170, help='port to listen on')
+    sources.append(sp)
+
+    sp = subparser_base.add_parser('kafka', help='consume NDJSON events from a Kafka topic (needs kafka-python)')
+    sp.set_defaults(which='kafka')
+    sp.add_argument('--topic', required=True, help='topic to consume')
+    sp.add_argument('--bootstrap_servers', default='localhost:9092', help='comma-separated Kafka brokers')
+    sp.add_argument('--group_id', default='es_stream', help='consumer group')
+    sources.append(sp)
+
+    for sp in sources:
+        sp.add_argument('-c', '--connection', default='cluster', choices=sorted(CONNECTION_IP),
+                        help='Elasticsearch instance to index into')
+        sp.add_argument('-x', '--index_name', default='ee_log_index', help='index or alias to write to')
+        sp.add_argument('-w', '--workers', type=int, default=2, help='maximum number of Bulk API calls in flight')
+        sp.add_argument('--max_docs', type=int, default=MAX_DOCS, help='number of events at which a batch is sent')
+        sp.add_argument('--max_mb', type=float, default=MAX_BYTES / 1024.0 / 1024.0,
+                        help='payload size, in megabytes, at which a batch is sent')
+        sp.add_argument('--max_wait', type=float, default=MAX_WAIT, help='seconds after its first event arrived at '
+                                                                         'which a batch is sent')
+        sp.add_argument('--no_wait_for_refresh', action='store_true',
+                        help='do not wait for documents to be searchable before a Bulk API call returns')
+        sp.add_argument('--time_field', default=None, help="field holding each event's creation time")
+        sp.add_argument('--id_field', default=None, help="field to use as each document's _id")
+        sp.add_argument('--slo', type=float, default=FRESHNESS_SLO, help='seconds within which an event has to be '
+                                                                         'searchable')
+        sp.add_argument('--enrich_table', default=None, help='add the fields of the dimension rows that events '
+                                                             'refer to, as for documents of this table, e.g. '
+                                                             'ee_audit_events (needs the MySQL login)')
+        sp.add_argument('--metrics_port', type=int, default=None, help='serve metrics on this port at /metrics')
+        sp.add_argument('--metrics_interval', type=float, default=10.0, help='seconds between metrics log lines')
+
+    sp = subparser_base.add_parser('load', help='write timestamped test events to a file or socket')
+    sp.set_defaults(which='load')
+    sp.add_argument('-t', '--target', required=True, help="NDJSON file to append to, or 'host:port' of a socket")
+    sp.add_argument('-r', '--rate', type=float, default=1000, help='events per second')
+    sp.add_argument('-s', '--seconds', type=float, default=60, help='how long to write events for')
+    sp.add_argument('--time_field', default='logTime', help="field to write each event's creation time to")
+
+    args = vars(parser.parse_args())
+    action = args.pop('which')
+
+    if action == 'load':
+        print('wrote {} events'.format(generate_load(**args)))
+        return
+
+    if action == 'tail':
+        source = tail_ndjson(args.pop('path'), args.pop('from_start'))
+    elif action == 'socket':
+        source = SocketSource(args.pop('host'), args.pop('port'))
+        print('Listening for events on port {}'.format(source.server_port))
+    else:
+        source = kafka_source(args.pop('topic'), args.pop('bootstrap_servers'), args.pop('group_id'))
+    args['max_bytes'] = int(args.pop('max_mb') * 1024 * 1024)
+    args['wait_for_refresh'] = not args.pop('no_wait_for_refresh')
+    args['metrics'] = new_metrics(args['index_name'])
+    metrics_port = args.pop('metrics_port')
+    if metrics_port is not None:
+        start_metrics_server(args['metrics'], metrics_port)
+    stop_logger = start_metrics_logger(args['metrics'], args.pop('metrics_interval'))
+    enrich_table = args.pop('enrich_table')
+    stop_refresher = None
+    if enrich_table:
+        rds_info = load_connection_info('./login/.rds', ['port'])
+        con, cur = rds_mysql_connection(rds_info)
+        dimensions = load_dimensions(cur, dimensions_for(enrich_table))
+        close_connection(con, cur)
+        args['enrichment'] = compile_enrichment(dimensions, enrich_table)
+        stop_refresher = start_dimension_refresher(dimensions, rds_info)
+    try:
+        stream_events(source, **args)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_logger.set()
+        if stop_refresher:
+            stop_refresher.set()
+        print(format_lag_summary(args['metrics'], args['slo']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+This module includes functions for tuning the batch size and the number of parallel Bulk API calls while a
+migration runs, instead of finding them beforehand with the sizetest and workertest benchmarks.  Tuning follows
+an additive-increase/multiplicative-decrease (AIMD) rule: while Elasticsearch keeps up, batches grow by a fixed
+number of bytes and one more worker is added; as soon as Elasticsearch rejects requests or bulk calls get too slow,
+the number of workers is halved and batches shrink by a quarter.  Because batches are sized in bytes, narrow tables
+such as site get many more rows per batch than wide tables such as scribe.
+
+Functions:
+    new_tuning_state: creates the dictionary that holds the current batch size and number of workers
+    batch_rows: returns the number of rows each worker should send in its next Bulk API call
+    record_doc_bytes: updates the running average document size using the results of the last batch
+    update_tuning_state: adjusts the batch size and number of workers using the results of the last batch
+    format_tuning_state: formats the current batch size and number of workers for printing
+"""
+
+
+DEFAULT_BATCH_BYTES = 5 * 1024 * 1024
+MIN_BATCH_BYTES = 1 * 1024 * 1024
+MAX_BATCH_BYTES = 15 * 1024 * 1024
+BATCH_BYTES_STEP = 1 * 1024 * 1024
+MIN_WORKERS = 1
+MAX_WORKERS = 32
+# Bulk API calls slower than this count as congestion, even if Elasticsearch has not started rejecting them
+LATENCY_TARGET = 5.0
+# Weight given to the latest batch in the running average document size
+DOC_BYTES_WEIGHT = 0.3
+
+
+def new_tuning_state(batch_size, workers, batch_bytes=None):
+    """ Creates the dictionary that holds the tuning state for a migration.
+        Args:
+            batch_size (integer): number of rows per worker to send before the average document size is known
+            workers (integer): number of parallel Bulk API calls to start with
+            batch_bytes (integer): size of each Bulk API call to aim for, in bytes (defaults to
+                DEFAULT_BATCH_BYTES)
+        Returns:
+            dictionary with the current batch size in bytes, the number of workers, the average document size,
+            the throughput of the last batch and the last change made
+    """
+    return {'batch_size': batch_size, 'batch_bytes': batch_bytes or DEFAULT_BATCH_BYTES, 'workers': workers,
+            'doc_bytes': None, 'throughput': 0, 'last_change': None}
+
+
+def batch_rows(state):
+    """ Returns the number of rows that each worker should send in its next Bulk API call.
+        Args:
+            state (dictionary): tuning state created by new_tuning_state
+        Returns:
+            integer
+    """
+    if not state['doc_bytes']:
+        return state['batch_size']
+    return max(1, int(state['batch_bytes'] / state['doc_bytes']))
+
+
+def record_doc_bytes(state, stats):
+    """ Updates the running average document size, which is used to turn the batch size in bytes into a
+        number of rows.
+        Args:
+            state (dictionary): tuning state created by new_tuning_state
+            stats (dictionary): bulk submission counts for the batch (see es_bulk.new_bulk_stats)
+    """
+    if stats['docs'] and stats['bytes']:
+        doc_bytes = stats['bytes'] / float(stats['docs'])
+        if state['doc_bytes'] is None:
+            state['doc_bytes'] = doc_bytes
+        else:
+            state['doc_bytes'] += DOC_BYTES_WEIGHT * (doc_bytes - state['doc_bytes'])
+
+
+def update_tuning_state(state, stats, elapsed):
+    """ Adjusts the batch size and number of workers using the results of the last batch.  Rejections or slow
+        calls cut the number of workers in half and the batch size by a quarter.  Otherwise, if throughput did not
+        drop, the batch size grows by BATCH_BYTES_STEP and one worker is added.  If throughput dropped after the
+        last increase, that increase is undone so that the tuning settles near the best setting for the table.
+        Args:
+            state (dictionary): tuning state created by new_tuning_state
+            stats (dictionary): bulk submission counts for the batch (see es_bulk.new_bulk_stats)
+            elapsed (float): time taken to submit the batch, in seconds
+    """
+    record_doc_bytes(state, stats)
+    throughput = stats['indexed'] / elapsed if elapsed > 0 else 0
+    slowest = max(stats['latencies']) if stats['latencies'] else 0
+    if stats['rejections'] or slowest > LATENCY_TARGET:
+        # Multiplicative decrease
+        state['workers'] = max(MIN_WORKERS, state['workers'] // 2)
+        state['batch_bytes'] = max(MIN_BATCH_BYTES, int(state['batch_bytes'] * 0.75))
+        state['last_change'] = 'decrease'
+    elif state['last_change'] == 'increase' and throughput < state['throughput']:
+        # The last increase made things worse, so step back
+        state['workers'] = max(MIN_WORKERS, state['workers'] - 1)
+        state['batch_bytes'] = max(MIN_BATCH_BYTES, state['batch_bytes'] - BATCH_BYTES_STEP)
+        state['last_change'] = 'undo'
+    else:
+        # Additive increase
+        state['workers'] = min(MAX_WORKERS, state['workers'] + 1)
+        state['batch_bytes'] = min(MAX_BATCH_BYTES, state['batch_bytes'] + BATCH_BYTES_STEP)
+        state['last_change'] = 'increase'
+    state['throughput'] = throughput
+
+
+def format_tuning_state(state):
+    """ Formats the current batch size and number of workers for printing.
+        Args:
+            state (dictionary): tuning state created by new_tuning_state
+        Returns:
+            string
+    """
+    return 'Tuned batch size: {:.1f} MB ({} rows per worker), workers: {}'.format(
+        state['batch_bytes'] / 1024.0 / 1024.0, batch_rows(state), state['workers'])
@@ -0,0 +1,125 @@
+"""
+This module includes a cache for table metadata, so that the schema file, DESCRIBE and SHOW TABLES are each read
+once instead of on every call.  Schema files are parsed once for as long as they are not modified.  DESCRIBE
+results and the table list are kept per database, under a namespace such as '<host>:<port>/<db>', until they are
+invalidated, and can be persisted to a json file so that later runs of the command line interfaces skip those
+round trips to RDS as well.
+
+Functions:
+    configure_cache: sets the database namespace and the file the cache is persisted to
+    cached_file: returns the parsed contents of a file, parsing it again only when it has been modified
+    cached_describe: returns the schema of a table, reading it only if it is not cached
+    cached_tables: returns the list of tables in the database, reading it only if it is not cached
+    invalidate: removes cached metadata for one table or for the whole database
+    save_cache: writes the cached database metadata to the cache file
+"""
+
+
+import copy
+import json
+import os
+import threading
+
+METADATA_CACHE_PATH = './metadata_cache.json'
+
+# State of the cache.  'databases' maps each namespace to {'describe': {table: schema}, 'tables': list or None};
+# 'files' maps each parsed file's path to its modification time and parsed contents.
+_CACHE = {'lock': threading.RLock(), 'namespace': '', 'path': None, 'databases': {}, 'files': {}}
+
+
+def _database():
+    """ Returns the cached metadata of the current namespace, creating it if needed """
+    return _CACHE['databases'].setdefault(_CACHE['namespace'], {'describe': {}, 'tables': None})
+
+
+def configure_cache(namespace='', path=None):
+    """ Sets the database namespace that DESCRIBE results and table lists are cached under, and the file the cache
+        is persisted to.  Metadata already saved in the file is loaded.
+        Args:
+            namespace (string): name of the database, e.g. '<host>:<port>/<db>'
+            path (string): path of the json cache file (None to keep the cache in memory only)
+    """
+    with _CACHE['lock']:
+        _CACHE['namespace'] = namespace
+        _CACHE['path'] = path
+        if path and os.path.exists(path):
+            with open(path) as cache_file:
+                for name, database in json.load(cache_file).items():
+                    _CACHE['databases'].setdefault(name, database)
+
+
+def cached_file(path, parser):
+    """ Returns the parsed contents of a file, parsing it again only when its modification time has changed.
+        Args:
+            path (string): path of the file
+            parser (function): function that takes the path and returns the parsed contents
+        Returns:
+            a copy of the parsed contents, which the caller is free to modify
+    """
+    mtime = os.path.getmtime(path)
+    with _CACHE['lock']:
+        entry = _CACHE['files'].get(path)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, parser(path))
+            _CACHE['files'][path] = entry
+        return copy.deepcopy(entry[1])
+
+
+def cached_describe(table, loader):
+    """ Returns the schema of a table, reading it only if it is not cached.
+        Args:
+            table (string): name of the table
+            loader (function): function without arguments that runs DESCRIBE and returns the schema
+        Returns:
+            a copy of the schema, which the caller is free to modify
+    """
+    with _CACHE['lock']:
+        describe = _database()['describe']
+        if table not in describe:
+            describe[table] = loader()
+            save_cache()
+        return copy.deepcopy(describe[table])
+
+
+def cached_tables(loader):
+    """ Returns the list of tables in the database, reading it only if it is not cached.
+        Args:
+            loader (function): function without arguments that runs SHOW TABLES and returns the table names
+        Returns:
+            list of strings
+    """
+    with _CACHE['lock']:
+        database = _database()
+        if database['tables'] is None:
+            database['tables'] = loader()
+            save_cache()
+        return list(database['tables'])
+
+
+def invalidate(table=None):
+    """ Removes cached metadata, so that it is read again the next time it is needed.  Call it after creating,
+        altering or dropping a table.
+        Args:
+            table (string): table whose schema to remove, along with the table list (None to remove everything
+                cached for the current namespace)
+    """
+    with _CACHE['lock']:
+        if table is None:
+            _CACHE['databases'].pop(_CACHE['namespace'], None)
+        else:
+            database = _database()
+            database['describe'].pop(table, None)
+            database['tables'] = None
+        save_cache()
+
+
+def save_cache():
+    """ Writes the cached metadata of every namespace to the cache file, if one has been configured """
+    with _CACHE['lock']:
+        path = _CACHE['path']
+        if not path:
+            return
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as cache_file:
+            json.dump(_CACHE['databases'], cache_file, indent=2, sort_keys=True)
+        os.replace(temp_path, path)
@@ -1,13 +1,28 @@
 import MySQLdb
 import time
 import csv
-from datetime import datetime
+import os
+import tempfile
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
+from csv_columns import read_typed_blocks
+from metadata_cache import METADATA_CACHE_PATH, configure_cache, cached_file, cached_describe, cached_tables, \
+    invalidate
 
 CONNECTION_PATH = '../login/.rds'
 
 CSV_PATH = '../table_csv_files/'
 
+SCHEMAS_PATH = './tblSchemas'
+
+# Rows sent in each multi-row INSERT by the fast loader when LOAD DATA LOCAL INFILE is not allowed
+INSERT_BATCH_ROWS = 20000
+# Bytes read at a time when a byte range of a CSV file is copied or read, so that no range is held in memory whole
+COPY_BLOCK_BYTES = 1024 * 1024
+# MySQL errors that mean LOAD DATA LOCAL INFILE is disabled on the client or the server
+LOCAL_INFILE_ERRORS = (1148, 2061, 2068, 3948, 3950)
+
 
 def load_connection_info(path, intvars):
     """ Loads connection information from a file.
@@ -60,13 +75,11 @@ def run_query(cur, query, show_results=False):
             print(row)
 
 
-def import_schemas_from_file():
-    """ Imports schema information from an external text file.
-        Used to create tables in the database with the proper schema before importing records.
-        Prerequisites: a text file with schema information needs to be saved as tblSchemas in the home
-        directory with the following format:
-        <column name> <data type> (e.g., 'doctor_name VARCHAR(150)')"""
-    with open('./tblSchemas') as schemas_file:
+def parse_schemas_file(path):
+    """ Parses a schema file with the format described in import_schemas_from_file.
+        Returns:
+            dictionary with a list of [<column name>, <data type>] for each table"""
+    with open(path) as schemas_file:
         schemas = {}
         for line in schemas_file:
             line = line.split()
@@ -79,9 +92,18 @@ def import_schemas_from_file():
     return schemas
 
 
-def read_schema_from_db(cur, table):
-    """ Reads schema information from a table in the database.
-        Used to define mappings for import into Elasticsearch."""
+def import_schemas_from_file():
+    """ Imports schema information from an external text file.
+        Used to create tables in the database with the proper schema before importing records.
+        Prerequisites: a text file with schema information needs to be saved as tblSchemas in the home
+        directory with the following format:
+        <column name> <data type> (e.g., 'doctor_name VARCHAR(150)')
+        The file is parsed once and parsed again only if it is modified."""
+    return cached_file(SCHEMAS_PATH, parse_schemas_file)
+
+
+def describe_table(cur, table):
+    """ Runs DESCRIBE on a table and returns its [<column name>, <data type>] pairs, bypassing the cache"""
     num_rows = cur.execute("""DESCRIBE {}""".format(table))
     tbl_schema = []
     for i in range(num_rows):
@@ -90,21 +112,31 @@ def read_schema_from_db(cur, table):
     return tbl_schema
 
 
+def read_schema_from_db(cur, table):
+    """ Reads schema information from a table in the database.
+        Used to define mappings for import into Elasticsearch.
+        DESCRIBE only runs the first time a table is read, until the table is invalidated in metadata_cache."""
+    return cached_describe(table, lambda: describe_table(cur, table))
+
+
+def list_tables(cur):
+    """ Returns the names of the tables in the database.  SHOW TABLES only runs if the list is not cached."""
+    def show_tables():
+        cur.execute("""SHOW TABLES""")
+        return [i[0] for i in cur.fetchall()]
+    return cached_tables(show_tables)
+
+
+def metadata_namespace(rds_info):
+    """ Returns the name that a database's metadata is cached under in metadata_cache"""
+    return '{}:{}/{}'.format(rds_info.get('host'), rds_info.get('port'), rds_info.get('db'))
+
+
 def create_table(cur, tbl_name, tbl_schema):
     query = """CREATE TABLE IF NOT EXISTS """ + tbl_name + " (" + \
             (", ".join(" ".join(row) for row in tbl_schema)) + ")"
     cur.execute(query)
-
-
-def schema_process(tbl_schema, j, item):
-    """ Processes a table's csv file contents and converts strings to datetime or integer objects,
-        according to the table's schema."""
-    if tbl_schema[j][1] == 'DATETIME' and item != 'NULL':
-        return datetime.strptime(item, "%Y-%m-%d %H:%M:%S")
-    elif 'INT' in tbl_schema[j][1]:
-        return int(item)
-    else:
-        return item
+    invalidate(tbl_name)
 
 
 def import_table_data(con, cur, tbl_name):
@@ -116,26 +148,203 @@ def import_table_data(con, cur, tbl_name):
     tbl_schema = schemas[tbl_name]
     create_table(cur, tbl_name, tbl_schema)
 
-    # Loop through CSV file and prepare data for import
-    file_records = []
+    # Read the CSV file in blocks, converting each block to the table's types a column at a time
     create_query_str = """INSERT INTO {} VALUES {}""".format(tbl_name, '(' + ','.join(['%s'] * len(tbl_schema)) + ')')
     table_csv_path = CSV_PATH + tbl_name + '.csv'
 
-    with open(table_csv_path) as csv_file:
-        reader = csv.reader(csv_file, delimiter=',')
-        for i, line in enumerate(reader):
-            record = [schema_process(tbl_schema, j, item) for j, item in enumerate(line)]
-            file_records.append(record)
-            # Import records into the MySQL database table, 1,000 records at a time
-            if i % 1000 == 0:
-                print('inserting 1000 rows')
-                cur.executemany(create_query_str, file_records)
+    with open(table_csv_path, newline='') as csv_file:
+        for file_records in read_typed_blocks(csv_file, tbl_schema):
+            # Import each block of records into the MySQL database table with its own commit
+            print('inserting {} rows'.format(len(file_records)))
+            cur.executemany(create_query_str, file_records)
+            con.commit()
+
+
+def csv_byte_ranges(path, chunks):
+    """ Splits a CSV file into byte ranges of about equal size that start and end on line boundaries, so that
+        each range can be loaded on its own connection.  Assumes that quoted fields do not contain newlines.
+        Args:
+            path (string): path of the CSV file
+            chunks (integer): number of ranges to split the file into
+        Returns:
+            list of (start, end) byte offsets.  Fewer ranges are returned if the file has fewer lines than chunks.
+    """
+    size = os.path.getsize(path)
+    edges = [0]
+    with open(path, 'rb') as csv_file:
+        for i in range(1, chunks):
+            offset = size * i // chunks
+            if offset <= edges[-1]:
+                continue
+            # Move the cut to just after the end of the line that the offset falls in
+            csv_file.seek(offset - 1)
+            csv_file.readline()
+            position = csv_file.tell()
+            if edges[-1] < position < size:
+                edges.append(position)
+    edges.append(size)
+    return [(edges[i], edges[i + 1]) for i in range(len(edges) - 1) if edges[i] < edges[i + 1]]
+
+
+def _range_lines(csv_file, start, end):
+    """ Yields the decoded lines of a file opened in binary mode that lie in a byte range """
+    csv_file.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        line = csv_file.readline()
+        if not line:
+            return
+        remaining -= len(line)
+        yield line.decode('utf-8')
+
+
+def read_csv_range(path, start, end):
+    """ Reads the rows of a CSV file that lie in a byte range returned by csv_byte_ranges, a line at a time.
+        Yields:
+            rows, each a list of strings
+    """
+    with open(path, 'rb') as csv_file:
+        for row in csv.reader(_range_lines(csv_file, start, end), delimiter=','):
+            yield row
+
+
+def copy_csv_range(path, start, end, out_file):
+    """ Copies a byte range of a file to another file, COPY_BLOCK_BYTES at a time.
+        Args:
+            path (string): path of the file to copy from
+            start (integer): offset of the first byte to copy
+            end (integer): offset after the last byte to copy
+            out_file (file object): file opened in binary mode to copy to
+    """
+    with open(path, 'rb') as csv_file:
+        csv_file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = csv_file.read(min(COPY_BLOCK_BYTES, remaining))
+            if not block:
+                return
+            out_file.write(block)
+            remaining -= len(block)
+
+
+def load_data_infile(cur, tbl_name, csv_path, tbl_schema):
+    """ Loads a CSV file into a table with LOAD DATA LOCAL INFILE, so that MySQL parses and converts the values
+        itself.  'NULL' strings are stored as NULL.  The connection needs to be opened with local_infile=1 and
+        the server needs local_infile enabled.
+        Args:
+            cur (cursor object): MySQL cursor object that is connected to the database
+            tbl_name (string): name of the table to load into
+            csv_path (string): path of the CSV file
+            tbl_schema (list): [<column name>, <data type>] for each column of the table
+        Returns:
+            integer: number of rows loaded
+    """
+    variables = ['@v{}'.format(j) for j in range(len(tbl_schema))]
+    assignments = ["{} = NULLIF({}, 'NULL')".format(col[0], var) for col, var in zip(tbl_schema, variables)]
+    query = """LOAD DATA LOCAL INFILE %s INTO TABLE {} FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' """ \
+            """LINES TERMINATED BY '\\n' ({}) SET {}""".format(tbl_name, ', '.join(variables), ', '.join(assignments))
+    return cur.execute(query, [csv_path])
+
+
+def insert_rows(cur, tbl_name, rows, batch_rows=INSERT_BATCH_ROWS):
+    """ Inserts rows with large multi-row INSERT statements (MySQLdb's executemany sends an INSERT ... VALUES
+        statement as one multi-row INSERT).  Values are sent as strings, apart from 'NULL' which is sent as NULL,
+        and MySQL converts them to the column types.
+        Args:
+            cur (cursor object): MySQL cursor object that is connected to the database
+            tbl_name (string): name of the table to insert into
+            rows (iterable): rows, each a list of strings.  Rows are taken batch_rows at a time, so a generator
+                such as read_csv_range is never read into memory whole.
+            batch_rows (integer): number of rows in each INSERT statement
+        Returns:
+            integer: number of rows inserted
+    """
+    rows = iter(rows)
+    num_rows = 0
+    while True:
+        batch = [[None if item == 'NULL' else item for item in row] for row in islice(rows, batch_rows)]
+        if not batch:
+            return num_rows
+        query = """INSERT INTO {} VALUES ({})""".format(tbl_name, ','.join(['%s'] * len(batch[0])))
+        cur.executemany(query, batch)
+        num_rows += len(batch)
+
+
+def _load_csv_range(rds_info, tbl_name, tbl_schema, csv_path, byte_range, method):
+    """ Loads one byte range of a CSV file on its own connection and commits it.
+        Args:
+            method (dictionary): {'name': 'infile' or 'insert'}, shared by all ranges, so that once LOAD DATA
+                LOCAL INFILE turns out to be disabled the remaining ranges go straight to INSERTs
+        Returns:
+            integer: number of rows loaded
+    """
+    con, cur = rds_mysql_connection(dict(rds_info, local_infile=1) if method['name'] == 'infile' else rds_info)
+    try:
+        if method['name'] == 'infile':
+            chunk_path = csv_path
+            if byte_range != (0, os.path.getsize(csv_path)):
+                # LOAD DATA reads whole files, so a range of a larger file is loaded from a temporary copy
+                with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as chunk_file:
+                    copy_csv_range(csv_path, byte_range[0], byte_range[1], chunk_file)
+                    chunk_path = chunk_file.name
+            try:
+                num_rows = load_data_infile(cur, tbl_name, chunk_path, tbl_schema)
                 con.commit()
-                file_records = []
-        # Insert any remaining records.
-        print('inserting {} rows'.format(len(file_records)))
-        cur.executemany(create_query_str, file_records)
+                return num_rows
+            except (MySQLdb.OperationalError, MySQLdb.NotSupportedError) as e:
+                if e.args[0] not in LOCAL_INFILE_ERRORS:
+                    raise
+                print('LOAD DATA LOCAL INFILE is not allowed ({}), using multi-row INSERTs'.format(e))
+                method['name'] = 'insert'
+            finally:
+                if chunk_path != csv_path:
+                    os.remove(chunk_path)
+        num_rows = insert_rows(cur, tbl_name, read_csv_range(csv_path, *byte_range))
         con.commit()
+        return num_rows
+    finally:
+        close_connection(con, cur)
+
+
+def fast_import_table_data(rds_info, tbl_name, chunks=4, method='infile', csv_path=None):
+    """ Imports a table into the MySQL database through the fast loader.  The CSV file is split into byte
+        ranges that are loaded in parallel over separate connections, with LOAD DATA LOCAL INFILE where it is
+        allowed and large multi-row INSERTs otherwise.  Prints the number of rows loaded per second.
+        Prerequisite: a CSV with the name <table_name>.csv needs to be saved in the CSV_PATH directory.
+        Args:
+            rds_info (dictionary): connection information (see rds_mysql_connection)
+            tbl_name (string): name of the table to import
+            chunks (integer): number of byte ranges, and parallel connections, to load the file with
+            method (string): 'infile' to try LOAD DATA LOCAL INFILE first, or 'insert' to use INSERTs only
+            csv_path (string): path of the CSV file (defaults to CSV_PATH/<table_name>.csv)
+        Returns:
+            integer: number of rows loaded
+    """
+    tbl_schema = import_schemas_from_file()[tbl_name]
+    csv_path = csv_path or CSV_PATH + tbl_name + '.csv'
+    con, cur = rds_mysql_connection(rds_info)
+    create_table(cur, tbl_name, tbl_schema)
+    con.commit()
+    close_connection(con, cur)
+
+    start_time = time.time()
+    ranges = csv_byte_ranges(csv_path, chunks)
+    shared_method = {'name': method}
+    if method == 'infile' and len(ranges) > 1:
+        # Load the first range on its own, so that if LOAD DATA LOCAL INFILE is disabled every other range
+        # falls back to INSERTs without trying it
+        num_rows = _load_csv_range(rds_info, tbl_name, tbl_schema, csv_path, ranges[0], shared_method)
+        ranges = ranges[1:]
+    else:
+        num_rows = 0
+    with ThreadPoolExecutor(max_workers=max(1, len(ranges))) as executor:
+        futures = [executor.submit(_load_csv_range, rds_info, tbl_name, tbl_schema, csv_path, byte_range,
+                                   shared_method) for byte_range in ranges]
+        num_rows += sum(future.result() for future in futures)
+    elapsed = time.time() - start_time
+    print('loaded {} rows into {} in {:.2f} seconds ({:.0f} rows/sec, {})'.format(
+        num_rows, tbl_name, elapsed, num_rows / elapsed if elapsed > 0 else 0, shared_method['name']))
+    return num_rows
 
 
 def interval_query(cur, table, start, num_rows):
@@ -144,11 +353,74 @@ def interval_query(cur, table, start, num_rows):
     return nresults, cur
 
 
+def keyset_query(cur, table, key_cols, last_key, num_rows, bounds=None):
+    """ Runs a select query that pages through a table by its key columns instead of by row offset.
+        Rows are returned in key order starting just after last_key, so the query is an indexed range scan
+        and takes the same time at the end of the table as at the start.
+        Args:
+            cur (cursor object): MySQL cursor object that is connected to the database
+            table (string): name of the table to query
+            key_cols (list of strings): columns that uniquely order the table, e.g. ['logId'] or
+                ['logTime', 'logId']
+            last_key (list or None): values of key_cols for the last row already read (None to start at the
+                beginning of the table)
+            num_rows (integer): maximum number of rows to return
+            bounds (tuple): optional (column, lower, upper) range to restrict the query to, e.g. one partition
+                returned by partition_ranges.  lower is inclusive and upper is exclusive; either can be None.
+        Returns:
+            tuple: number of rows returned and the cursor holding them
+    """
+    order_by = ', '.join(key_cols)
+    conditions = []
+    params = []
+    if last_key is not None:
+        # Expand (a, b) > (x, y) into a > x OR (a = x AND b > y), which MySQL can turn into an index range
+        clauses = []
+        for i, col in enumerate(key_cols):
+            terms = ['{} = %s'.format(prev) for prev in key_cols[:i]] + ['{} > %s'.format(col)]
+            clauses.append('(' + ' AND '.join(terms) + ')')
+            params += list(last_key[:i + 1])
+        conditions.append('(' + ' OR '.join(clauses) + ')')
+    if bounds is not None:
+        col, lower, upper = bounds
+        if lower is not None:
+            conditions.append('{} >= %s'.format(col))
+            params.append(lower)
+        if upper is not None:
+            conditions.append('{} < %s'.format(col))
+            params.append(upper)
+    where = 'WHERE ' + ' AND '.join(conditions) + ' ' if conditions else ''
+    query = """SELECT * FROM {} {}ORDER BY {} LIMIT {}""".format(table, where, order_by, num_rows)
+    nresults = cur.execute(query, params or None)
+    return nresults, cur
+
+
+def partition_ranges(cur, table, column, partitions):
+    """ Splits a table into ranges of equal width on one column, so that each range can be read on its own
+        connection.  Works on integer keys (e.g. logId or event_id) and on DATETIME columns (e.g. logTime).
+        Args:
+            cur (cursor object): MySQL cursor object that is connected to the database
+            table (string): name of the table to split
+            column (string): column to split the table on
+            partitions (integer): number of ranges to split the table into
+        Returns:
+            list of (column, lower, upper) tuples that can be passed to keyset_query as bounds.  The first range
+            has no lower bound and the last has no upper bound, so that every row falls in exactly one range.
+            Fewer ranges are returned if the column has fewer distinct values than partitions.
+    """
+    cur.execute("""SELECT MIN({0}), MAX({0}) FROM {1}""".format(column, table))
+    low, high = cur.fetchone()
+    if low is None or partitions < 2:
+        return [(column, None, None)]
+    # (high - low) * i // partitions works for both integers and datetime.timedelta
+    cuts = sorted(set(low + (high - low) * i // partitions for i in range(1, partitions)) - {low})
+    edges = [None] + cuts + [None]
+    return [(column, edges[i], edges[i + 1]) for i in range(len(edges) - 1)]
+
+
 def get_colnames(cur, table):
     """ Generates a list of column names for a table in the database"""
-    cur.execute("""DESCRIBE {}""".format(table))
-    cols = cur.fetchall()
-    return [col[0] for col in cols]
+    return [col[0] for col in read_schema_from_db(cur, table)]
 
 
 def time_query(cur, query, show_results=False):
@@ -163,8 +435,8 @@ def main():
     # Connect to RDS
     rds_info = load_connection_info(CONNECTION_PATH, ['port'])  # path points to the file with my login information
     con, cur = rds_mysql_connection(rds_info)
-    cur.execute("""SHOW TABLES""")
-    table_list = [i[0] for i in cur.fetchall()]
+    configure_cache(metadata_namespace(rds_info), METADATA_CACHE_PATH)
+    table_list = list_tables(cur)
 
     # Use ArgumentParser to parse command line arguments
     parser = ArgumentParser(description='Augmedix project mySQL functions CLI')
@@ -173,6 +445,9 @@ def main():
     sp = subparser_base.add_parser('tables')
     sp.set_defaults(which='tables')
 
+    sp = subparser_base.add_parser('clear_cache')
+    sp.set_defaults(which='clear_cache')
+
     sp = subparser_base.add_parser('query')
     sp.set_defaults(which='query')
     sp.add_argument('-q', '--query', help="mySQL query string to execute")
@@ -196,6 +471,12 @@ def main():
     sp = subparser_base.add_parser('import')
     sp.set_defaults(which='import')
     sp.add_argument('-t', '--table', help="table to import into the database")
+    sp.add_argument('--fast', action='store_true', help="load the CSV file in parallel byte-range chunks with "
+                                                         "LOAD DATA LOCAL INFILE or multi-row INSERTs")
+    sp.add_argument('-c', '--chunks', type=int, default=4, help="number of chunks and parallel connections for "
+                                                                 "--fast")
+    sp.add_argument('-m', '--method', choices=['infile', 'insert'], default='infile',
+                    help="loading method for --fast: try LOAD DATA LOCAL INFILE first, or use INSERTs only")
 
     args = vars(parser.parse_args())
     args['cur'] = cur
@@ -205,6 +486,8 @@ def main():
     if action == 'tables':
         cur.execute("""SHOW TABLES""")
         print(cur.fetchall())
+    if action == 'clear_cache':
+        invalidate()
     if action == 'query':
         run_query(**args)
     if action == 'tquery':
@@ -216,8 +499,13 @@ def main():
         schema = read_schema_from_db(**args)
         print(schema)
     if action == 'import':
-        args['con'] = con
-        import_table_data(**args)
+        if args.pop('fast'):
+            fast_import_table_data(rds_info, args['table'], args['chunks'], args['method'])
+        else:
+            del args['chunks'], args['method']
+            args['con'] = con
+            args['tbl_name'] = args.pop('table')
+            import_table_data(**args)
 
     close_connection(con, cur)
 
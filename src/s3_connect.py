@@ -1,20 +1,37 @@
-from boto.s3.connection import S3Connection
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+from boto.s3.prefix import Prefix
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+import threading
+from es_connect import CONNECTION_IP, API_FUNCS, add_document_arguments, resolve_id_columns
 from mySQL_connect import load_connection_info
+from s3_ingest import ingest_s3_object, DOWNLOAD_WORKERS
 
 LOGIN_PATH = '../login/.aws'
 
+MANIFEST_PATH = './s3_manifest.json'
+SYNC_WORKERS = 8
 
-def connect_to_s3(access_key, secret_key):
+
+def connect_to_s3(access_key, secret_key, endpoint=None):
     """ Creates a connection to S3.
         Args:
             access_key (string) - AWS primary key
             secret_key (string) - AWS secret key
+            endpoint (string) - 'host:port' of an S3-compatible endpoint to use instead of AWS, e.g. a local
+                stand-in started by s3_standin.py (None for AWS)
         Returns:
             s3 connection object
     """
     try:
-        s3con = S3Connection(access_key, secret_key)
+        if endpoint:
+            host, port = endpoint.rsplit(':', 1)
+            s3con = S3Connection(access_key, secret_key, host=host, port=int(port), is_secure=False,
+                                 calling_format=OrdinaryCallingFormat())
+        else:
+            s3con = S3Connection(access_key, secret_key)
         print('Connection successful')
         return s3con
     except Exception as e:
@@ -61,6 +78,127 @@ def get_file(s3con, bucket, folder, filename):
     key.get_contents_to_filename(filename)
 
 
+def list_keys(bucket, prefix='', workers=SYNC_WORKERS):
+    """ Lists the objects under a prefix, listing each of its sub-prefixes (e.g. one per day or per shard) in
+        parallel instead of walking the whole prefix in one paged listing.
+        Args:
+            bucket (bucket object) - boto bucket object to list
+            prefix (string) - prefix to list, e.g. 'logs/2018-05-01/'
+            workers (integer) - number of listings to run at once
+        Returns:
+            list of key objects, each with its name, size and etag, sorted by name
+    """
+    keys = []
+    sub_prefixes = []
+    for item in bucket.list(prefix=prefix, delimiter='/'):
+        if isinstance(item, Prefix):
+            sub_prefixes.append(item.name)
+        else:
+            keys.append(item)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for listing in pool.map(lambda sub_prefix: list(bucket.list(prefix=sub_prefix)), sub_prefixes):
+            keys += listing
+    return sorted(keys, key=lambda key: key.name)
+
+
+def load_manifest(path=None):
+    """ Loads the manifest of downloaded objects.
+        Args:
+            path (string) - path of the manifest file (defaults to MANIFEST_PATH)
+        Returns:
+            dictionary of {bucket: {key name: {'etag': ..., 'size': ..., 'path': ...}}} (empty if there is no
+            manifest yet)
+    """
+    path = path or MANIFEST_PATH
+    if not os.path.exists(path):
+        return {}
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(manifest, path=None):
+    """ Writes the manifest of downloaded objects through a temporary file, so that it is never left half-written
+        Args:
+            manifest (dictionary) - manifest returned by load_manifest, with any new downloads
+            path (string) - path of the manifest file (defaults to MANIFEST_PATH)
+    """
+    path = path or MANIFEST_PATH
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def is_unchanged(entry, key):
+    """ Returns whether an object is the same as when it was last downloaded: its ETag and size match the
+        manifest entry and the local copy is still there with the same size.
+    """
+    return entry is not None and entry['etag'] == key.etag and entry['size'] == key.size and \
+        os.path.exists(entry['path']) and os.path.getsize(entry['path']) == key.size
+
+
+def download_key(key, local_path):
+    """ Downloads an object to a local file, through a temporary file so that an interrupted download does not
+        leave a partial file behind.
+        Args:
+            key (key object) - boto key object to download
+            local_path (string) - path of the local file
+    """
+    directory = os.path.dirname(local_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = local_path + '.part'
+    key.get_contents_to_filename(temp_path)
+    os.replace(temp_path, local_path)
+
+
+def sync_prefix(s3con, bucket, prefix, local_dir, workers=SYNC_WORKERS, manifest_path=None):
+    """ Downloads every object under a prefix that has changed since the last sync.  Prefixes are listed
+        concurrently, objects are downloaded by a bounded pool of threads that share the connection's pool of
+        HTTP connections, and objects whose ETag and size match the manifest are skipped.
+        Args:
+            s3con (s3 connection object) - S3 connection object where the objects are located
+            bucket (string) - name of the bucket to sync from
+            prefix (string) - prefix of the objects to download, e.g. 'logs/2018-05-01/'
+            local_dir (string) - directory to download into; each object is saved under its full key name
+            workers (integer) - number of listings and downloads to run at once
+            manifest_path (string) - path of the manifest file (defaults to MANIFEST_PATH)
+        Returns:
+            dictionary with the number of objects listed, downloaded, skipped and failed, and the bytes
+            downloaded
+    """
+    bucket_obj = s3con.get_bucket(bucket, validate=False)
+    manifest = load_manifest(manifest_path)
+    entries = manifest.setdefault(bucket, {})
+    keys = list_keys(bucket_obj, prefix, workers)
+    counts = {'listed': len(keys), 'downloaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+    lock = threading.Lock()
+    pending = [key for key in keys if not is_unchanged(entries.get(key.name), key)]
+    counts['skipped'] = len(keys) - len(pending)
+
+    def fetch(key):
+        local_path = os.path.join(local_dir, *key.name.split('/'))
+        download_key(key, local_path)
+        with lock:
+            entries[key.name] = {'etag': key.etag, 'size': key.size, 'path': local_path}
+            counts['downloaded'] += 1
+            counts['bytes'] += key.size
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(fetch, key): key for key in pending}
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    print('failed to download {}: {}'.format(futures[future].name, future.exception()))
+                    counts['failed'] += 1
+    finally:
+        # Downloads that finished are recorded even if the sync is interrupted
+        save_manifest(manifest, manifest_path)
+    print('listed {listed} objects, downloaded {downloaded} ({bytes} bytes), skipped {skipped} unchanged, '
+          '{failed} failed'.format(**counts))
+    return counts
+
+
 def close_s3_connection(con):
     """ Closes an s3 connection
         Args:
@@ -76,12 +214,9 @@ def __main__():
     """
     Uses ArgumentParser to implement a command line interface for the functions in this module
     """
-    # Connect to S3
-    s3_info = load_connection_info(LOGIN_PATH, [])
-    s3con = connect_to_s3(s3_info['access_key'], s3_info['secret_key'])
-
     # Use ArgumentParser to parse command line arguments
     parser = ArgumentParser(description='Augmedix project S3 functions CLI')
+    parser.add_argument('--endpoint', help="'host:port' of an S3-compatible endpoint to use instead of AWS")
     subparser_base = parser.add_subparsers(title='actions', description='Choose an action')
 
     sp = subparser_base.add_parser('list_buckets')
@@ -97,7 +232,40 @@ def __main__():
     sp.add_argument('-f', '--folder', default='new-folder', help='full path of folder where file lies')
     sp.add_argument('-n', '--filename', default='doctor.csv', help='name of file to be downloaded')
 
+    sp = subparser_base.add_parser('sync')
+    sp.set_defaults(which='sync')
+    sp.add_argument('-b', '--bucket', default='nt-augmedix-demo', help='bucket to download files from')
+    sp.add_argument('-p', '--prefix', default='', help="prefix of the files to download, e.g. 'logs/2018-05-01/'")
+    sp.add_argument('-d', '--local_dir', default='.', help='directory to download the files into')
+    sp.add_argument('-w', '--workers', type=int, default=SYNC_WORKERS, help='number of listings and downloads to '
+                                                                            'run at once')
+    sp.add_argument('--manifest_path', default=MANIFEST_PATH, help='manifest of the ETag and size of every file '
+                                                                   'downloaded, used to skip unchanged files')
+
+    sp = subparser_base.add_parser('ingest')
+    sp.set_defaults(which='ingest')
+    sp.add_argument('-b', '--bucket', default='nt-augmedix-demo', help='bucket where the CSV export lies')
+    sp.add_argument('-k', '--key_name', required=True, help='full name of the CSV export, gzip-compressed if it '
+                                                             'ends in .gz')
+    sp.add_argument('-t', '--table', required=True, help='table in tblSchemas that the export holds rows of')
+    sp.add_argument('-c', '--connection', default='cluster', choices=sorted(CONNECTION_IP),
+                    help='Elasticsearch instance to index into')
+    sp.add_argument('-w', '--workers', type=int, default=4, help='number of parallel Bulk API calls')
+    sp.add_argument('-s', '--batch_size', type=int, default=1000, help='number of records in each Bulk API call')
+    sp.add_argument('-e', '--engine', choices=sorted(API_FUNCS), default='threads',
+                    help='submission engine for Bulk API calls')
+    sp.add_argument('--index_name', help='index or alias to write to (defaults to <table>_index)')
+    sp.add_argument('--part_mb', type=float, default=8, help='size of each ranged GET, in megabytes')
+    sp.add_argument('--download_workers', type=int, default=DOWNLOAD_WORKERS, help='number of ranged GETs in '
+                                                                                    'flight')
+    sp.add_argument('--skip_header', action='store_true', help='skip the first row of the export')
+    add_document_arguments(sp)
+
     args = vars(parser.parse_args())
+
+    # Connect to S3
+    s3_info = load_connection_info(LOGIN_PATH, [])
+    s3con = connect_to_s3(s3_info['access_key'], s3_info['secret_key'], args.pop('endpoint'))
     args['s3con'] = s3con
     action = args['which']
     del args['which']
@@ -108,6 +276,12 @@ def __main__():
         list_bucket_contents(**args)
     elif action =='get_file':
         get_file(**args)
+    elif action == 'sync':
+        sync_prefix(**args)
+    elif action == 'ingest':
+        resolve_id_columns(args)
+        args['api_func'] = API_FUNCS[args.pop('engine')]
+        ingest_s3_object(**args)
 
     close_s3_connection(s3con)
 
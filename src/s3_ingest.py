@@ -0,0 +1,220 @@
+"""
+This module includes functions for streaming CSV log exports from S3 straight into Elasticsearch, without first
+saving them to disk or loading them into MySQL.  Each object is downloaded as a series of ranged GETs made in
+parallel, gzip-compressed objects are decompressed as the parts arrive, and rows are parsed incrementally and sent
+to the Bulk API in batches.  Only a bounded number of parts and one batch of rows are held in memory at a time, so
+objects of any size can be ingested.
+
+Functions:
+    object_ranges: splits an object into byte ranges of a given size
+    fetch_range: downloads one byte range of an object
+    stream_object: downloads an object as a series of parallel ranged GETs and yields its parts in order
+    decompress_stream: decompresses a stream of gzip or zlib data as it arrives
+    iter_text_lines: splits a stream of bytes into lines of text
+    stream_csv_rows: streams the rows of a CSV object in S3
+    ingest_s3_object: indexes the rows of a CSV object in S3 into Elasticsearch
+"""
+
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import codecs
+import csv
+import time
+import zlib
+from csv_columns import column_types, convert_columns
+from es_bulk import merge_bulk_stats, format_bulk_stats
+from es_connect import PAYLOAD_BYTES, submit_parallel_es_requests, flush_async_es_requests
+from es_documents import compile_row_converter, compile_action_header, serialize_rows
+from mySQL_connect import import_schemas_from_file
+
+PART_BYTES = 8 * 1024 * 1024
+DOWNLOAD_WORKERS = 4
+
+
+def object_ranges(size, part_bytes):
+    """ Splits an object into byte ranges.
+        Args:
+            size (integer): size of the object in bytes
+            part_bytes (integer): size of each range
+        Returns:
+            list of (first byte, last byte) tuples, inclusive as in an HTTP Range header
+    """
+    return [(start, min(start + part_bytes, size) - 1) for start in range(0, size, part_bytes)]
+
+
+def fetch_range(bucket, key_name, first, last):
+    """ Downloads one byte range of an object.  A new key object is used for every range, so that ranges can be
+        downloaded from several threads at once.
+        Args:
+            bucket (bucket object): boto bucket object where the object is located
+            key_name (string): full name of the object
+            first (integer): first byte of the range
+            last (integer): last byte of the range
+        Returns:
+            bytes
+    """
+    return bucket.new_key(key_name).get_contents_as_string(headers={'Range': 'bytes={}-{}'.format(first, last)})
+
+
+def stream_object(bucket, key_name, part_bytes=PART_BYTES, workers=DOWNLOAD_WORKERS):
+    """ Downloads an object as a series of ranged GETs made in parallel and yields its parts in order.  At most
+        <workers> parts are downloaded or waiting to be consumed at a time, which bounds the memory used to
+        about workers * part_bytes.
+        Args:
+            bucket (bucket object): boto bucket object where the object is located
+            key_name (string): full name of the object
+            part_bytes (integer): size of each ranged GET
+            workers (integer): number of ranged GETs in flight
+        Yields:
+            bytes, one part of the object at a time
+    """
+    key = bucket.get_key(key_name)
+    if key is None:
+        raise KeyError('{} not found in bucket {}'.format(key_name, bucket.name))
+    ranges = iter(object_ranges(key.size, part_bytes))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for first, last in ranges:
+            pending.append(pool.submit(fetch_range, bucket, key_name, first, last))
+            if len(pending) == workers:
+                break
+        while pending:
+            part = pending.popleft().result()
+            next_range = next(ranges, None)
+            if next_range is not None:
+                pending.append(pool.submit(fetch_range, bucket, key_name, *next_range))
+            yield part
+
+
+def decompress_stream(parts):
+    """ Decompresses a stream of gzip (or zlib) data as it arrives.  Files made of several concatenated gzip
+        members, as written by some log shippers, are decompressed member after member.
+        Args:
+            parts (iterable of bytes): compressed data
+        Yields:
+            bytes of decompressed data
+    """
+    # 32 + MAX_WBITS detects the gzip or zlib header automatically
+    decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    for part in parts:
+        while part:
+            data = decompressor.decompress(part)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            # The member is finished: anything left over is the start of the next one
+            part = decompressor.unused_data
+            decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def iter_text_lines(chunks, encoding='utf-8'):
+    """ Splits a stream of bytes into lines of text, decoding multi-byte characters that are split between chunks
+        correctly.
+        Args:
+            chunks (iterable of bytes): data
+            encoding (string): text encoding of the data
+        Yields:
+            strings, one line at a time with its '\\n'
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + decoder.decode(chunk)).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    rest += decoder.decode(b'', final=True)
+    if rest:
+        yield rest
+
+
+def stream_csv_rows(bucket, key_name, part_bytes=PART_BYTES, workers=DOWNLOAD_WORKERS, compressed=None):
+    """ Streams the rows of a CSV object in S3.
+        Args:
+            bucket (bucket object): boto bucket object where the object is located
+            key_name (string): full name of the object
+            part_bytes (integer): size of each ranged GET
+            workers (integer): number of ranged GETs in flight
+            compressed (boolean): whether the object is gzip-compressed (defaults to whether its name ends in .gz)
+        Returns:
+            csv reader that yields each row as a list of strings
+    """
+    if compressed is None:
+        compressed = key_name.endswith('.gz')
+    chunks = stream_object(bucket, key_name, part_bytes, workers)
+    if compressed:
+        chunks = decompress_stream(chunks)
+    return csv.reader(iter_text_lines(chunks), delimiter=',')
+
+
+def _submit_rows(connection, workers, api_func, converter, header, types, rows):
+    """ Converts one batch of CSV rows and hands it to the Bulk API, one payload per worker """
+    rows = convert_columns(types, rows)
+    chunk = -(-len(rows) // workers)
+    payloads = []
+    for i in range(0, len(rows), chunk):
+        payloads += serialize_rows(converter, rows[i:i + chunk], header, PAYLOAD_BYTES)
+    return api_func(connection, workers, payloads)
+
+
+def ingest_s3_object(s3con, bucket, key_name, connection, table, workers, batch_size,
+                     api_func=submit_parallel_es_requests, index_name=None, part_mb=8,
+                     download_workers=DOWNLOAD_WORKERS, compressed=None, skip_header=False, id_cols=None,
+                     op_type='index'):
+    """ Indexes the rows of a CSV object in S3 into Elasticsearch while it downloads.  The object has the
+        columns of <table> in tblSchemas, in the same order, and is indexed into an index that already exists.
+        Args:
+            s3con (s3 connection object): S3 connection object where the object is located
+            bucket (string): name of the bucket where the object is located
+            key_name (string): full name of the object, e.g. 'exports/2018-05-01/ee_log.csv.gz'
+            connection (string): name of the Elasticsearch connection to be used
+            table (string): name of the table in tblSchemas that the object holds rows of
+            workers (integer): number of parallel workers to use in Bulk API calls
+            batch_size (integer): number of records each worker sends in each Bulk API call
+            api_func (function): function to use to make calls to the Elasticsearch Bulk API (see
+                es_connect.API_FUNCS)
+            index_name (string): index or alias to write to (defaults to <table>_index)
+            part_mb (float): size of each ranged GET, in megabytes
+            download_workers (integer): number of ranged GETs in flight
+            compressed (boolean): whether the object is gzip-compressed (defaults to whether its name ends in .gz)
+            skip_header (boolean): whether the first row holds column names instead of values
+            id_cols (list of strings): columns to derive each document's _id from (see es_connect.migrate_table)
+            op_type (string): Bulk API operation for each document (see es_connect.migrate_table)
+        Returns:
+            tuple: number of rows indexed and the total time taken
+    """
+    t0 = time.time()
+    schema = import_schemas_from_file()[table]
+    # DATETIME values in the export are already in the format of the Elasticsearch mapping, so they are passed
+    # through as strings instead of being parsed and formatted again
+    types = ['str' if col_type == 'datetime' else col_type for col_type in column_types(schema)]
+    converter = compile_row_converter([[col[0], 'text' if col_type == 'str' else col[1]]
+                                       for col, col_type in zip(schema, types)], id_cols, op_type)
+    header = compile_action_header(converter, index_name or table + '_index', 'record')
+    rows = stream_csv_rows(s3con.get_bucket(bucket, validate=False), key_name, int(part_mb * 1024 * 1024),
+                           download_workers, compressed)
+    if skip_header:
+        next(rows, None)
+    result = []
+    batch = []
+    num_rows = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size * workers:
+            result += _submit_rows(connection, workers, api_func, converter, header, types, batch)
+            num_rows += len(batch)
+            batch = []
+    if batch:
+        result += _submit_rows(connection, workers, api_func, converter, header, types, batch)
+        num_rows += len(batch)
+    result += flush_async_es_requests()
+    elapsed = time.time() - t0
+    print(format_bulk_stats(merge_bulk_stats(result)))
+    print('ingested {} rows from s3://{}/{} in {:.2f} seconds ({:.0f} rows/sec)'.format(
+        num_rows, bucket, key_name, elapsed, num_rows / elapsed if elapsed > 0 else 0))
+    return num_rows, elapsed
@@ -0,0 +1,215 @@
+"""
+This module includes a local stand-in for Amazon S3, so that S3 downloads and streaming ingestion can be tested
+and benchmarked without AWS.  It serves the files under a local directory over the path-style S3 REST API: each
+sub-directory is a bucket and each file below it is an object.  It answers HEAD and GET requests for objects,
+including ranged GETs, and bucket listings with prefixes, delimiters and paging.  Requests are not
+authenticated.
+
+Functions:
+    start_standin: starts a stand-in S3 endpoint in a background thread
+    main: uses argparse to set up a command line interface for this module
+"""
+
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from argparse import ArgumentParser
+from email.utils import formatdate
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.sax.saxutils import escape
+import hashlib
+import os
+import threading
+import time
+
+LIST_MAX_KEYS = 1000
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server that handles each connection in its own thread """
+    daemon_threads = True
+
+
+def _object_etag(path):
+    """ Returns the quoted md5 ETag of a file, as S3 reports it for objects uploaded in a single part """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as object_file:
+        for block in iter(lambda: object_file.read(1024 * 1024), b''):
+            md5.update(block)
+    return '"{}"'.format(md5.hexdigest())
+
+
+def _iso_time(timestamp):
+    """ Formats a timestamp the way S3 bucket listings do """
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(timestamp))
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    """ Handles requests to the stand-in endpoint.  Settings and counters live on the server object. """
+    protocol_version = 'HTTP/1.1'
+
+    def split_path(self):
+        """ Returns the bucket, the object key and the query parameters of the request """
+        parts = urlsplit(self.path)
+        bucket, _, key = unquote(parts.path).lstrip('/').partition('/')
+        return bucket, key, {name: values[0] for name, values in parse_qs(parts.query).items()}
+
+    def send_body(self, status, body, headers=None, content_type='application/xml'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_error_code(self, status, code):
+        body = '<?xml version="1.0" encoding="UTF-8"?><Error><Code>{}</Code></Error>'.format(code).encode('utf-8')
+        self.send_body(status, body)
+
+    def count_request(self):
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        self.count_request()
+        bucket, key, params = self.split_path()
+        bucket_path = os.path.join(self.server.root, bucket)
+        if not bucket or not os.path.isdir(bucket_path):
+            self.send_error_code(404, 'NoSuchBucket')
+        elif not key:
+            self.send_listing(bucket, bucket_path, params)
+        elif not os.path.isfile(os.path.join(bucket_path, key)):
+            self.send_error_code(404, 'NoSuchKey')
+        else:
+            self.send_object(os.path.join(bucket_path, key))
+
+    def send_object(self, path):
+        size = os.path.getsize(path)
+        headers = {'ETag': _object_etag(path), 'Last-Modified': formatdate(os.path.getmtime(path), usegmt=True),
+                   'Accept-Ranges': 'bytes'}
+        start, end = 0, size - 1
+        status = 200
+        byte_range = self.headers.get('Range')
+        if byte_range and byte_range.startswith('bytes='):
+            first, _, last = byte_range[len('bytes='):].partition('-')
+            start = int(first) if first else max(0, size - int(last))
+            end = min(int(last), size - 1) if first and last else size - 1
+            if start >= size:
+                self.send_error_code(416, 'InvalidRange')
+                return
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+            status = 206
+        if self.command == 'HEAD':
+            body = b''
+            headers['Content-Length'] = str(end - start + 1)
+        else:
+            with open(path, 'rb') as object_file:
+                object_file.seek(start)
+                body = object_file.read(end - start + 1)
+            with self.server.lock:
+                self.server.bytes_sent += len(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_listing(self, bucket, bucket_path, params):
+        prefix = params.get('prefix', '')
+        delimiter = params.get('delimiter', '')
+        marker = params.get('marker', '')
+        max_keys = int(params.get('max-keys', LIST_MAX_KEYS))
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(bucket_path):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), bucket_path).replace(os.sep, '/')
+                if key.startswith(prefix) and key > marker:
+                    keys.append(key)
+        entries = []
+        seen_prefixes = set()
+        for key in sorted(keys):
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest[:rest.index(delimiter) + len(delimiter)]
+                if common in seen_prefixes or common <= marker:
+                    continue
+                seen_prefixes.add(common)
+                entries.append((common, None))
+            else:
+                entries.append((key, os.path.join(bucket_path, key)))
+        truncated = len(entries) > max_keys
+        entries = entries[:max_keys]
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+                 '<Name>{}</Name><Prefix>{}</Prefix><Marker>{}</Marker><MaxKeys>{}</MaxKeys>'.format(
+                     escape(bucket), escape(prefix), escape(marker), max_keys),
+                 '<Delimiter>{}</Delimiter><IsTruncated>{}</IsTruncated>'.format(escape(delimiter),
+                                                                                 str(truncated).lower())]
+        if truncated and entries:
+            lines.append('<NextMarker>{}</NextMarker>'.format(escape(entries[-1][0])))
+        for name, path in entries:
+            if path is None:
+                lines.append('<CommonPrefixes><Prefix>{}</Prefix></CommonPrefixes>'.format(escape(name)))
+            else:
+                lines.append('<Contents><Key>{}</Key><LastModified>{}</LastModified><ETag>{}</ETag><Size>{}</Size>'
+                             '<StorageClass>STANDARD</StorageClass></Contents>'.format(
+                                 escape(name), _iso_time(os.path.getmtime(path)), escape(_object_etag(path)),
+                                 os.path.getsize(path)))
+        lines.append('</ListBucketResult>')
+        self.send_body(200, '\n'.join(lines).encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_standin(root, port=0, latency=0.0):
+    """ Starts a stand-in S3 endpoint in a background thread.
+        Args:
+            root (string): directory whose sub-directories are served as buckets
+            port (integer): port to listen on (0 to pick a free port)
+            latency (float): seconds to wait before answering each request
+        Returns:
+            server object.  server.server_port is the port it listens on, server.requests and server.bytes_sent
+            count the requests received and the object bytes sent, and server.shutdown() stops it.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), S3Handler)
+    server.root = root
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.bytes_sent = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    """
+    Uses argparse to implement a command line interface for the functions in this module.
+    """
+    parser = ArgumentParser(description='Local stand-in for Amazon S3')
+    parser.add_argument('-r', '--root', default='.', help='directory whose sub-directories are served as buckets')
+    parser.add_argument('-p', '--port', type=int, default=9000, help='port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before answering each request')
+    args = parser.parse_args()
+    server = start_standin(args.root, args.port, args.latency)
+    print('Stand-in S3 endpoint serving {} on port {}'.format(args.root, server.server_port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Shared fixtures for the tests.  The modules in src/ are imported by name, as the command line tools import each
+other, and every test runs from the root of the repository so that tblSchemas and tblMappings are found.  Bulk calls
+go to the local stand-in node from es_standin, S3 requests to the stand-in endpoint from s3_standin, and MySQL is
+stood in for by the in-memory SQLite cursor from es_benchmark.
+"""
+
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+STANDIN_CONNECTION = 'standin'
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch, tmpdir):
+    """ Runs each test from the root of the repository, with dead letters written to a temporary file """
+    import es_bulk
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(es_bulk, 'DEAD_LETTER_PATH', str(tmpdir.join('dead_letters.ndjson')))
+
+
+@pytest.fixture
+def standin():
+    """ Starts a stand-in Elasticsearch node and registers it as the 'standin' connection """
+    import es_connect
+    from es_standin import start_standin
+    server = start_standin()
+    es_connect.CONNECTION_IP[STANDIN_CONNECTION] = ['127.0.0.1:{}'.format(server.server_port)]
+    yield server
+    es_connect.close_es_connections()
+    del es_connect.CONNECTION_IP[STANDIN_CONNECTION]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def s3(tmpdir):
+    """ Starts a stand-in S3 endpoint serving the buckets under tmpdir/s3, and yields the server and a connection
+        to it
+    """
+    from s3_connect import connect_to_s3
+    from s3_standin import start_standin
+    root = tmpdir.mkdir('s3')
+    server = start_standin(str(root))
+    s3con = connect_to_s3('access', 'secret', '127.0.0.1:{}'.format(server.server_port))
+    yield server, s3con
+    s3con.close()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def checkpoint_path(tmpdir):
+    return str(tmpdir.join('checkpoints.json'))
+
+
+def synthetic_table(table, num_rows, seed=0):
+    """ Returns a SQLite connection and cursor holding synthetic rows of a table from tblSchemas """
+    from es_benchmark import load_synthetic_table
+    from metadata_cache import configure_cache
+    from mySQL_connect import import_schemas_from_file
+    configure_cache('tests')
+    return load_synthetic_table(table, import_schemas_from_file()[table], num_rows, seed)
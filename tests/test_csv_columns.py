@@ -0,0 +1,42 @@
+import io
+from datetime import datetime
+
+import pytest
+
+from csv_columns import column_types, convert_int_column, convert_datetime_column, convert_columns, \
+    read_typed_blocks
+
+
+def test_datetime_column_matches_strptime():
+    values = ('2018-05-01 13:45:00', 'NULL', '1999-12-31 23:59:59')
+    assert convert_datetime_column(values) == [datetime(2018, 5, 1, 13, 45), None, datetime(1999, 12, 31, 23, 59, 59)]
+
+
+@pytest.mark.parametrize('value', ['2018-05-01', '2018-05-01T13:45:00', '2018-05-01 13:45', '2018-05-01 13:45:00.5',
+                                   ' 2018-05-01 13:45:0', '2018-02-30 00:00:00',
+                                   '2018-05-01 24:00:00', 'null', ''])
+def test_datetime_column_rejects_what_strptime_rejects(value):
+    with pytest.raises(ValueError):
+        datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    with pytest.raises(ValueError):
+        convert_datetime_column(('2018-05-01 13:45:00', value))
+
+
+def test_datetime_column_accepts_what_strptime_accepts():
+    values = ('2018-5-1 3:04:05', 'NULL', '2018-05-01 13:45:00')
+    assert convert_datetime_column(values) == [datetime(2018, 5, 1, 3, 4, 5), None, datetime(2018, 5, 1, 13, 45)]
+
+
+def test_int_column_and_nulls():
+    assert convert_int_column(('12', 'NULL', '-7')) == [12, None, -7]
+    assert convert_int_column(('1', '2')) == [1, 2]
+
+
+def test_typed_blocks():
+    schema = [['id', 'INT(11)'], ['name', 'VARCHAR(10)'], ['created', 'DATETIME']]
+    assert column_types(schema) == ['int', 'str', 'datetime']
+    csv_file = io.StringIO('1,a,2018-01-01 00:00:00\n2,NULL,NULL\n3,"b,c",2018-01-02 10:00:00\n')
+    blocks = list(read_typed_blocks(csv_file, schema, block_rows=2))
+    assert blocks == [[(1, 'a', datetime(2018, 1, 1)), (2, None, None)], [(3, 'b,c', datetime(2018, 1, 2, 10))]]
+    with pytest.raises(ValueError):
+        convert_columns(column_types(schema), [['1', 'a']])
@@ -0,0 +1,52 @@
+import sqlite3
+
+from es_benchmark import SQLiteCursor
+from dimension_cache import DIMENSIONS, ENRICHMENTS, load_dimensions, refresh_dimension, dimensions_for, \
+    dimensions_generation, compile_enrichment, enrich_document
+
+
+def dimension_database():
+    con = sqlite3.connect(':memory:')
+    con.execute('CREATE TABLE doctor (doctorId INT, doctorFirstName TEXT, doctorLastName TEXT, doctorEmail TEXT, '
+                'doctorStatus TEXT, siteID INT, doctorPassword TEXT)')
+    con.execute('CREATE TABLE site (id INT, siteName TEXT, siteLeadEmail TEXT)')
+    con.executemany('INSERT INTO doctor VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(1, 'Ann', 'Lee', 'ann@x', 'active', 10, 'secret'),
+                     (2, 'Bob', 'Ray', 'bob@x', 'active', 20, 'secret')])
+    con.executemany('INSERT INTO site VALUES (?, ?, ?)', [(10, 'North', 'n@x'), (20, 'South', 's@x')])
+    return con, SQLiteCursor(con, {})
+
+
+def test_every_cached_dimension_enriches_a_table():
+    used = set(dimension for lookups in ENRICHMENTS.values() for field, dimension in lookups)
+    assert set(DIMENSIONS) == used
+
+
+def test_enrichment_follows_lookups_in_order():
+    con, cur = dimension_database()
+    dimensions = load_dimensions(cur, dimensions_for('ee_audit_events'))
+    enrichment = compile_enrichment(dimensions, 'ee_audit_events')
+    doc = enrich_document(enrichment, {'event_id': 1, 'doctors_id': 2})
+    assert doc['doctorFirstName'] == 'Bob' and doc['siteName'] == 'South'
+    assert 'doctorPassword' not in doc
+    missing = enrich_document(enrichment, {'event_id': 2, 'doctors_id': 99})
+    assert missing['doctorFirstName'] is None and missing['siteName'] is None
+
+
+def test_incremental_and_full_refresh():
+    con, cur = dimension_database()
+    dimensions = load_dimensions(cur, ['doctor'])
+    doctor = dimensions['doctor']
+    generation = dimensions_generation()
+    con.execute("INSERT INTO doctor VALUES (3, 'Cy', 'Day', 'cy@x', 'active', 10, '')")
+    con.execute("UPDATE doctor SET doctorStatus = 'inactive' WHERE doctorId = 1")
+    # An incremental refresh only reads keys above the largest one loaded
+    assert refresh_dimension(cur, 'doctor', doctor) == 1
+    assert doctor['max_key'] == 3 and doctor['rows'][1][3] == 'active'
+    assert dimensions_generation() > generation
+    con.execute('DELETE FROM doctor WHERE doctorId = 2')
+    refresh_dimension(cur, 'doctor', doctor, full=True)
+    assert sorted(doctor['rows']) == [1, 3] and doctor['rows'][1][3] == 'inactive'
+    generation = dimensions_generation()
+    refresh_dimension(cur, 'doctor', doctor, full=True)
+    assert dimensions_generation() == generation
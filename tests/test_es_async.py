@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+import es_async
+import es_bulk
+from es_bulk import merge_bulk_stats
+from test_es_bulk import bulk_payload
+
+
+@pytest.fixture
+def engine(standin, monkeypatch):
+    """ Starts the submission engine for the stand-in node, with no backoff between retries """
+    monkeypatch.setattr(es_async, 'backoff_delay', lambda attempt: 0)
+    es_async.start_engine(['127.0.0.1:{}'.format(standin.server_port)], 1)
+    yield standin
+    es_async.stop_engine()
+
+
+def submit(payloads):
+    for payload in payloads:
+        es_async.submit_payload(payload)
+    return merge_bulk_stats(es_async.flush_engine())
+
+
+def test_chunked_responses_are_read(engine):
+    engine.chunked = True
+    stats = submit([bulk_payload(30) for i in range(3)])
+    assert (stats['docs'], stats['indexed'], stats['failed']) == (90, 90, 0)
+
+
+def test_chunked_responses_with_rejected_items_are_retried(engine):
+    engine.chunked = True
+    engine.rejection_rate = 0.5
+    random.seed(1)
+    stats = submit([bulk_payload(40)])
+    assert stats['retried'] > 0 and stats['indexed'] == 40
+    assert stats['sent_bytes'] == engine.bytes_received
+
+
+def test_connection_is_reused_across_requests(engine):
+    stats = submit([bulk_payload(10) for i in range(5)])
+    assert stats['indexed'] == 50
+    assert engine.requests == 5 and engine.connections == 1
+
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_rejected_requests_are_resent(engine, status):
+    engine.bulk_statuses = [status, status]
+    payload = bulk_payload(20)
+    stats = submit([payload])
+    assert (stats['indexed'], stats['rejections'], stats['failed']) == (20, 2, 0)
+    assert stats['sent_bytes'] == 3 * len(payload) and engine.requests == 3
+
+
+def test_server_errors_are_dead_lettered(engine):
+    engine.bulk_statuses = [500]
+    stats = submit([bulk_payload(20)])
+    assert (stats['indexed'], stats['failed'], stats['retried']) == (0, 20, 0)
+    with open(es_bulk.DEAD_LETTER_PATH) as dead_letters:
+        assert len(dead_letters.readlines()) == 20
+    # The connection is still usable after an error response
+    assert submit([bulk_payload(5)])['indexed'] == 5 and engine.connections == 1
+
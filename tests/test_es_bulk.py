@@ -0,0 +1,75 @@
+import json
+import random
+
+import requests
+
+import es_bulk
+from es_bulk import new_bulk_stats, merge_bulk_stats, item_succeeded, split_bulk_payload, sort_bulk_outcome, \
+    record_bulk_outcome, submit_bulk_with_retry
+
+
+def bulk_payload(num_docs, index='site_index_v1'):
+    lines = []
+    for i in range(num_docs):
+        lines.append(json.dumps({'index': {'_index': index, '_type': 'record', '_id': str(i)}}))
+        lines.append(json.dumps({'id': i, 'siteName': 'site {}'.format(i)}))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def bulk_url(server):
+    return 'http://127.0.0.1:{}/_bulk'.format(server.server_port)
+
+
+def test_payload_bytes_are_counted_once_per_batch(standin, monkeypatch):
+    monkeypatch.setattr('es_bulk.backoff_delay', lambda attempt: 0)
+    random.seed(1)
+    standin.rejection_rate = 0.5
+    payload = bulk_payload(40)
+    stats = submit_bulk_with_retry(requests.Session(), bulk_url(standin), payload, max_retries=20)
+    assert stats['retried'] > 0 and stats['indexed'] == 40
+    assert stats['bytes'] == len(payload)
+    assert stats['sent_bytes'] == standin.bytes_received > len(payload)
+
+
+def test_merge_adds_every_count():
+    first, second = new_bulk_stats(2, 100), new_bulk_stats(3, 50)
+    first['latencies'].append(0.5)
+    total = merge_bulk_stats([first, second])
+    assert (total['docs'], total['bytes'], total['sent_bytes'], total['latencies']) == (5, 150, 150, [0.5])
+
+
+def test_only_create_conflicts_count_as_indexed():
+    assert item_succeeded('create', 409)
+    assert item_succeeded('index', 201) and item_succeeded('update', 200)
+    assert not item_succeeded('index', 409) and not item_succeeded('update', 409)
+    assert not item_succeeded('create', 429)
+
+
+def test_partial_response_is_sorted_per_item(tmpdir):
+    payload = bulk_payload(6)
+    results = [('index', {'status': 201}), ('create', {'status': 409}), ('index', {'status': 409}),
+               ('index', {'status': 429}), ('update', {'status': 400, 'error': 'mapper_parsing_exception'}),
+               ('index', {})]
+    body = json.dumps({'errors': True, 'items': [{op: result} for op, result in results]}).encode('utf-8')
+    indexed, retry, failed, rejected = sort_bulk_outcome(200, body, payload, None, 6)
+    pairs = split_bulk_payload(payload)
+    assert (indexed, retry, rejected) == (2, [pairs[3]], True)
+    assert [pair for pair, result in failed] == [pairs[2], pairs[4], pairs[5]]
+    stats = new_bulk_stats(6, len(payload))
+    dead_letter_path = str(tmpdir.join('partial.ndjson'))
+    assert record_bulk_outcome(stats, (indexed, retry, failed, rejected), 0, dead_letter_path=dead_letter_path) \
+        == retry
+    assert (stats['indexed'], stats['retried'], stats['failed'], stats['rejections']) == (2, 1, 3, 1)
+    with open(dead_letter_path) as dead_letters:
+        letters = [json.loads(line) for line in dead_letters]
+    assert [(letter['source']['id'], letter['status']) for letter in letters] == [(2, 409), (4, 400), (5, None)]
+
+
+def test_rejections_left_after_the_last_retry_are_dead_lettered(standin, monkeypatch):
+    monkeypatch.setattr('es_bulk.backoff_delay', lambda attempt: 0)
+    standin.rejection_rate = 1.0
+    stats = submit_bulk_with_retry(requests.Session(), bulk_url(standin), bulk_payload(5), max_retries=2)
+    assert (stats['indexed'], stats['retried'], stats['failed']) == (0, 10, 5)
+    assert standin.requests == 3
+    with open(es_bulk.DEAD_LETTER_PATH) as dead_letters:
+        assert len(dead_letters.readlines()) == 5
@@ -0,0 +1,61 @@
+import pytest
+
+from conftest import STANDIN_CONNECTION, synthetic_table
+from es_connect import migrate_table, generate_json, submit_parallel_es_requests
+from es_mappings import infer_field_kind, import_mappings_from_file, build_profile, profile_mapping
+
+
+def test_field_kinds_are_inferred_from_types_and_names():
+    assert infer_field_kind('logId', 'int(11)') == 'integer'
+    assert infer_field_kind('bytes', 'bigint(20)') == 'long'
+    assert infer_field_kind('logTime', 'datetime') == 'date'
+    assert infer_field_kind('scribePasswordOld', 'varchar(1500)') == 'exclude'
+    assert infer_field_kind('scribeAvatar', 'longtext') == 'stored'
+    assert infer_field_kind('doctorEmail', 'varchar(150)') == 'keyword'
+    assert infer_field_kind('logMessage', 'varchar(500)') == 'text'
+
+
+def test_sampled_strings_are_keywords_when_short_and_repetitive():
+    enum = {'count': 1000, 'distinct': 4, 'max_length': 20, 'spaces': True}
+    assert infer_field_kind('eventName', 'varchar(100)', enum) == 'keyword'
+    assert infer_field_kind('eventName', 'varchar(100)', dict(enum, distinct=900)) == 'text'
+    assert infer_field_kind('eventName', 'varchar(100)', dict(enum, distinct=900, spaces=False)) == 'keyword'
+    assert infer_field_kind('eventName', 'varchar(1000)', dict(enum, max_length=300)) == 'text'
+
+
+def test_unknown_declared_kinds_are_rejected(tmpdir):
+    path = tmpdir.join('tblMappings')
+    path.write('tblname ee_log\nlogMessage fulltext\n')
+    with pytest.raises(ValueError):
+        import_mappings_from_file(str(path))
+
+
+def test_optimized_profile_of_scribe(tmpdir):
+    con, cur = synthetic_table('scribe', 200)
+    assert build_profile(cur, 'scribe', 'legacy') is None
+    with pytest.raises(ValueError):
+        build_profile(cur, 'scribe', 'compact')
+    path = tmpdir.join('tblMappings')
+    path.write('tblname scribe\nscribeLastName keyword\n')
+    profile = build_profile(cur, 'scribe', path=str(path))
+    kinds = dict(profile['fields'])
+    assert sorted(profile['exclude']) == ['scribePassword', 'scribePasswordOld']
+    assert (kinds['scribeAvatar'], kinds['scribeEmail'], kinds['scribeDate'], kinds['mfa']) == \
+        ('stored', 'keyword', 'date', 'integer')
+    assert kinds['scribeLastName'] == 'keyword'
+    properties = profile_mapping(profile, 'record')['mappings']['record']['properties']
+    assert 'scribePassword' not in properties
+    assert properties['scribeAvatar'] == {'type': 'keyword', 'index': False, 'doc_values': False}
+    assert profile_mapping(profile, 'record')['mappings']['record']['dynamic'] is False
+
+
+def test_excluded_columns_are_left_out_of_the_documents(standin):
+    con, cur = synthetic_table('scribe', 50)
+    sources = []
+
+    def api_func(connection, workers, actions_list):
+        sources.extend(actions_list[1::2])
+        return submit_parallel_es_requests(connection, workers, actions_list)
+    migrate_table(STANDIN_CONNECTION, cur, 'scribe', 1, 50, 50, generate_json, api_func, mapping='optimized')
+    assert len(sources) == 50
+    assert all('scribePassword' not in source and 'scribeAvatar' in source for source in sources)
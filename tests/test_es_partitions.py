@@ -0,0 +1,66 @@
+from datetime import datetime
+import calendar
+
+import pytest
+
+from conftest import STANDIN_CONNECTION, synthetic_table
+from es_connect import migrate_table, generate_json, submit_parallel_es_requests, get_es_client
+from es_partitions import daily_indices, put_partition_template, expired_partitions, apply_retention
+
+
+def migrate(cur, partitioning=None):
+    return migrate_table(STANDIN_CONNECTION, cur, 'ee_log', 2, 100, 10 ** 6, generate_json,
+                         submit_parallel_es_requests, id_cols=['logId'], partitioning=partitioning)
+
+
+def partitions(standin):
+    return {name: docs for name, docs in standin.indices.items() if name.startswith('ee_log_index-')}
+
+
+def test_daily_indices_cover_the_window():
+    assert daily_indices('ee_log', datetime(2018, 5, 30, 22), datetime(2018, 6, 1, 1)) == \
+        ['ee_log_index-2018.05.30', 'ee_log_index-2018.05.31', 'ee_log_index-2018.06.01']
+
+
+def test_daily_partitions_hold_every_row_behind_the_read_alias(standin):
+    con, cur = synthetic_table('ee_log', 1000)
+    con.execute("UPDATE ee_log SET logTime = datetime('2018-05-01', '+' || (logId * 200) || ' minutes') "
+                "WHERE logTime IS NOT NULL")
+    undated = con.execute('SELECT COUNT(*) FROM ee_log WHERE logTime IS NULL').fetchone()[0]
+    migrate(cur, 'daily')
+    days = partitions(standin)
+    assert sum(days.values()) == 1000 and days['ee_log_index-undated'] == undated
+    # A row every 200 minutes: rows 1 to 7 fall on the first day, and 139 days plus the undated partition in all
+    assert days['ee_log_index-2018.05.01'] == 7 and len(days) == 140
+    assert standin.aliases['ee_log_index'] == set(days)
+    assert 'ee_log_partitions' in standin.templates
+
+
+def test_partitioning_detaches_the_versioned_index(standin):
+    con, cur = synthetic_table('ee_log', 300)
+    migrate(cur)
+    (versioned,) = standin.aliases['ee_log_index']
+    migrate(cur, 'rollover')
+    assert standin.aliases['ee_log_write'] == {'ee_log_index-000001'}
+    assert standin.aliases['ee_log_index'] == {'ee_log_index-000001'}
+    assert standin.indices['ee_log_index-000001'] == 300 and versioned in standin.indices
+
+
+def test_template_is_refused_while_the_read_alias_is_an_index(standin):
+    get_es_client(STANDIN_CONNECTION).indices.create(index='ee_log_index')
+    with pytest.raises(ValueError):
+        put_partition_template(get_es_client(STANDIN_CONNECTION), 'ee_log', {'mappings': {}})
+
+
+def test_retention_deletes_old_partitions_but_not_the_write_index(standin):
+    es = get_es_client(STANDIN_CONNECTION)
+    for name in ['ee_log_index-2018.01.01', 'ee_log_index-2018.03.31', 'ee_log_index-undated',
+                 'ee_log_index-000001', 'ee_log_index-000002']:
+        es.indices.create(index=name)
+    es.indices.update_aliases(body={'actions': [{'add': {'index': 'ee_log_index-000002', 'alias': 'ee_log_write'}}]})
+    standin.creation_dates['ee_log_index-000001'] = calendar.timegm((2018, 1, 15, 0, 0, 0)) * 1000
+    standin.creation_dates['ee_log_index-000002'] = calendar.timegm((2018, 1, 15, 0, 0, 0)) * 1000
+    now = calendar.timegm((2018, 5, 1, 0, 0, 0))
+    assert expired_partitions(es, 'ee_log', 90, now) == ['ee_log_index-000001', 'ee_log_index-2018.01.01']
+    assert apply_retention(es, 'ee_log', 90, now) == ['ee_log_index-000001', 'ee_log_index-2018.01.01']
+    assert sorted(standin.indices) == ['ee_log_index-000002', 'ee_log_index-2018.03.31', 'ee_log_index-undated']
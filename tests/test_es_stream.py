@@ -0,0 +1,72 @@
+import json
+import time
+
+from conftest import STANDIN_CONNECTION
+import es_bulk
+from es_stream import event_time, tail_ndjson, stream_events, format_lag_summary
+
+
+def events(num_events, created=None):
+    return [{'logId': i, 'logTime': created if created is not None else time.time(), 'logMessage': 'event'}
+            for i in range(num_events)]
+
+
+def test_event_time_reads_epochs_and_utc_strings():
+    assert event_time(1525132800) == 1525132800.0
+    assert event_time('2018-05-01 00:00:00') == 1525132800.0
+    assert event_time('2018-05-01T00:00:01.5Z') == 1525132801.5
+    assert event_time('yesterday') is None and event_time(None) is None
+
+
+def test_tail_ndjson_waits_for_whole_lines_and_follows_truncation(tmpdir):
+    path = tmpdir.join('events.ndjson')
+    path.write('{"old": 1}\n')
+    source = tail_ndjson(str(path), poll_interval=0)
+    assert next(source) is None
+    with open(str(path), 'a') as ndjson_file:
+        ndjson_file.write('{"logId": 1}\n{"logId": ')
+        ndjson_file.flush()
+        assert next(source) == {'logId': 1}
+        assert next(source) is None
+        ndjson_file.write('2}\nnot json\n[3]\n')
+    assert next(source) == {'logId': 2}
+    assert next(source) is None
+    path.write('{"logId": 4}\n')
+    assert next(source) is None
+    assert next(source) == {'logId': 4}
+
+
+def test_events_are_sent_in_batches_of_max_docs(standin):
+    metrics = stream_events(events(25), STANDIN_CONNECTION, 'ee_log_index', max_docs=10, time_field='logTime',
+                            id_field='logId')
+    assert standin.requests == 3 and standin.indices == {'ee_log_index': 25}
+    assert metrics['counters']['indexed'] == 25 and metrics['counters'].get('late', 0) == 0
+    assert len(metrics['histograms']['lag']) == 3
+
+
+def test_a_batch_is_sent_when_its_deadline_passes(standin):
+    def source():
+        yield events(1)[0]
+        time.sleep(0.2)
+        # The deadline is checked on idle polls too
+        yield None
+        time.sleep(0.2)
+        assert standin.requests == 1
+        yield events(1)[0]
+    stream_events(source(), STANDIN_CONNECTION, 'ee_log_index', max_docs=10, max_wait=0.1, wait_for_refresh=False)
+    assert standin.requests == 2
+
+
+def test_old_events_are_counted_late(standin):
+    metrics = stream_events(events(5, created='2018-05-01 00:00:00'), STANDIN_CONNECTION, 'ee_log_index',
+                            time_field='logTime', slo=7.0)
+    assert metrics['counters']['late'] == 5
+    assert '0.00% searchable within the 7.0s SLO' in format_lag_summary(metrics)
+
+
+def test_failed_batches_are_dead_lettered(standin):
+    standin.bulk_statuses = [500]
+    metrics = stream_events(events(4), STANDIN_CONNECTION, 'ee_log_index')
+    assert metrics['counters']['failed'] == 4
+    with open(es_bulk.DEAD_LETTER_PATH) as dead_letters:
+        assert [json.loads(line)['source']['logId'] for line in dead_letters] == [0, 1, 2, 3]
@@ -0,0 +1,52 @@
+import es_tuning
+from es_bulk import new_bulk_stats
+from es_tuning import new_tuning_state, batch_rows, record_doc_bytes, update_tuning_state
+
+
+def batch_stats(docs, num_bytes, rejections=0, latency=0.1):
+    stats = new_bulk_stats(docs, num_bytes)
+    stats['indexed'] = docs
+    stats['rejections'] = rejections
+    stats['latencies'] = [latency]
+    return stats
+
+
+def test_retries_do_not_inflate_document_size():
+    state = new_tuning_state(100, 2)
+    stats = batch_stats(100, 100000, rejections=3)
+    # A retried payload adds to the bytes sent, not to the size of the batch
+    stats['sent_bytes'] += 60000
+    record_doc_bytes(state, stats)
+    assert state['doc_bytes'] == 1000
+    assert batch_rows(state) == es_tuning.DEFAULT_BATCH_BYTES // 1000
+
+
+def test_additive_increase_stops_at_the_maximum():
+    state = new_tuning_state(100, es_tuning.MAX_WORKERS - 1, es_tuning.MAX_BATCH_BYTES - 1)
+    for throughput in range(1, 5):
+        update_tuning_state(state, batch_stats(1000 * throughput, 10 ** 6), 1.0)
+    assert state['workers'] == es_tuning.MAX_WORKERS
+    assert state['batch_bytes'] == es_tuning.MAX_BATCH_BYTES
+
+
+def test_multiplicative_decrease_stops_at_the_minimum():
+    state = new_tuning_state(100, 16)
+    for i in range(20):
+        update_tuning_state(state, batch_stats(1000, 10 ** 6, rejections=1), 1.0)
+    assert state['workers'] == es_tuning.MIN_WORKERS
+    assert state['batch_bytes'] == es_tuning.MIN_BATCH_BYTES
+    assert state['last_change'] == 'decrease'
+
+
+def test_slow_calls_count_as_congestion():
+    state = new_tuning_state(100, 8, 8 * 1024 * 1024)
+    update_tuning_state(state, batch_stats(1000, 10 ** 6, latency=es_tuning.LATENCY_TARGET + 1), 1.0)
+    assert state['workers'] == 4 and state['batch_bytes'] == 6 * 1024 * 1024
+
+
+def test_increase_that_lowers_throughput_is_undone():
+    state = new_tuning_state(100, 4, 4 * 1024 * 1024)
+    update_tuning_state(state, batch_stats(2000, 10 ** 6), 1.0)
+    assert (state['workers'], state['last_change']) == (5, 'increase')
+    update_tuning_state(state, batch_stats(1000, 10 ** 6), 1.0)
+    assert (state['workers'], state['batch_bytes'], state['last_change']) == (4, 4 * 1024 * 1024, 'undo')
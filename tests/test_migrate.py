@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from conftest import STANDIN_CONNECTION, synthetic_table
+import checkpoints
+from checkpoints import get_checkpoint
+from es_connect import (migrate_table, keyset_reader, offset_reader, next_batch, generate_json,
+                        submit_parallel_es_requests)
+
+
+def failing_api(calls):
+    """ Returns a Bulk API function that raises on its <calls>-th call """
+    count = {'calls': 0}
+
+    def api_func(connection, workers, actions_list):
+        count['calls'] += 1
+        if count['calls'] == calls:
+            raise RuntimeError('lost the connection')
+        return submit_parallel_es_requests(connection, workers, actions_list)
+    return api_func
+
+
+def migrate(cur, api_func=submit_parallel_es_requests, **kwargs):
+    return migrate_table(STANDIN_CONNECTION, cur, 'ee_log', 2, 100, 10 ** 6, generate_json, api_func,
+                         id_cols=['logId'], **kwargs)
+
+
+def test_keyset_reader_yields_the_last_key_of_each_batch():
+    con, cur = synthetic_table('ee_log', 250)
+    batches = keyset_reader(cur, 'ee_log', 100)
+    keys = []
+    while True:
+        num_results, cur, last_key = next_batch(batches, cur)
+        if num_results == 0:
+            break
+        rows = cur.fetchall()
+        assert len(rows) == num_results
+        keys.append(last_key)
+    assert keys == [[100], [200], [250]]
+
+
+def test_offset_reader_yields_no_key():
+    con, cur = synthetic_table('ee_log', 50)
+    assert next_batch(offset_reader(cur, 'ee_log', 100), cur)[::2] == (50, None)
+
+
+def test_plain_migration_writes_no_checkpoint(standin, monkeypatch, tmpdir):
+    default_path = str(tmpdir.join('default_checkpoints.json'))
+    monkeypatch.setattr(checkpoints, 'CHECKPOINT_PATH', default_path)
+    con, cur = synthetic_table('ee_log', 500)
+    migrate(cur)
+    assert not os.path.exists(default_path)
+    (index,) = standin.aliases['ee_log_index']
+    assert standin.indices[index] == 500
+
+
+def test_failed_plain_migration_deletes_its_index(standin):
+    con, cur = synthetic_table('ee_log', 500)
+    with pytest.raises(RuntimeError):
+        migrate(cur, failing_api(2))
+    assert not standin.indices
+
+
+def test_checkpointed_migration_resumes_into_the_same_index(standin, checkpoint_path):
+    con, cur = synthetic_table('ee_log', 1000)
+    with pytest.raises(RuntimeError):
+        migrate(cur, failing_api(3), checkpoint_path=checkpoint_path)
+    progress = get_checkpoint('ee_log', 'migration', checkpoint_path)
+    assert progress['last_key'] == [400] and progress['rows'] == 400
+    migrate(cur, resume=True, checkpoint_path=checkpoint_path)
+    assert standin.aliases['ee_log_index'] == {progress['index']}
+    assert standin.indices[progress['index']] == 1000
+    assert get_checkpoint('ee_log', 'migration', checkpoint_path) is None
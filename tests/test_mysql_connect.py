@@ -0,0 +1,88 @@
+import csv
+
+from conftest import synthetic_table
+import mySQL_connect
+from mySQL_connect import csv_byte_ranges, read_csv_range, copy_csv_range, insert_rows, keyset_query
+
+
+class RecordingCursor(object):
+    """ Records the rows of each executemany call """
+    def __init__(self):
+        self.batches = []
+
+    def executemany(self, query, rows):
+        self.batches.append(rows)
+
+
+def write_csv(tmpdir, rows, line_terminator='\n'):
+    path = tmpdir.join('table.csv')
+    with open(str(path), 'w', newline='') as csv_file:
+        csv.writer(csv_file, lineterminator=line_terminator).writerows(rows)
+    return str(path)
+
+
+def test_ranges_cover_every_row_once(tmpdir):
+    rows = [[str(i), 'name, with comma' if i % 7 == 0 else 'name{}'.format(i), 'NULL'] for i in range(1000)]
+    for line_terminator in ['\n', '\r\n']:
+        path = write_csv(tmpdir, rows, line_terminator)
+        ranges = csv_byte_ranges(path, 6)
+        assert len(ranges) == 6
+        read = [row for start, end in ranges for row in read_csv_range(path, start, end)]
+        assert read == rows
+
+
+def test_read_csv_range_is_lazy(tmpdir):
+    path = write_csv(tmpdir, [[str(i)] for i in range(100)])
+    rows = read_csv_range(path, 0, 10)
+    assert not isinstance(rows, list)
+    assert next(rows) == ['0']
+
+
+def test_copy_csv_range_in_blocks(tmpdir, monkeypatch):
+    monkeypatch.setattr(mySQL_connect, 'COPY_BLOCK_BYTES', 7)
+    path = write_csv(tmpdir, [[str(i), 'x' * i] for i in range(50)])
+    with open(path, 'rb') as csv_file:
+        data = csv_file.read()
+    for start, end in csv_byte_ranges(path, 3):
+        out_path = str(tmpdir.join('copy.csv'))
+        with open(out_path, 'wb') as out_file:
+            copy_csv_range(path, start, end, out_file)
+        with open(out_path, 'rb') as out_file:
+            assert out_file.read() == data[start:end]
+
+
+def test_insert_rows_consumes_generator_in_batches():
+    cur = RecordingCursor()
+    rows = ([str(i), 'NULL'] for i in range(25))
+    assert insert_rows(cur, 'site', rows, batch_rows=10) == 25
+    assert [len(batch) for batch in cur.batches] == [10, 10, 5]
+    assert cur.batches[0][0] == ['0', None]
+    assert insert_rows(cur, 'site', iter([]), batch_rows=10) == 0
+
+
+def keyset_ids(cur, key_cols, batch_size, bounds=None):
+    """ Pages through ee_log with keyset_query and returns the logId of every row read """
+    ids = []
+    last_key = None
+    while True:
+        num_results, cur = keyset_query(cur, 'ee_log', key_cols, last_key, batch_size, bounds)
+        if num_results == 0:
+            return ids
+        rows = cur.fetchall()
+        col_names = [col[0] for col in cur.description]
+        ids += [row[col_names.index('logId')] for row in rows]
+        last_key = [rows[-1][col_names.index(col)] for col in key_cols]
+
+
+def test_keyset_query_pages_through_ties_on_the_first_key_column():
+    con, cur = synthetic_table('ee_log', 20)
+    # Rows 3 to 12 share a logTime, so batches have to continue inside the tie on logId
+    con.execute("UPDATE ee_log SET logTime = printf('2018-01-01 00:00:%02d', logId)")
+    con.execute("UPDATE ee_log SET logTime = '2018-01-01 00:00:05' WHERE logId BETWEEN 3 AND 12")
+    assert keyset_ids(cur, ['logTime', 'logId'], 4) == list(range(1, 21))
+
+
+def test_keyset_query_stays_within_bounds():
+    con, cur = synthetic_table('ee_log', 20)
+    assert keyset_ids(cur, ['logId'], 3, ('logId', 5, 15)) == list(range(5, 15))
+    assert keyset_ids(cur, ['logId'], 3, ('logId', None, 4)) == [1, 2, 3]
@@ -0,0 +1,52 @@
+import os
+
+from s3_connect import sync_prefix, list_keys, load_manifest
+from test_s3_ingest import put_object
+
+
+def put_logs(server):
+    for day in ['2018-05-01', '2018-05-02']:
+        for shard in range(3):
+            put_object(server, 'logs', 'ee_log/{}/part-{}.csv'.format(day, shard),
+                       '{},{}\n'.format(day, shard).encode('utf-8'))
+    put_object(server, 'logs', 'ee_log/README', b'exports of ee_log\n')
+
+
+def sync(s3con, tmpdir):
+    return sync_prefix(s3con, 'logs', 'ee_log/', str(tmpdir.join('download')),
+                       manifest_path=str(tmpdir.join('manifest.json')))
+
+
+def test_list_keys_lists_sub_prefixes(s3):
+    server, s3con = s3
+    put_logs(server)
+    names = [key.name for key in list_keys(s3con.get_bucket('logs', validate=False), 'ee_log/')]
+    assert names == sorted(names) and len(names) == 7
+    assert 'ee_log/README' in names and 'ee_log/2018-05-02/part-2.csv' in names
+
+
+def test_unchanged_objects_are_skipped(s3, tmpdir):
+    server, s3con = s3
+    put_logs(server)
+    counts = sync(s3con, tmpdir)
+    assert (counts['listed'], counts['downloaded'], counts['skipped'], counts['failed']) == (7, 7, 0, 0)
+    local_path = str(tmpdir.join('download', 'ee_log', '2018-05-01', 'part-0.csv'))
+    with open(local_path) as local_file:
+        assert local_file.read() == '2018-05-01,0\n'
+    entry = load_manifest(str(tmpdir.join('manifest.json')))['logs']['ee_log/2018-05-01/part-0.csv']
+    assert entry['path'] == local_path and entry['size'] == 13
+    counts = sync(s3con, tmpdir)
+    assert (counts['downloaded'], counts['skipped'], counts['bytes']) == (0, 7, 0)
+
+
+def test_changed_and_missing_objects_are_downloaded_again(s3, tmpdir):
+    server, s3con = s3
+    put_logs(server)
+    sync(s3con, tmpdir)
+    # Same size, different content: only the ETag tells them apart
+    put_object(server, 'logs', 'ee_log/2018-05-01/part-1.csv', b'2018-05-01,9\n')
+    os.remove(str(tmpdir.join('download', 'ee_log', '2018-05-02', 'part-2.csv')))
+    counts = sync(s3con, tmpdir)
+    assert (counts['downloaded'], counts['skipped']) == (2, 5)
+    with open(str(tmpdir.join('download', 'ee_log', '2018-05-01', 'part-1.csv'))) as local_file:
+        assert local_file.read() == '2018-05-01,9\n'
@@ -0,0 +1,62 @@
+import gzip
+import os
+
+from conftest import STANDIN_CONNECTION
+from s3_ingest import object_ranges, decompress_stream, iter_text_lines, stream_csv_rows, ingest_s3_object
+
+
+def site_rows(first, last):
+    return [[str(i), 'Clinique {} été'.format(i), 'lead{}@example.com'.format(i)] for i in range(first, last)]
+
+
+def csv_bytes(rows):
+    return ''.join(','.join(row) + '\n' for row in rows).encode('utf-8')
+
+
+def put_object(server, bucket, key_name, data):
+    path = os.path.join(server.root, bucket, *key_name.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as object_file:
+        object_file.write(data)
+
+
+def test_object_ranges_cover_the_object():
+    assert object_ranges(10, 4) == [(0, 3), (4, 7), (8, 9)]
+    assert object_ranges(8, 4) == [(0, 3), (4, 7)]
+    assert object_ranges(0, 4) == []
+
+
+def test_decompress_stream_reads_concatenated_members_split_anywhere():
+    first, second = csv_bytes(site_rows(0, 50)), csv_bytes(site_rows(50, 120))
+    data = gzip.compress(first) + gzip.compress(second)
+    for part_bytes in [1, 7, 64, len(data)]:
+        parts = [data[i:i + part_bytes] for i in range(0, len(data), part_bytes)]
+        assert b''.join(decompress_stream(parts)) == first + second
+
+
+def test_text_lines_join_characters_split_between_chunks():
+    data = csv_bytes(site_rows(0, 3))
+    chunks = [data[i:i + 1] for i in range(len(data))]
+    assert ''.join(iter_text_lines(chunks)) == data.decode('utf-8')
+
+
+def test_gzip_members_are_streamed_across_ranged_gets(s3):
+    server, s3con = s3
+    rows = site_rows(0, 300)
+    put_object(server, 'exports', 'daily/site.csv.gz', gzip.compress(csv_bytes(rows[:100])) +
+               gzip.compress(csv_bytes(rows[100:])))
+    bucket = s3con.get_bucket('exports', validate=False)
+    assert list(stream_csv_rows(bucket, 'daily/site.csv.gz', part_bytes=256, workers=3)) == rows
+    # One HEAD for the size, then one ranged GET per part
+    size = os.path.getsize(os.path.join(server.root, 'exports', 'daily', 'site.csv.gz'))
+    assert server.requests == 1 + len(object_ranges(size, 256))
+    assert server.bytes_sent == size
+
+
+def test_ingest_indexes_every_row(s3, standin):
+    server, s3con = s3
+    put_object(server, 'exports', 'site.csv', csv_bytes([['id', 'siteName', 'siteLeadEmail']] + site_rows(0, 250)))
+    num_rows, elapsed = ingest_s3_object(s3con, 'exports', 'site.csv', STANDIN_CONNECTION, 'site', 2, 50,
+                                         part_mb=0.001, skip_header=True, id_cols=['id'])
+    assert num_rows == 250
+    assert standin.indices == {'site_index': 250}
@@ -0,0 +1,62 @@
+import pytest
+
+from conftest import STANDIN_CONNECTION, synthetic_table
+import es_connect
+from checkpoints import get_checkpoint
+from es_connect import sync_table, generate_json, submit_parallel_es_requests
+
+
+def failing_api(calls):
+    """ Returns a Bulk API function that raises on its <calls>-th call """
+    count = {'calls': 0}
+
+    def api_func(connection, workers, actions_list):
+        count['calls'] += 1
+        if count['calls'] == calls:
+            raise RuntimeError('lost the connection')
+        return submit_parallel_es_requests(connection, workers, actions_list)
+    return api_func
+
+
+def sync(cur, checkpoint_path, api_func=submit_parallel_es_requests):
+    return sync_table(STANDIN_CONNECTION, cur, 'ee_log', 2, 100, generate_json, api_func,
+                      checkpoint_path=checkpoint_path, id_cols=['logId'])
+
+
+def test_first_sync_loads_and_swaps_alias(standin, checkpoint_path):
+    con, cur = synthetic_table('ee_log', 1000)
+    synced, total_time = sync(cur, checkpoint_path)
+    assert synced == 1000
+    (index,) = standin.aliases['ee_log_index']
+    assert index.startswith('ee_log_index_v') and standin.indices[index] == 1000
+    watermark = get_checkpoint('ee_log', 'watermark', checkpoint_path)
+    assert watermark['last_key'] == [1000] and watermark['loading'] is None
+
+
+def test_incremental_sync_appends_new_rows(standin, checkpoint_path):
+    con, cur = synthetic_table('ee_log', 1000)
+    sync(cur, checkpoint_path)
+    con.execute('INSERT INTO ee_log (logId) VALUES (1001), (1002)')
+    assert sync(cur, checkpoint_path)[0] == 2
+    (index,) = standin.aliases['ee_log_index']
+    assert standin.indices[index] == 1002
+
+
+def test_crashed_first_sync_is_finished_by_the_next(standin, checkpoint_path):
+    con, cur = synthetic_table('ee_log', 1000)
+    with pytest.raises(RuntimeError):
+        sync(cur, checkpoint_path, failing_api(3))
+    loading = get_checkpoint('ee_log', 'watermark', checkpoint_path)['loading']
+    assert loading in standin.indices and 'ee_log_index' not in standin.aliases
+    assert sync(cur, checkpoint_path)[0] == 600
+    # The rows went into the index being loaded, which is now live, and no concrete ee_log_index was created
+    assert standin.aliases['ee_log_index'] == {loading}
+    assert standin.indices[loading] == 1000 and 'ee_log_index' not in standin.indices
+
+
+def test_sync_reloads_when_the_alias_is_gone(standin, checkpoint_path):
+    con, cur = synthetic_table('ee_log', 500)
+    sync(cur, checkpoint_path)
+    es_connect.get_es_client(STANDIN_CONNECTION).indices.delete(index=','.join(standin.aliases['ee_log_index']))
+    assert sync(cur, checkpoint_path)[0] == 500
+    assert 'ee_log_index' not in standin.indices and len(standin.aliases['ee_log_index']) == 1